@@ -0,0 +1,350 @@
+"""
+Scriptable control of the spectrophotometer, and unattended runs of measurement protocols.
+
+    with Acquisition.Spectrophotometer("/dev/ttyACM0") as device:
+        device.setExposure("B")               # a preset, or a time in ms: device.setExposure(25)
+        frame = device.acquire("led")        # lamp on, read, lamp off, read dark
+        frame["corrected"]
+        device.autoExposure("led")           # peak at 80% of the ADC range
+
+A protocol file (JSON) lists the samples of a run with their exposures (a preset letter, a
+time in ms, or "auto"), repeats and delays:
+
+    {"output": "cyan series.spec", "mode": "absorbance", "exposure": "B", "repeats": 3,
+     "samples": [{"name": "blank"}, {"name": "cyan 50", "repeats": 5, "delay": 60}]}
+
+and runProtocol() measures them without an operator, handing the frames to a background
+writer so that disk access does not hold up the acquisition.
+"""
+
+import collections
+import json
+import re
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy
+
+import Calibration
+import Storage
+
+DEFAULT_PORT = "/dev/ttyACM0"
+# exposure times (ms) selected by the command letters of the firmware
+# (arduino_CLK_and_LED_combined_24_Nov_.ino)
+EXPOSURES = {"A": 1, "B": 10, "C": 30, "D": 500, "E": 700}
+# the presets of the menus: the firmware's letters, and the long fluorescence exposures
+# F, G and H, which the firmware has no letter for and are sent as 'T' commands
+PRESETS = dict(EXPOSURES, F=1000, G=2000, H=3000)
+# exposure limits (ms) of the 'T' command of the firmware
+MIN_EXPOSURE = 1
+MAX_EXPOSURE = 60000
+# the 10 bit ADC of the Arduino
+FULL_SCALE = 1023
+# lamp on and off commands
+LAMPS = {"led": ("Y", "X"), "uv": ("U", "V")}
+MODES = {"absorbance": "led", "fluorescence": "uv"}
+
+class DeviceError(Exception):
+    "The spectrometer did not answer as expected"
+
+class Spectrophotometer:
+    "The Arduino driving the line sensor and the LED and UV lamps, over a serial port"
+    def __init__(self, port=DEFAULT_PORT, timeout=1, calibration=None, settle=2.0, readDelay=1.0, connection=None):
+        self.port = port
+        self.timeout = timeout
+        self.calibration = calibration or Calibration.calibration()
+        # seconds to wait for the lamp to go dark, and for the sensor to be read out
+        self.settle = settle
+        self.readDelay = readDelay
+        # counts from which a channel is taken to be saturated
+        self.saturation = FULL_SCALE - 3
+        self.connection = connection
+        self.exposure = numpy.nan
+        self.lamps = dict((name, False) for name in LAMPS)
+
+    def __repr__(self):
+        return "Spectrophotometer(%r)" % self.port
+
+    def connect(self):
+        if self.connection is None:
+            import serial
+            self.connection = serial.Serial(self.port, timeout=self.timeout)
+            # the Arduino resets when the port is opened
+            time.sleep(1)
+        return self
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def __enter__(self):
+        return self.connect()
+
+    def __exit__(self, *exception):
+        for name in LAMPS:
+            if self.lamps[name]: self.lamp(name, False)
+        self.close()
+
+    def command(self, letters):
+        self.connection.write(letters.encode("ascii"))
+
+    def setExposure(self, exposure):
+        "Select one of the exposure presets by its letter, or any exposure time in ms"
+        if isinstance(exposure, str):
+            if exposure not in PRESETS:
+                raise ValueError("unknown exposure %r, expected one of %s or a time in ms"
+                                 % (exposure, "".join(sorted(PRESETS))))
+            if exposure not in EXPOSURES: return self.setExposure(PRESETS[exposure])
+            self.command(exposure)
+            self.exposure = EXPOSURES[exposure]
+        else:
+            exposure = int(round(exposure))
+            if not MIN_EXPOSURE <= exposure <= MAX_EXPOSURE:
+                raise ValueError("exposure %d ms outside %d..%d ms" % (exposure, MIN_EXPOSURE, MAX_EXPOSURE))
+            self.command("T%d\n" % exposure)
+            self.exposure = exposure
+
+    def lamp(self, name, on=True):
+        "Switch the 'led' or 'uv' lamp"
+        self.command(LAMPS[name][0 if on else 1])
+        self.lamps[name] = on
+
+    def readTime(self):
+        "Seconds a spectrum takes to read at the current exposure"
+        # the firmware integrates for the exposure before it sends anything
+        exposure = self.exposure if numpy.isfinite(self.exposure) else MIN_EXPOSURE
+        return self.readDelay + exposure / 1000.0
+
+    def readSpectrum(self):
+        "Read one raw spectrum from the sensor"
+        self.command("R")
+        self.connection.flush()
+        time.sleep(self.readTime())
+        header = self.connection.readline().decode()
+        if header.startswith("Exposure:"):
+            # the firmware reports the exposure it actually used
+            self.exposure = float(header.split(":")[1])
+        data = numpy.empty(len(self.calibration.channels))
+        for channel in self.calibration.channels:
+            response = self.connection.readline().decode().split(",")
+            if len(response) < 2:
+                raise DeviceError("no data for channel %d" % channel)
+            if channel != int(response[0]):
+                print("warning - channel numbers do not match")
+            data[channel] = float(response[1])
+        return data
+
+    def acquire(self, lamp="led", dark=None):
+        """Lamp on, read, lamp off, read the dark spectrum (unless one is given) and
+        return the frame with the dark corrected spectrum"""
+        timestamp = time.time()
+        self.lamp(lamp, True)
+        intensities = self.readSpectrum()
+        self.lamp(lamp, False)
+        if dark is None:
+            time.sleep(self.settle)
+            dark = self.readSpectrum()
+        return dict(intensities=intensities, dark=dark, corrected=numpy.clip(intensities - dark, 0.001, 1024),
+                    wavelengths=self.calibration.wavelengths, exposure=self.exposure, timestamp=timestamp,
+                    lamp=lamp, saturated=int(numpy.count_nonzero(intensities >= self.saturation)))
+
+    def autoExposure(self, lamp="led", target=0.8, tolerance=0.1, start=None, minimum=MIN_EXPOSURE,
+                     maximum=MAX_EXPOSURE, maxReads=8, log=None):
+        """Find the exposure that brings the highest channel to target (fraction of the ADC
+        range) within tolerance, and leave it set; returns the exposure in ms.
+
+        Below saturation the signal above the dark level grows linearly with the exposure,
+        so each read predicts the exposure to try next. A saturated read only says that the
+        exposure is too long: it becomes an upper bound and the next try is well below it.
+        The search stops after maxReads reads (including the dark read) with the best
+        unsaturated exposure found."""
+        if not 0 < target < 1:
+            raise ValueError("target must be a fraction of the ADC range")
+        if start is None:
+            start = self.exposure if numpy.isfinite(self.exposure) else 10
+        exposure = min(max(float(start), minimum), maximum)
+        self.lamp(lamp, False)
+        self.setExposure(exposure)
+        time.sleep(self.settle)
+        offset = numpy.median(self.readSpectrum())
+        goal = target * FULL_SCALE
+        # longest exposure known not to saturate, shortest known to saturate
+        low, high = None, maximum + 1
+        best = None
+        self.lamp(lamp, True)
+        try:
+            for read in range(maxReads - 1):
+                self.setExposure(exposure)
+                exposure = self.exposure
+                peak = self.readSpectrum().max()
+                if log: log("exposure %g ms: peak %d" % (exposure, peak))
+                if peak >= self.saturation:
+                    # the true peak may be far above full scale
+                    high = exposure
+                    proposed = exposure / 10.0 if low is None else numpy.sqrt(low * high)
+                else:
+                    low = exposure
+                    if best is None or abs(peak - goal) < abs(best[1] - goal):
+                        best = (exposure, peak)
+                    if abs(peak - goal) <= tolerance * goal: break
+                    signal = peak - offset
+                    if signal <= 0.01 * FULL_SCALE:
+                        # nothing above the dark level to extrapolate from
+                        proposed = exposure * 10
+                    else:
+                        proposed = exposure * (goal - offset) / signal
+                    if proposed >= high:
+                        proposed = numpy.sqrt(exposure * high)
+                proposed = min(max(proposed, minimum), maximum)
+                if round(proposed) == exposure: break
+                exposure = proposed
+        finally:
+            self.lamp(lamp, False)
+        self.setExposure(best[0] if best is not None else minimum)
+        return self.exposure
+
+class QueuedWriter:
+    "Appends frames to a spectrum file from a background thread"
+    def __init__(self, store):
+        self.store = store
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None: break
+            intensities, metadata = item
+            try:
+                self.store.append(intensities, **metadata)
+            except Exception as e:
+                self.error = e
+
+    def put(self, intensities, **metadata):
+        if self.error is not None: raise self.error
+        self.queue.put((numpy.array(intensities), metadata))
+
+    def close(self):
+        "Wait for the queued frames to be written"
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None: raise self.error
+
+class Protocol:
+    "A list of samples to measure, with their exposure, repeats, delay before and interval between frames"
+    defaults = dict(exposure=None, repeats=1, delay=0.0, interval=0.0, saveRaw=False)
+    def __init__(self, samples, output, mode="absorbance", **defaults):
+        if mode not in MODES:
+            raise ValueError("unknown mode %r" % mode)
+        unknown = set(defaults) - set(self.defaults)
+        if unknown: raise ValueError("unknown protocol settings %s" % ", ".join(sorted(unknown)))
+        self.output = output
+        self.mode = mode
+        settings = dict(self.defaults)
+        settings.update(defaults)
+        self.samples = []
+        for sample in samples:
+            if isinstance(sample, str): sample = dict(name=sample)
+            unknown = set(sample) - set(self.defaults) - set(["name"])
+            if unknown: raise ValueError("unknown sample settings %s" % ", ".join(sorted(unknown)))
+            self.samples.append(dict(settings, **sample))
+
+    def __repr__(self):
+        return "Protocol(%d samples -> %r)" % (len(self.samples), self.output)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as fd:
+            description = json.load(fd)
+        return cls(**description)
+
+    def frames(self):
+        return sum(s["repeats"] for s in self.samples)
+
+def runProtocol(protocol, device, store=None, log=print):
+    "Measure every sample of a protocol, returning the number of frames written"
+    if store is None:
+        store = Storage.SpectrumFile(protocol.output, device.calibration.wavelengths)
+    writer = QueuedWriter(store)
+    lamp = MODES[protocol.mode]
+    count = 0
+    try:
+        for sample in protocol.samples:
+            if sample["exposure"] == "auto":
+                log("exposure for %s: %g ms" % (sample["name"], device.autoExposure(lamp)))
+            elif sample["exposure"] is not None:
+                device.setExposure(sample["exposure"])
+            if sample["delay"]:
+                log("waiting %g s before %s" % (sample["delay"], sample["name"]))
+                time.sleep(sample["delay"])
+            for repeat in range(sample["repeats"]):
+                if repeat and sample["interval"]: time.sleep(sample["interval"])
+                frame = device.acquire(lamp)
+                metadata = dict(timestamp=frame["timestamp"], exposure=frame["exposure"],
+                                sample=sample["name"], device=str(device.port))
+                writer.put(frame["corrected"], mode=protocol.mode, **metadata)
+                if sample["saveRaw"]:
+                    writer.put(frame["intensities"], mode="raw", **metadata)
+                    writer.put(frame["dark"], mode="dark", **metadata)
+                count += 1
+                log("%s %d/%d (%d/%d)" % (sample["name"], repeat + 1, sample["repeats"], count, protocol.frames()))
+    finally:
+        writer.close()
+    return count
+
+class SimulatedConnection:
+    """Stands in for the serial port, answering like the Arduino firmware; for dry runs of protocols.
+    With realtime, a spectrum only arrives after its exposure, and readline() waits for at
+    most timeout seconds like a serial port before giving up with an empty line."""
+    def __init__(self, channels=256, seed=0, realtime=False, timeout=1):
+        self.channels = channels
+        self.realtime = realtime
+        self.timeout = timeout
+        self.ready = 0.0
+        self.random = numpy.random.RandomState(seed)
+        self.exposure = 1
+        self.lamps = dict(led=False, uv=False)
+        self.output = collections.deque()
+        x = numpy.arange(channels)
+        self.ledSpectrum = 700 * numpy.exp(-0.5 * ((x - 150) / 45.0)**2)
+        self.uvSpectrum = 300 * numpy.exp(-0.5 * ((x - 90) / 20.0)**2)
+
+    def write(self, data):
+        for command in re.findall(r"T\s*\d+|.", data.decode("ascii"), re.S):
+            if command in "YX": self.lamps["led"] = command == "Y"
+            elif command in "UV": self.lamps["uv"] = command == "U"
+            elif command in EXPOSURES: self.exposure = EXPOSURES[command]
+            elif command[0] == "T": self.exposure = min(max(int(command[1:]), MIN_EXPOSURE), MAX_EXPOSURE)
+            elif command == "R": self._read()
+
+    def _read(self):
+        signal = 5 + self.random.normal(0, 1, self.channels)
+        scale = self.exposure / 10.0
+        if self.lamps["led"]: signal += self.ledSpectrum * scale
+        if self.lamps["uv"]: signal += self.uvSpectrum * scale
+        signal = numpy.clip(numpy.round(signal), 0, FULL_SCALE).astype(int)
+        if self.realtime: self.ready = time.time() + self.exposure / 1000.0
+        self.output.append("Exposure: %d\n" % self.exposure)
+        self.output.extend("%d,%d\n" % (x, v) for x, v in enumerate(signal))
+
+    def readline(self):
+        if self.realtime:
+            wait = self.ready - time.time()
+            time.sleep(min(max(wait, 0), self.timeout))
+            if wait > self.timeout: return b""
+        return self.output.popleft().encode("ascii") if self.output else b""
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
@@ -0,0 +1,74 @@
+"""
+Analysis of concentration series: absorbance, and straight line fits of signal against
+concentration for every channel of a stack of spectra at once.
+
+    fit = Analysis.fitLines(concentrations, spectra)     # spectra: (samples, channels)
+    fit.slopes, fit.intercepts, fit.rsquared, fit.stderr
+"""
+
+import numpy
+
+def absorbance(reference, intensities, floor=0.001):
+    "log10(reference/intensities), with both clipped to floor as in the acquisition UI"
+    reference = numpy.maximum(reference, floor)
+    intensities = numpy.maximum(intensities, floor)
+    return numpy.log10(reference / intensities)
+
+class LineFit:
+    "Per channel straight lines signal = intercept + slope * concentration"
+    def __init__(self, slopes, intercepts, rsquared, stderr, interceptStderr, residualStd, n):
+        self.slopes = slopes
+        self.intercepts = intercepts
+        self.rsquared = rsquared
+        self.stderr = stderr
+        self.interceptStderr = interceptStderr
+        self.residualStd = residualStd
+        self.n = n
+
+    def __repr__(self):
+        return "LineFit(%d channels)" % len(self.slopes)
+
+    def __call__(self, concentration):
+        "Predicted signal for a concentration (or a column of them)"
+        return self.intercepts + self.slopes * numpy.asarray(concentration)[..., numpy.newaxis]
+
+def fitLines(concentrations, data, weights=None, mask=None):
+    """Closed form weighted least squares fit of data[:, i] against concentrations for all
+    channels i, equivalent to calling scipy.stats.linregress once per channel.
+    weights (samples, or samples x channels) scale each point's squared residual;
+    mask (same shapes) is True for outliers that are left out of the fit."""
+    x = numpy.asarray(concentrations, dtype=float)
+    y = numpy.asarray(data, dtype=float)
+    if y.ndim != 2 or len(x) != len(y):
+        raise ValueError("need one concentration per spectrum, got %d and %s" % (len(x), y.shape))
+    w = numpy.ones(y.shape) if weights is None else numpy.broadcast_to(
+        numpy.asarray(weights, dtype=float).reshape(len(x), -1), y.shape).copy()
+    if mask is not None:
+        w[numpy.broadcast_to(numpy.asarray(mask, dtype=bool).reshape(len(x), -1), y.shape)] = 0
+    # masked points may hold nan or inf, which must not leak into the sums
+    y = numpy.where(w > 0, y, 0.0)
+    # the sums are accumulated as matrix products about a rough origin (x0, y0), which
+    # keeps the cancellation in the centred moments small
+    x0 = x.mean()
+    y0 = y.mean(axis=0)
+    x = x - x0
+    y -= y0
+    wy = w * y
+    sw = w.sum(axis=0)
+    n = (w > 0).sum(axis=0)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        xm = x.dot(w) / sw
+        ym = wy.sum(axis=0) / sw
+        sxx = (x * x).dot(w) - sw * xm**2
+        sxy = x.dot(wy) - sw * xm * ym
+        syy = numpy.einsum("ij,ij->j", wy, y) - sw * ym**2
+        slopes = sxy / sxx
+        intercepts = ym + y0 - slopes * (xm + x0)
+        ssres = numpy.maximum(syy - slopes * sxy, 0.0)
+        rsquared = numpy.where(syy > 0, 1.0 - ssres / syy, 1.0)
+        residualStd = numpy.sqrt(ssres / (n - 2))
+        stderr = residualStd / numpy.sqrt(sxx)
+        interceptStderr = stderr * numpy.sqrt(sxx / sw + (xm + x0)**2)
+    for a in stderr, interceptStderr, residualStd:
+        a[n <= 2] = numpy.nan
+    return LineFit(slopes, intercepts, rsquared, stderr, interceptStderr, residualStd, n)
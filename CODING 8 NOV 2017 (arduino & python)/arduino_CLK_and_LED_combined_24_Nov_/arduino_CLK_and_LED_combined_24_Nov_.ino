@@ -48,7 +48,7 @@ void readSensor() {
 
 // the loop function runs over and over again forever
 void loop() {
-  static int exposure = 1;
+  static long exposure = 1;
   
   while(Serial.available() == 0);
   char command = Serial.read();
@@ -86,6 +86,10 @@ void loop() {
     case 'E': 
       exposure = 700;
       break;
+    case 'T':
+      // arbitrary exposure in ms, e.g. T250 followed by a newline
+      exposure = constrain(Serial.parseInt(), 1, 60000);
+      break;
     case 'R':
       readSensor();
       delay(exposure);
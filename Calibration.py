@@ -0,0 +1,86 @@
+"""
+Pixel number <-> wavelength calibration of the spectrometer's 256 channel line sensor.
+
+The wavelength axis is evaluated once per calibration and reused for every frame;
+the inverse lookup (wavelength -> fractional pixel) interpolates on a finely sampled
+copy of the same polynomial.
+"""
+
+import numpy
+
+# wavelength = a + b*x + c*x**2 + d*x**3 (nm), as used by Spectrophotometer v13
+DEFAULT_COEFFICIENTS = (379.092, 1.00553, -0.00786286, 4.69722e-5)
+CHANNELS = 256
+
+# emission lines of a low pressure mercury lamp (nm), useful for recalibration
+MERCURY_LINES = (404.656, 435.833, 546.074, 576.960, 579.066)
+
+class Calibration:
+    "Polynomial mapping from pixel number to wavelength in nm"
+    def __init__(self, coefficients=DEFAULT_COEFFICIENTS, channels=CHANNELS, oversampling=16):
+        # coefficients in increasing order of power
+        self.coefficients = tuple(float(c) for c in coefficients)
+        self.channels = numpy.arange(channels)
+        self.channels.flags.writeable = False
+        self.wavelengths = self(self.channels.astype(float))
+        self.wavelengths.flags.writeable = False
+        # finely sampled axis for the inverse lookup
+        self._pixels = numpy.linspace(0, channels - 1, (channels - 1) * oversampling + 1)
+        self._fine = self(self._pixels)
+        if numpy.any(numpy.diff(self._fine) <= 0):
+            raise ValueError("calibration is not monotonic over the sensor")
+
+    def __repr__(self):
+        return "Calibration(%s)" % ", ".join("%g" % c for c in self.coefficients)
+
+    def __eq__(self, other):
+        return isinstance(other, Calibration) and self.coefficients == other.coefficients \
+            and len(self.channels) == len(other.channels)
+
+    def __hash__(self):
+        return hash((self.coefficients, len(self.channels)))
+
+    def __call__(self, pixelnumber):
+        "Wavelength (nm) of a pixel number, or of an array of them"
+        return numpy.polynomial.polynomial.polyval(pixelnumber, self.coefficients)
+
+    def pixel(self, wavelength):
+        "Fractional pixel number of a wavelength (nm), or of an array of them"
+        return numpy.interp(wavelength, self._fine, self._pixels, left=numpy.nan, right=numpy.nan)
+
+    @classmethod
+    def fromLines(cls, pixels, wavelengths, degree=3, channels=CHANNELS):
+        "Least squares fit of a calibration to the pixel positions of known emission lines"
+        if len(pixels) != len(wavelengths):
+            raise ValueError("need one wavelength per line position")
+        if len(pixels) <= degree:
+            raise ValueError("need at least %d lines for a degree %d fit" % (degree + 1, degree))
+        coefficients = numpy.polynomial.polynomial.polyfit(pixels, wavelengths, degree)
+        return cls(coefficients, channels)
+
+def linePixels(intensities, approximatePixels, halfWidth=3):
+    "Sub-pixel positions (intensity weighted centroids) of the peaks near the given pixels"
+    intensities = numpy.asarray(intensities, dtype=float)
+    positions = []
+    for p in approximatePixels:
+        lo = max(int(round(p)) - halfWidth, 0)
+        hi = min(int(round(p)) + halfWidth + 1, len(intensities))
+        # recentre on the local maximum before taking the centroid
+        peak = lo + int(numpy.argmax(intensities[lo:hi]))
+        lo = max(peak - halfWidth, 0)
+        hi = min(peak + halfWidth + 1, len(intensities))
+        window = intensities[lo:hi] - intensities[lo:hi].min()
+        if window.sum() <= 0:
+            positions.append(float(peak))
+        else:
+            positions.append(float(numpy.dot(numpy.arange(lo, hi), window) / window.sum()))
+    return numpy.array(positions)
+
+_cache = {}
+
+def calibration(coefficients=DEFAULT_COEFFICIENTS, channels=CHANNELS):
+    "Shared Calibration instance, so that every reader of the same calibration uses one axis"
+    key = (tuple(float(c) for c in coefficients), channels)
+    if key not in _cache:
+        _cache[key] = Calibration(coefficients, channels)
+    return _cache[key]
@@ -0,0 +1,164 @@
+"""
+Index of the spectra in the "experimentation overall" archive.
+
+The archive identifies each measurement only by its path, e.g.
+"absorbance/CYAN/EXPERIMENTATION 1 30 NOV/data/RAW data/final data/Experimentation 1 Cyan Raw 50 concen final.csv".
+Dataset scans the tree once, parses every path into metadata (dye, experiment, concentration,
+mode, kind) and stores all spectra in a memory mapped (sample x channel) cube next to a JSON
+index. The cache is rebuilt only for files whose modification time or size changed.
+
+    data = Dataset.Dataset("experimentation overall")
+    rows = data.select(dye="cyan", mode="absorbance", kind="raw", concentration=50)
+    data.intensities[rows]
+"""
+
+import json
+import os
+import re
+
+import numpy
+
+import Storage
+
+CACHE = ".dataset-cache"
+INDEX_VERSION = 1
+
+def _number(text):
+    return float(text.replace(" ", "."))
+
+def parseName(relativepath):
+    "Metadata encoded in the path of an archived spectrum, relative to the archive root"
+    parts = relativepath.replace("\\", "/").split("/")
+    lowerpath = "/".join(parts).lower()
+    name = os.path.splitext(parts[-1])[0]
+    lower = name.lower()
+    entry = dict(path=relativepath)
+    entry["mode"] = "fluorescence" if "fluorescence" in lowerpath else "absorbance"
+    entry["dye"] = "cyan" if "cyan" in lowerpath else "magenta" if "magenta" in lowerpath else ""
+    # the experiment number from the folders, falling back on the file name
+    entry["experiment"] = None
+    for part in parts[:-1] + [name]:
+        match = re.search(r"\bexp[a-z]*\s*(\d+)", part.lower())
+        if match:
+            entry["experiment"] = int(match.group(1))
+            break
+    if "reference" in lower:
+        entry["kind"] = "reference"
+    elif "ratio" in lower or "absor" in lower or "absorption" in [p.lower() for p in parts[:-1]]:
+        entry["kind"] = "ratio"
+    else:
+        entry["kind"] = "raw"
+    entry["final"] = "final" in lowerpath
+    entry["retake"] = "retake" in lower
+    entry["concentration"] = concentration(lower, entry["kind"])
+    return entry
+
+def concentration(lowername, kind="raw"):
+    "Concentration in percent, from names like '12 5% ...', '12.5% ...' or '125 concen ...'"
+    if kind == "reference": return 0.0
+    # "6 25%", "12 5%" and "12.5%" are decimal percentages
+    match = re.search(r"(\d+(?:[ .]\d+)?)\s*%", lowername)
+    if match: return _number(match.group(1))
+    match = re.search(r"(?:^|\s)(\d+)\s+concen", lowername) or re.search(r"^(\d+)\s+(?:cyan|magenta)", lowername)
+    if match:
+        # without a percent sign, 125 and 625 are 12.5% and 6.25% with the point dropped
+        return {"125": 12.5, "625": 6.25}.get(match.group(1), float(match.group(1)))
+    return None
+
+class Dataset:
+    "Memory mapped spectra and metadata of all CSV files below root"
+    def __init__(self, root, cache=None):
+        self.root = root
+        self.cache = cache or os.path.join(root, CACHE)
+        self.refresh()
+
+    def __repr__(self):
+        return "Dataset(%r, %d spectra)" % (self.root, len(self.entries))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def scan(self):
+        "Relative paths, modification times and sizes of the CSV files in the archive"
+        files = []
+        for directory, subdirectories, filenames in os.walk(self.root):
+            subdirectories[:] = sorted(d for d in subdirectories if not d.startswith("."))
+            for filename in sorted(filenames):
+                if filename.lower().endswith(".csv"):
+                    path = os.path.join(directory, filename)
+                    status = os.stat(path)
+                    files.append((os.path.relpath(path, self.root), status.st_mtime, status.st_size))
+        return files
+
+    def refresh(self):
+        "Load the cached index, re-reading only the files that were added or changed"
+        files = self.scan()
+        index = self._loadIndex()
+        if index is not None and [tuple(f) for f in index["files"]] == files:
+            self.entries = index["entries"]
+            self.intensities = numpy.load(os.path.join(self.cache, "intensities.npy"), mmap_mode="r")
+            self.wavelengths = numpy.load(os.path.join(self.cache, "wavelengths.npy"), mmap_mode="r")
+            return
+        previous = {}
+        if index is not None:
+            old = numpy.load(os.path.join(self.cache, "intensities.npy"), mmap_mode="r")
+            oldwl = numpy.load(os.path.join(self.cache, "wavelengths.npy"), mmap_mode="r")
+            for row, f in enumerate(index["files"]):
+                previous[tuple(f)] = (old[row], oldwl[row])
+        spectra = []
+        for f in files:
+            if f in previous:
+                spectra.append(previous[f])
+            else:
+                channels, wavelengths, intensities = Storage.readCSV(os.path.join(self.root, f[0]))
+                spectra.append((intensities, wavelengths))
+        self._write(files, spectra)
+
+    def _loadIndex(self):
+        try:
+            with open(os.path.join(self.cache, "index.json")) as fd:
+                index = json.load(fd)
+        except (IOError, ValueError):
+            return None
+        if index.get("version") != INDEX_VERSION: return None
+        return index
+
+    def _write(self, files, spectra):
+        channels = max([len(s[0]) for s in spectra] or [0])
+        if not os.path.isdir(self.cache): os.makedirs(self.cache)
+        cubes = {}
+        for name, column in ("intensities", 0), ("wavelengths", 1):
+            # written to a temporary name first, since the old cube may still be mapped
+            temporary = os.path.join(self.cache, name + ".new.npy")
+            cube = numpy.lib.format.open_memmap(temporary, mode="w+", dtype=float, shape=(len(spectra), channels))
+            cube[:] = numpy.nan
+            for row, s in enumerate(spectra):
+                cube[row, :len(s[column])] = s[column]
+            cube.flush()
+            del cube
+            os.replace(temporary, os.path.join(self.cache, name + ".npy"))
+            cubes[name] = numpy.load(os.path.join(self.cache, name + ".npy"), mmap_mode="r")
+        self.entries = [parseName(f[0]) for f in files]
+        with open(os.path.join(self.cache, "index.json"), "w") as fd:
+            json.dump(dict(version=INDEX_VERSION, files=files, entries=self.entries), fd, indent=0)
+        self.intensities = cubes["intensities"]
+        self.wavelengths = cubes["wavelengths"]
+
+    def select(self, **query):
+        "Row numbers of the spectra whose metadata match all the given values"
+        rows = []
+        for row, entry in enumerate(self.entries):
+            for key, value in query.items():
+                if key not in entry:
+                    raise KeyError("unknown metadata %r" % key)
+                if isinstance(value, (list, tuple, set)):
+                    if entry[key] not in value: break
+                elif entry[key] != value: break
+            else:
+                rows.append(row)
+        return numpy.array(rows, dtype=int)
+
+    def spectra(self, **query):
+        "Metadata, wavelengths and intensities of the matching spectra"
+        rows = self.select(**query)
+        return [self.entries[r] for r in rows], self.wavelengths[rows], self.intensities[rows]
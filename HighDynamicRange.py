@@ -0,0 +1,126 @@
+"""
+High dynamic range spectra, merged from a bracket of exposures.
+
+Each exposure is divided by its time, giving counts per ms. Channels that saturate, or
+that barely rise above the dark level, are masked out. The remaining estimates of every
+channel are then averaged with inverse variance weights, all channels at once:
+
+    darks = HighDynamicRange.DarkCache(device)
+    frame = HighDynamicRange.acquire(device, "uv", [100, 1000, 3000], darks)
+    frame["corrected"], frame["uncertainty"]       # counts per ms
+
+The dark frames of each exposure are kept, so only the first bracket (or one after the
+cache has expired) reads them.
+"""
+
+import time
+
+import numpy
+
+import Acquisition
+
+# noise of one read of the sensor (counts), and counts per photo electron
+READ_NOISE = 2.0
+GAIN = 1.0
+
+def bracket(exposure, stops=3, factor=4.0):
+    "stops exposures spaced by factor, centred on exposure (ms)"
+    exposures = exposure * float(factor)**(numpy.arange(stops) - (stops - 1) / 2.0)
+    return numpy.unique(numpy.clip(numpy.round(exposures), Acquisition.MIN_EXPOSURE, Acquisition.MAX_EXPOSURE))
+
+def merge(intensities, exposures, darks=0.0, saturation=Acquisition.FULL_SCALE - 3, readNoise=READ_NOISE,
+          gain=GAIN, minSignal=None):
+    """Merge raw spectra taken at different exposures into counts per ms.
+
+    intensities is (exposures, channels), or (exposures, ..., channels) for several
+    spectra; darks broadcasts against it. A reading is used when it is below saturation
+    and at least minSignal (default three read noises) above its dark. Returns the
+    merged rate, its standard uncertainty, and the number of exposures used per channel.
+    Channels with no usable reading take the rate of the shortest exposure if all of
+    them saturated (a lower bound) and of the longest otherwise, with infinite
+    uncertainty."""
+    intensities = numpy.asarray(intensities, dtype=float)
+    exposures = numpy.asarray(exposures, dtype=float).reshape((-1,) + (1,) * (intensities.ndim - 1))
+    if len(exposures) != len(intensities):
+        raise ValueError("need one exposure per spectrum, got %d and %d" % (len(exposures), len(intensities)))
+    if minSignal is None: minSignal = 3 * readNoise
+    signal = intensities - darks
+    usable = (intensities < saturation) & (signal >= minSignal)
+    # shot noise of the signal, and read noise of both the lit and the dark frame
+    variance = 2 * readNoise**2 + gain * numpy.maximum(signal, 0)
+    rates = signal / exposures
+    weights = numpy.where(usable, exposures**2 / variance, 0.0)
+    total = weights.sum(axis=0)
+    used = usable.sum(axis=0)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        merged = (weights * rates).sum(axis=0) / total
+        uncertainty = 1 / numpy.sqrt(total)
+    saturated = numpy.all(intensities >= saturation, axis=0)
+    order = numpy.argsort(exposures.ravel())
+    fallback = numpy.where(saturated, rates[order[0]], rates[order[-1]])
+    merged = numpy.where(used > 0, merged, fallback)
+    return merged, uncertainty, used
+
+class DarkCache:
+    "Dark frames of a device by exposure, read when first needed and again once they are older than maxAge (s)"
+    def __init__(self, device, maxAge=600.0, reads=1):
+        self.device = device
+        self.maxAge = maxAge
+        self.reads = reads
+        self.frames = {}
+
+    def __repr__(self):
+        return "DarkCache(%s ms)" % ", ".join("%g" % e for e in sorted(self.frames))
+
+    def __contains__(self, exposure):
+        entry = self.frames.get(float(exposure))
+        return entry is not None and time.time() - entry[0] <= self.maxAge
+
+    def clear(self):
+        self.frames.clear()
+
+    def read(self, exposures):
+        "Read the dark frames that are missing or stale (with every lamp off)"
+        missing = [e for e in exposures if e not in self]
+        if not missing: return
+        for name in Acquisition.LAMPS:
+            if self.device.lamps[name]: self.device.lamp(name, False)
+        time.sleep(self.device.settle)
+        for exposure in missing:
+            self.device.setExposure(exposure)
+            dark = numpy.mean([self.device.readSpectrum() for i in range(self.reads)], axis=0)
+            self.frames[float(exposure)] = (time.time(), dark)
+
+    def __call__(self, exposures):
+        "Dark frames (exposures, channels) for a list of exposures"
+        self.read(exposures)
+        return numpy.array([self.frames[float(e)][1] for e in exposures])
+
+def acquire(device, lamp="led", exposures=None, darks=None, **options):
+    """Read a bracket of exposures with the lamp on and merge them; returns a frame like
+    Acquisition.Spectrophotometer.acquire() with rates (counts per ms, exposure 1 ms) in
+    place of counts, and the uncertainty and number of exposures used per channel.
+    The exposure set before is restored afterwards."""
+    previous = device.exposure
+    if exposures is None: exposures = bracket(previous if numpy.isfinite(previous) else 10)
+    # the firmware takes whole milliseconds
+    exposures = sorted(set(float(round(e)) for e in exposures))
+    if darks is None: darks = DarkCache(device)
+    darkFrames = darks(exposures)
+    timestamp = time.time()
+    raw = []
+    device.lamp(lamp, True)
+    try:
+        for exposure in exposures:
+            device.setExposure(exposure)
+            raw.append(device.readSpectrum())
+    finally:
+        device.lamp(lamp, False)
+    if numpy.isfinite(previous): device.setExposure(previous)
+    raw = numpy.array(raw)
+    options.setdefault("saturation", device.saturation)
+    rates, uncertainty, used = merge(raw, exposures, darkFrames, **options)
+    return dict(intensities=rates, corrected=numpy.maximum(rates, 0.001 / max(exposures)),
+                uncertainty=uncertainty, used=used, raw=raw, darks=darkFrames, exposures=numpy.array(exposures),
+                wavelengths=device.calibration.wavelengths, exposure=1.0, timestamp=timestamp, lamp=lamp,
+                saturated=int(numpy.count_nonzero(numpy.all(raw >= options["saturation"], axis=0))))
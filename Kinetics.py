@@ -0,0 +1,163 @@
+"""
+Fluorescence kinetics: emission spectra streamed at a fixed cadence with the UV lamp on,
+and decay (bleaching) rates fitted for every channel at once.
+
+    store = Kinetics.record(device, "cyan bleaching.spec", duration=600, interval=2)
+    times, intensities, wavelengths = Kinetics.load("cyan bleaching.spec")
+    fit = Kinetics.fitDecay(times, intensities)
+    fit.rates, fit.halfLives, fit.amplitudes, fit.baselines
+
+Frames go to the spectrum file in blocks of a fixed size as float32 rows of a
+time x channel table, so an hour long run needs no more memory than a few seconds of it,
+and reading it back is a memory map.
+"""
+
+import time
+
+import numpy
+
+import Storage
+
+MODE = "kinetics"
+
+def record(device, filename, duration, interval=1.0, lamp="uv", sample="", chunk=64, pipeline=None, log=print):
+    """Read dark corrected spectra every interval seconds for duration seconds with the
+    lamp on, appending them to filename; the dark frame is read first and stored too.
+    A pipeline (a live view, say) is given every frame as it comes in. An interval shorter
+    than a read at the device's exposure is logged, and the frames then come as fast as
+    they can be read."""
+    if log and interval < device.readTime():
+        log("a read takes %g s at the %g ms exposure, longer than the %g s interval"
+            % (device.readTime(), device.exposure, interval))
+    store = Storage.SpectrumFile(filename, device.calibration.wavelengths, dtype="f4")
+    metadata = dict(sample=sample, device=str(device.port))
+    device.lamp(lamp, False)
+    time.sleep(device.settle)
+    dark = device.readSpectrum()
+    # 0.5 // 0.01 is 49.0 in floating point: a little slack keeps the last frame
+    frames = int(duration / interval + 1e-9) + 1
+    late = 0
+    with Storage.ChunkedWriter(store, chunk) as writer:
+        writer.append(dark, mode="dark", exposure=device.exposure, **metadata)
+        device.lamp(lamp, True)
+        try:
+            start = time.time()
+            for i in range(frames):
+                # frames are scheduled from the start, so that the cadence does not drift
+                wait = start + i * interval - time.time()
+                if wait > 0: time.sleep(wait)
+                else: late += 1
+                timestamp = time.time()
+                intensities = device.readSpectrum()
+                writer.append(intensities - dark, mode=MODE, timestamp=timestamp, exposure=device.exposure,
+                              **metadata)
+                if pipeline is not None:
+                    pipeline.push(intensities, dark=dark, exposure=device.exposure)
+                if log and (i + 1) % chunk == 0:
+                    log("%d/%d frames" % (i + 1, frames))
+        finally:
+            device.lamp(lamp, False)
+    if log and late > 1:
+        log("%d frames were late: a read takes longer than the %g s interval" % (late, interval))
+    return store
+
+def load(filename):
+    "Times (s from the first frame), intensities (frames, channels) and wavelengths of a kinetics run"
+    store = Storage.SpectrumFile(filename)
+    frames = store.frames()
+    rows = numpy.flatnonzero(frames["mode"] == MODE.encode("ascii"))
+    if not len(rows):
+        raise ValueError("%s holds no kinetics frames" % filename)
+    if rows[-1] - rows[0] == len(rows) - 1:
+        # contiguous, as written by record(): stays memory mapped
+        frames = frames[rows[0]:rows[-1] + 1]
+    else:
+        frames = frames[rows]
+    times = frames["timestamp"] - frames["timestamp"][0]
+    return times, frames["intensities"], store.wavelengths
+
+class DecayFit:
+    "Per channel exponential decays signal = baseline + amplitude * exp(-rate * (t - t0))"
+    def __init__(self, rates, rateStderr, amplitudes, baselines, residualStd, t0):
+        self.rates = rates
+        self.rateStderr = rateStderr
+        self.amplitudes = amplitudes
+        self.baselines = baselines
+        self.residualStd = residualStd
+        self.t0 = t0
+        with numpy.errstate(divide="ignore"):
+            self.halfLives = numpy.log(2) / rates
+
+    def __repr__(self):
+        return "DecayFit(%d channels)" % len(self.rates)
+
+    def __call__(self, times):
+        "Predicted signal (times, channels)"
+        times = numpy.asarray(times, dtype=float)[..., numpy.newaxis]
+        return self.baselines + self.amplitudes * numpy.exp(-self.rates * (times - self.t0))
+
+def _sums(decays, y, baseline, perChannel=False):
+    """Least squares amplitudes, baselines and residual sums of squares: for every row of
+    decays against every channel, or (perChannel) for row i against channel i"""
+    n = len(y)
+    sy = y.sum(axis=0)
+    syy = numpy.einsum("ij,ij->j", y, y)
+    se = decays.sum(axis=1)
+    see = numpy.einsum("ij,ij->i", decays, decays)
+    if perChannel:
+        sey = numpy.einsum("ji,ij->j", decays, y)
+    else:
+        sey = decays.dot(y)
+        se = se[:, numpy.newaxis]
+        see = see[:, numpy.newaxis]
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        if baseline:
+            sxx = see - se**2 / n
+            sxy = sey - se * sy / n
+            amplitudes = sxy / sxx
+            baselines = (sy - amplitudes * se) / n
+            ssres = syy - sy**2 / n - amplitudes * sxy
+        else:
+            amplitudes = sey / see
+            baselines = numpy.zeros_like(amplitudes)
+            ssres = syy - amplitudes * sey
+    return amplitudes, baselines, numpy.maximum(ssres, 0.0)
+
+def fitDecay(times, data, baseline=True, rates=None):
+    """Fit an exponential decay to data[:, i] against times for every channel i.
+
+    For a given rate the model is linear in the amplitude and baseline, which are then
+    solved in closed form; every rate of a logarithmic grid (by default from a tenth of
+    the inverse run length to the inverse frame spacing) is tried for all channels with
+    one matrix product, and each channel's best rate is refined by a parabola through
+    its neighbours. The rate's standard error follows from the curvature there."""
+    t = numpy.asarray(times, dtype=float)
+    y = numpy.asarray(data, dtype=float)
+    if y.ndim != 2 or len(t) != len(y):
+        raise ValueError("need one time per spectrum, got %d and %s" % (len(t), y.shape))
+    t0 = t[0]
+    t = t - t0
+    if rates is None:
+        span = t[-1] - t[0]
+        if not span > 0:
+            raise ValueError("need spectra at more than one time")
+        rates = numpy.logspace(numpy.log10(0.1 / span), numpy.log10(len(t) / span), 200)
+    rates = numpy.asarray(rates, dtype=float)
+    step = numpy.log(rates[1] / rates[0])
+    amplitudes, baselines, ssres = _sums(numpy.exp(-numpy.outer(rates, t)), y, baseline)
+    best = numpy.argmin(numpy.where(numpy.isfinite(ssres), ssres, numpy.inf), axis=0)
+    inner = numpy.clip(best, 1, len(rates) - 2)
+    channels = numpy.arange(y.shape[1])
+    below, at, above = ssres[inner - 1, channels], ssres[inner, channels], ssres[inner + 1, channels]
+    curvature = below - 2 * at + above
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        shift = numpy.where((best == inner) & (curvature > 0), 0.5 * (below - above) / curvature, 0.0)
+    fitted = rates[best] * numpy.exp(numpy.clip(shift, -1, 1) * step)
+    amplitudes, baselines, ssres = _sums(numpy.exp(-numpy.outer(fitted, t)), y, baseline, perChannel=True)
+    dof = max(len(t) - (3 if baseline else 2), 1)
+    variance = ssres / dof
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        # d2(ssres)/d(rate)2 from the parabola in log(rate); the estimate is 2 variance / curvature
+        rateStderr = fitted * step * numpy.sqrt(2 * variance / curvature)
+    rateStderr[(best != inner) | ~(curvature > 0)] = numpy.inf
+    return DecayFit(fitted, rateStderr, amplitudes, baselines, numpy.sqrt(variance), t0)
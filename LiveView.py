@@ -0,0 +1,123 @@
+"""
+A live view of the spectra being acquired, updated in place without blocking.
+
+The figure is drawn once; afterwards only the line data are redrawn over a cached
+background (blitting), which keeps up with the acquisition frame rate. The view is a
+pipeline stage, so it shows whatever the earlier stages computed:
+
+    view = LiveView.LiveView(wavelengths)
+    pipeline = Pipeline.Pipeline(Pipeline.DarkSubtraction(dark), Pipeline.Absorbance(reference), view)
+    pipeline.push(intensities)       # returns immediately, the window stays open
+"""
+
+import time
+
+import numpy
+
+import Pipeline
+
+TRACES = (("intensities", "raw", "0.6"), ("corrected", "dark corrected", "C0"), ("absorbance", "absorbance", "C3"))
+
+class LiveView(Pipeline.Stage):
+    "Persistent figure with raw, dark corrected and absorbance traces"
+    def __init__(self, wavelengths, maxFps=60.0, title="Spectrophotometer"):
+        from matplotlib import pyplot
+        self.pyplot = pyplot
+        self.wavelengths = numpy.asarray(wavelengths)
+        self.minInterval = 1.0 / maxFps if maxFps else 0.0
+        self.lastDraw = 0.0
+        self.frames = 0
+        pyplot.ion()
+        self.figure, (self.countAxes, self.absorbanceAxes) = pyplot.subplots(2, 1, sharex=True)
+        if self.figure.canvas.manager:
+            self.figure.canvas.manager.set_window_title(title)
+        self.lines = {}
+        for key, label, color in TRACES:
+            axes = self.absorbanceAxes if key == "absorbance" else self.countAxes
+            line, = axes.plot(self.wavelengths, numpy.full(len(self.wavelengths), numpy.nan),
+                              color=color, label=label, animated=True)
+            self.lines[key] = line
+        self.countAxes.set_ylabel("counts")
+        self.countAxes.set_ylim(0, 1100)
+        self.countAxes.legend(loc="upper right")
+        self.absorbanceAxes.set_ylabel("absorbance")
+        self.absorbanceAxes.set_xlabel("wavelength (nm)")
+        self.absorbanceAxes.set_ylim(-0.1, 1.0)
+        self.absorbanceAxes.set_xlim(self.wavelengths.min(), self.wavelengths.max())
+        self.status = self.countAxes.text(0.01, 0.95, "", transform=self.countAxes.transAxes,
+                                          va="top", animated=True)
+        self.background = None
+        self.figure.canvas.mpl_connect("draw_event", self._captureBackground)
+        pyplot.show(block=False)
+        self.redraw()
+
+    def _captureBackground(self, event=None):
+        self.background = self.figure.canvas.copy_from_bbox(self.figure.bbox)
+        self._drawArtists()
+
+    def _drawArtists(self):
+        for line in self.lines.values():
+            self.figure.draw_artist(line)
+        self.figure.draw_artist(self.status)
+
+    def redraw(self):
+        "Full redraw, needed after the axis limits change"
+        self.figure.canvas.draw()
+        self.figure.canvas.flush_events()
+
+    def _rescale(self, axes, traces, margin=0.5):
+        """Grow (or shrink a lot) the y range to fit all the traces drawn on axes at once,
+        so that traces of different ranges do not move the limits back and forth; returns
+        True if the limits changed"""
+        ranges = [(numpy.nanmin(data), numpy.nanmax(data)) for data in traces if numpy.isfinite(data).any()]
+        if not ranges: return False
+        lo, hi = min(r[0] for r in ranges), max(r[1] for r in ranges)
+        low, high = axes.get_ylim()
+        span = max(hi - lo, 1e-6)
+        if lo < low or hi > high or (high - low) > 10 * span:
+            axes.set_ylim(lo - margin * span, hi + margin * span)
+            return True
+        return False
+
+    def process(self, frame):
+        now = time.perf_counter()
+        if now - self.lastDraw < self.minInterval:
+            return frame
+        self.lastDraw = now
+        self.frames += 1
+        traces = {self.countAxes: [], self.absorbanceAxes: []}
+        for key, line in self.lines.items():
+            data = frame.get(key)
+            if data is None or numpy.ndim(data) != 1: continue
+            line.set_ydata(data)
+            traces[self.absorbanceAxes if key == "absorbance" else self.countAxes].append(data)
+        rescaled = False
+        for axes, data in traces.items():
+            rescaled |= self._rescale(axes, data)
+        text = []
+        if "concentration" in frame:
+            text.append("concentration %.3g +- %.2g" % (frame["concentration"], frame.get("uncertainty", numpy.nan)))
+        if "exposure" in frame:
+            text.append("exposure %g ms" % frame["exposure"])
+        if frame.get("saturated"):
+            text.append("%d channels saturated" % frame["saturated"])
+        self.status.set_text("   ".join(text))
+        canvas = self.figure.canvas
+        if rescaled or self.background is None:
+            self.redraw()
+        else:
+            canvas.restore_region(self.background)
+            self._drawArtists()
+            canvas.blit(self.figure.bbox)
+            canvas.flush_events()
+        return frame
+
+    def update(self, **frame):
+        "Show a frame given as keyword arguments (intensities=..., absorbance=...)"
+        return self.process(frame)
+
+    def isOpen(self):
+        return self.pyplot.fignum_exists(self.figure.number)
+
+    def close(self):
+        self.pyplot.close(self.figure)
@@ -0,0 +1,163 @@
+"""
+Processing of live spectra, frame by frame, as they come off the spectrometer.
+
+A Pipeline passes every frame (a dictionary holding at least "intensities") through a
+chain of stages. Each stage writes its results into buffers it allocated for the first
+frame and reuses afterwards, so steady state processing allocates no new arrays; a
+consumer that keeps results beyond the next frame must copy them.
+
+    pipeline = Pipeline.Pipeline(
+        Pipeline.DarkSubtraction(dark),
+        Pipeline.Absorbance(reference),
+        Pipeline.Concentration(Pipeline.ConcentrationModel.load("cyan.npz")))
+    frame = pipeline.push(intensities)
+    frame["concentration"], frame["uncertainty"]
+
+The stages work on a single spectrum or on a (N, channels) stack alike.
+"""
+
+import numpy
+
+import Analysis
+
+class Stage:
+    "A step applied to every frame"
+    def process(self, frame):
+        return frame
+
+    def buffer(self, name, like):
+        "A reusable output array with the shape of like"
+        existing = getattr(self, name, None)
+        if existing is None or existing.shape != numpy.shape(like):
+            existing = numpy.empty(numpy.shape(like))
+            setattr(self, name, existing)
+        return existing
+
+class DarkSubtraction(Stage):
+    "intensities - dark, clipped to the sensor range; a frame's own 'dark' entry takes precedence"
+    def __init__(self, dark=None, floor=0.001, ceiling=1024):
+        self.dark = dark
+        self.floor = floor
+        self.ceiling = ceiling
+
+    def process(self, frame):
+        intensities = frame["intensities"]
+        corrected = self.buffer("_corrected", intensities)
+        dark = frame.get("dark", self.dark)
+        if dark is None:
+            corrected[...] = intensities
+        else:
+            numpy.subtract(intensities, dark, out=corrected)
+        numpy.clip(corrected, self.floor, self.ceiling, out=corrected)
+        frame["corrected"] = corrected
+        return frame
+
+class Absorbance(Stage):
+    "log10(reference/corrected) of the dark corrected spectrum"
+    def __init__(self, reference, floor=0.001):
+        self.floor = floor
+        self.setReference(reference)
+
+    def setReference(self, reference):
+        self.reference = numpy.maximum(numpy.asarray(reference, dtype=float), self.floor)
+
+    def process(self, frame):
+        corrected = frame.get("corrected", frame["intensities"])
+        absorbance = self.buffer("_absorbance", corrected)
+        numpy.maximum(corrected, self.floor, out=absorbance)
+        numpy.divide(self.reference, absorbance, out=absorbance)
+        numpy.log10(absorbance, out=absorbance)
+        frame["absorbance"] = absorbance
+        return frame
+
+class ConcentrationModel:
+    "Per channel calibration lines absorbance = intercept + slope * concentration"
+    def __init__(self, slopes, intercepts, residualStd, channels=None):
+        self.slopes = numpy.asarray(slopes, dtype=float)
+        self.intercepts = numpy.asarray(intercepts, dtype=float)
+        self.residualStd = numpy.asarray(residualStd, dtype=float)
+        usable = numpy.isfinite(self.slopes) & numpy.isfinite(self.intercepts) \
+            & numpy.isfinite(self.residualStd) & (self.residualStd > 0)
+        if channels is not None:
+            selected = numpy.zeros(len(self.slopes), dtype=bool)
+            selected[channels] = True
+            usable &= selected
+        # unusable channels get zero weight instead of being indexed out, so that
+        # processing a frame needs no fancy indexing (and no temporary arrays)
+        self.weights = numpy.where(usable, 1.0 / numpy.where(usable, self.residualStd, 1.0)**2, 0.0)
+        self.slopes = numpy.where(usable, self.slopes, 0.0)
+        self.intercepts = numpy.where(usable, self.intercepts, 0.0)
+        self.weightedSlopes = self.weights * self.slopes
+        self.information = numpy.dot(self.weightedSlopes, self.slopes)
+        if not self.information > 0:
+            raise ValueError("calibration has no usable channels")
+        self.channels = int(usable.sum())
+
+    def __repr__(self):
+        return "ConcentrationModel(%d usable channels)" % self.channels
+
+    @classmethod
+    def fromFit(cls, fit, channels=None):
+        "Model from an Analysis.LineFit of absorbance against concentration"
+        return cls(fit.slopes, fit.intercepts, fit.residualStd, channels)
+
+    @classmethod
+    def fromSeries(cls, concentrations, absorbances, channels=None, **options):
+        return cls.fromFit(Analysis.fitLines(concentrations, absorbances, **options), channels)
+
+    def save(self, filename):
+        numpy.savez(filename, slopes=self.slopes, intercepts=self.intercepts,
+                    residualStd=numpy.where(self.weights > 0, self.residualStd, numpy.nan))
+
+    @classmethod
+    def load(cls, filename):
+        data = numpy.load(filename)
+        return cls(data["slopes"], data["intercepts"], data["residualStd"])
+
+class Concentration(Stage):
+    """Weighted least squares concentration over all usable channels, with its standard
+    uncertainty scaled up by the frame's reduced chi squared when that exceeds one"""
+    def __init__(self, model):
+        self.model = model
+
+    def process(self, frame):
+        model = self.model
+        absorbance = frame["absorbance"]
+        residual = self.buffer("_residual", absorbance)
+        fitted = self.buffer("_fitted", absorbance)
+        # one value per spectrum: 0-d for a single frame
+        concentration = self.buffer("_concentration", absorbance[..., 0])
+        uncertainty = self.buffer("_uncertainty", absorbance[..., 0])
+        numpy.subtract(absorbance, model.intercepts, out=residual)
+        numpy.dot(residual, model.weightedSlopes, out=concentration)
+        concentration /= model.information
+        numpy.multiply(concentration[..., numpy.newaxis], model.slopes, out=fitted)
+        numpy.subtract(residual, fitted, out=residual)
+        numpy.multiply(residual, residual, out=residual)
+        # reduced chi squared, then the uncertainty
+        numpy.dot(residual, model.weights, out=uncertainty)
+        uncertainty /= max(model.channels - 1, 1)
+        numpy.maximum(uncertainty, 1.0, out=uncertainty)
+        uncertainty /= model.information
+        numpy.sqrt(uncertainty, out=uncertainty)
+        frame["concentration"] = concentration
+        frame["uncertainty"] = uncertainty
+        return frame
+
+class Pipeline:
+    "A chain of stages applied to each frame"
+    def __init__(self, *stages):
+        self.stages = list(stages)
+
+    def __repr__(self):
+        return "Pipeline(%s)" % ", ".join(type(s).__name__ for s in self.stages)
+
+    def append(self, stage):
+        self.stages.append(stage)
+
+    def push(self, intensities, **frame):
+        "Process one frame (or a stack of frames), returning the frame dictionary"
+        frame["intensities"] = intensities
+        for stage in self.stages:
+            frame = stage.process(frame)
+        return frame
@@ -0,0 +1,233 @@
+"""
+Preprocessing of spectra: smoothing, baseline removal, resampling and derivatives.
+
+Every operator takes a single spectrum or a (N, channels) stack and handles the whole
+stack in one call, so the same code serves the live stream and the archive:
+
+    entries, wavelengths, intensities = Dataset.Dataset("experimentation overall").spectra(dye="cyan")
+    grid = Preprocessing.commonGrid(wavelengths)
+    spectra = Preprocessing.resample(intensities, wavelengths, grid)
+    spectra = Preprocessing.savitzkyGolay(spectra, window=9)
+    spectra -= Preprocessing.alsBaseline(spectra)
+
+The stage classes wrap the operators for a Pipeline; each reads one entry of the frame
+and writes its result to the same or another entry:
+
+    pipeline = Pipeline.Pipeline(Pipeline.DarkSubtraction(dark), Preprocessing.Smooth(window=9),
+                                 Preprocessing.RemoveBaseline(), Pipeline.Absorbance(reference))
+"""
+
+import numpy
+
+import Pipeline
+
+def _stack(spectra):
+    spectra = numpy.asarray(spectra, dtype=float)
+    return numpy.atleast_2d(spectra), spectra.ndim == 1
+
+def _unstack(result, single):
+    return result[0] if single else result
+
+def savitzkyGolayCoefficients(window, order, derivative=0, delta=1.0):
+    """(window, window) matrix whose row i gives the value (or derivative) at point i of
+    the polynomial of the given order fitted to a window of points"""
+    if window % 2 == 0 or window <= order:
+        raise ValueError("the window must be odd and longer than the polynomial order")
+    x = numpy.arange(window) - window // 2
+    vandermonde = numpy.vander(x, order + 1, increasing=True)
+    fit = numpy.linalg.pinv(vandermonde)
+    # derivative of the fitted polynomial, evaluated at every point of the window
+    powers = numpy.arange(order + 1)
+    factors = numpy.ones(order + 1)
+    for k in range(derivative):
+        factors *= numpy.maximum(powers - k, 0)
+    evaluate = numpy.zeros((window, order + 1))
+    usable = powers >= derivative
+    evaluate[:, usable] = factors[usable] * x[:, numpy.newaxis]**(powers[usable] - derivative)
+    return evaluate.dot(fit) / delta**derivative
+
+def savitzkyGolay(spectra, window=7, order=2, derivative=0, delta=1.0):
+    """Savitzky-Golay smoothing (or derivative, with the channel spacing delta) along the
+    channels; the first and last half windows are taken from the fits of the end windows"""
+    y, single = _stack(spectra)
+    if y.shape[1] < window:
+        raise ValueError("need at least %d channels, got %d" % (window, y.shape[1]))
+    coefficients = savitzkyGolayCoefficients(window, order, derivative, delta)
+    half = window // 2
+    result = numpy.empty_like(y)
+    windows = numpy.lib.stride_tricks.sliding_window_view(y, window, axis=1)
+    result[:, half:len(y[0]) - half] = windows.dot(coefficients[half])
+    result[:, :half] = y[:, :window].dot(coefficients[:half].T)
+    result[:, len(y[0]) - half:] = y[:, -window:].dot(coefficients[half + 1:].T)
+    return _unstack(result, single)
+
+def derivative(spectra, order=1, window=7, polyorder=None, spacing=1.0):
+    """Smoothed derivative spectra; spacing is the (uniform) distance between channels,
+    so resample onto a regular wavelength grid first for derivatives per nm"""
+    if polyorder is None: polyorder = order + 1
+    return savitzkyGolay(spectra, window, polyorder, order, spacing)
+
+def polynomialBaseline(spectra, x=None, degree=3, iterations=20, tolerance=1e-6):
+    """Baseline under the peaks by repeated polynomial fits, each to the spectrum clipped
+    from above by the previous fit (the modified polyfit method); x defaults to channels"""
+    y, single = _stack(spectra)
+    x = numpy.arange(y.shape[1], dtype=float) if x is None else numpy.asarray(x, dtype=float)
+    # scaled to -1..1 for a well conditioned Vandermonde matrix
+    u = (x - x.min()) / max(x.max() - x.min(), 1e-12) * 2 - 1
+    vandermonde = numpy.vander(u, degree + 1)
+    projection = vandermonde.dot(numpy.linalg.pinv(vandermonde))
+    target = y.copy()
+    baseline = target.dot(projection.T)
+    for iteration in range(iterations):
+        numpy.minimum(target, baseline, out=target)
+        previous = baseline
+        baseline = target.dot(projection.T)
+        change = numpy.abs(baseline - previous).max()
+        if change <= tolerance * max(numpy.abs(baseline).max(), 1e-12):
+            break
+    return _unstack(baseline, single)
+
+def _secondDifferences(channels):
+    "The three upper diagonals of D'D for the second difference matrix D"
+    d = numpy.diff(numpy.eye(channels), 2, axis=0)
+    dtd = d.T.dot(d)
+    return numpy.diagonal(dtd).copy(), numpy.diagonal(dtd, 1).copy(), numpy.diagonal(dtd, 2).copy()
+
+def _solvePentadiagonal(diagonal, first, second, b):
+    """Solve A x = b for a stack of symmetric positive definite pentadiagonal matrices,
+    by a banded Cholesky factorisation running along the channels for all rows at once.
+    diagonal and b are (N, channels); first and second are the off diagonals (shared)."""
+    n, m = b.shape
+    l0 = numpy.empty((n, m))
+    l1 = numpy.zeros((n, m))
+    l2 = numpy.zeros((n, m))
+    z = numpy.empty((n, m))
+    for i in range(m):
+        d = diagonal[:, i].copy()
+        r = b[:, i].copy()
+        if i >= 2:
+            l2[:, i] = second[i - 2] / l0[:, i - 2]
+            d -= l2[:, i]**2
+            r -= l2[:, i] * z[:, i - 2]
+        if i >= 1:
+            c = first[i - 1] - (l2[:, i] * l1[:, i - 1] if i >= 2 else 0)
+            l1[:, i] = c / l0[:, i - 1]
+            d -= l1[:, i]**2
+            r -= l1[:, i] * z[:, i - 1]
+        l0[:, i] = numpy.sqrt(d)
+        z[:, i] = r / l0[:, i]
+    x = numpy.empty((n, m))
+    for i in range(m - 1, -1, -1):
+        r = z[:, i].copy()
+        if i + 1 < m: r -= l1[:, i + 1] * x[:, i + 1]
+        if i + 2 < m: r -= l2[:, i + 2] * x[:, i + 2]
+        x[:, i] = r / l0[:, i]
+    return x
+
+def alsBaseline(spectra, smoothness=1e5, asymmetry=0.01, iterations=10):
+    """Asymmetric least squares baseline (Eilers and Boelens): a smooth curve that points
+    above it (peaks) pull on with weight asymmetry and points below with 1 - asymmetry.
+    Each iteration solves the banded smoother for every spectrum of the stack at once."""
+    y, single = _stack(spectra)
+    diagonal, first, second = _secondDifferences(y.shape[1])
+    first = smoothness * first
+    second = smoothness * second
+    weights = numpy.ones_like(y)
+    for iteration in range(iterations):
+        baseline = _solvePentadiagonal(weights + smoothness * diagonal, first, second, weights * y)
+        updated = numpy.where(y > baseline, asymmetry, 1 - asymmetry)
+        if numpy.array_equal(updated, weights): break
+        weights = updated
+    return _unstack(baseline, single)
+
+def commonGrid(wavelengths, step=None):
+    """A regular grid over the wavelength range that all axes of a (N, channels) stack
+    cover, spaced by step (default the median channel spacing)"""
+    axes = numpy.atleast_2d(numpy.asarray(wavelengths, dtype=float))
+    start = axes.min(axis=1).max()
+    stop = axes.max(axis=1).min()
+    if step is None: step = numpy.median(numpy.abs(numpy.diff(axes, axis=1)))
+    return start + step * numpy.arange(int(numpy.floor((stop - start) / step + 1e-9)) + 1)
+
+def resample(spectra, wavelengths, grid):
+    """Linear interpolation of spectra onto grid. wavelengths is one increasing axis shared
+    by all spectra, or one per spectrum (N, channels); points outside an axis are nan."""
+    y, single = _stack(spectra)
+    axes = numpy.asarray(wavelengths, dtype=float)
+    grid = numpy.asarray(grid, dtype=float)
+    if axes.ndim == 1:
+        index = numpy.clip(numpy.searchsorted(axes, grid) - 1, 0, len(axes) - 2)
+        fraction = (grid - axes[index]) / (axes[index + 1] - axes[index])
+        result = y[:, index] * (1 - fraction) + y[:, index + 1] * fraction
+        outside = (grid < axes[0]) | (grid > axes[-1])
+        result[:, outside] = numpy.nan
+        return _unstack(result, single)
+    axes = numpy.broadcast_to(axes, y.shape)
+    # the axes are offset row by row so that one sorted search serves the whole stack
+    span = max(axes.max(), grid.max()) - min(axes.min(), grid.min()) + 1
+    offsets = span * numpy.arange(len(y))[:, numpy.newaxis]
+    flat = (axes + offsets).ravel()
+    rows = numpy.arange(len(y))[:, numpy.newaxis]
+    index = numpy.searchsorted(flat, (grid + offsets).ravel()).reshape(len(y), -1) - 1 - rows * y.shape[1]
+    index = numpy.clip(index, 0, y.shape[1] - 2)
+    low = numpy.take_along_axis(axes, index, 1)
+    high = numpy.take_along_axis(axes, index + 1, 1)
+    fraction = (grid - low) / (high - low)
+    result = numpy.take_along_axis(y, index, 1) * (1 - fraction) + numpy.take_along_axis(y, index + 1, 1) * fraction
+    result[(grid < axes[:, :1]) | (grid > axes[:, -1:])] = numpy.nan
+    return _unstack(result, single)
+
+class Operator(Pipeline.Stage):
+    "Applies an operator to the frame entry source and stores the result as target"
+    def __init__(self, source="corrected", target=None):
+        self.source = source
+        self.target = target or source
+
+    def apply(self, spectra):
+        return spectra
+
+    def process(self, frame):
+        frame[self.target] = self.apply(frame.get(self.source, frame["intensities"]))
+        return frame
+
+class Smooth(Operator):
+    "Savitzky-Golay smoothing"
+    def __init__(self, window=7, order=2, **entries):
+        Operator.__init__(self, **entries)
+        self.window = window
+        self.order = order
+
+    def apply(self, spectra):
+        return savitzkyGolay(spectra, self.window, self.order)
+
+class Derivative(Operator):
+    "Savitzky-Golay derivative, by default into the entry 'derivative'"
+    def __init__(self, order=1, window=7, polyorder=None, spacing=1.0, source="corrected", target="derivative"):
+        Operator.__init__(self, source, target)
+        self.order = order
+        self.window = window
+        self.polyorder = polyorder
+        self.spacing = spacing
+
+    def apply(self, spectra):
+        return derivative(spectra, self.order, self.window, self.polyorder, self.spacing)
+
+class RemoveBaseline(Operator):
+    "Subtracts an asymmetric least squares ('als') or polynomial ('polynomial') baseline"
+    def __init__(self, method="als", source="corrected", target=None, **options):
+        Operator.__init__(self, source, target)
+        self.baseline = dict(als=alsBaseline, polynomial=polynomialBaseline)[method]
+        self.options = options
+
+    def apply(self, spectra):
+        return spectra - self.baseline(spectra, **self.options)
+
+class Resample(Operator):
+    "Interpolation from the axis wavelengths onto grid"
+    def __init__(self, wavelengths, grid, **entries):
+        Operator.__init__(self, **entries)
+        self.wavelengths = wavelengths
+        self.grid = grid
+
+    def apply(self, spectra):
+        return resample(spectra, self.wavelengths, self.grid)
@@ -1,125 +1,182 @@
-import scipy
-import matplotlib
-from matplotlib import pyplot
-import serial
+import numpy
+import Acquisition
+import HighDynamicRange
+import Kinetics
+import LiveView
+import Pipeline
+import Storage
 import time
-    
-def pixelNumberToWavelength(pixelnumber):
-    a = 379.092
-    b = 1.00553
-    c = -0.00786286
-    d = 4.69722e-5
-    x = pixelnumber
-    wavelength = d*x**3 + c*x**2 + b*x + a
-    return wavelength
-
-def readSpectrum(arduino):
-    arduino.write(b"R")
-    arduino.flush()
-    time.sleep(1)
-    print(arduino.readline().decode())
-    data = []
-    for channel in range(256):
-        response = arduino.readline().decode().split(",")
-        #print(response)
-        if channel != int(response[0]):
-            print("warning - channel numbers do not match")
-        value = float(response[1])
-        data.append(value)
-    channels = [i for i in range(len(data))]
-    wavelengths = [pixelNumberToWavelength(x) for x in channels]
-    wavelengths = scipy.array(wavelengths)
-    data = scipy.array(data)
-    return channels, wavelengths, data
-
-def saveSpectrum(channels, wavelengths, intensities):
-    filename = input("Enter the filename to save to:")
-    with open(filename, "w") as fd:
-        for i in range(len(channels)):
-            fd.write("%d,%f,%f\n"%(channels[i], wavelengths[i], intensities[i]))
-        print("successfully saved the file")
+
+EXPOSURES = Acquisition.PRESETS
+
+def readSpectrum(device):
+    data = device.readSpectrum()
+    print("Exposure: %g" % device.exposure)
+    return device.calibration.channels, device.calibration.wavelengths, data
+
+def saveSpectrum(channels, wavelengths, intensities, mode="", exposure=numpy.nan):
+    filename = input("Enter the filename to save to (.csv for a single spectrum):")
+    if filename.lower().endswith(".csv"):
+        Storage.writeCSV(filename, channels, wavelengths, intensities)
+    else:
+        if not filename.lower().endswith(".spec"): filename += ".spec"
+        sample = input("Enter the sample name:")
+        store = Storage.SpectrumFile(filename, wavelengths)
+        store.append(intensities, mode=mode, exposure=exposure, sample=sample, device=device.port)
+    print("successfully saved the file")
+
+def sendCommand(command, lamp):
+    "Exposure letters, automatic (T) or given (T250) exposure and lamp switches typed in the menus"
+    if command == "T":
+        print("exposure set to %g ms" % device.autoExposure(lamp, log=print))
+    elif command.startswith("T"):
+        device.setExposure(float(command[1:]))
+    elif command in EXPOSURES:
+        device.setExposure(command)
+    else:
+        for name, (on, off) in Acquisition.LAMPS.items():
+            if command in (on, off): device.lamp(name, command == on)
+
+view = None
+
+def liveView(wavelengths):
+    "The live view window, opened again if it was closed"
+    global view
+    if view is None or not view.isOpen():
+        view = LiveView.LiveView(wavelengths)
+    return view
+
+def liveSpectrum(lamp, reference=None):
+    "Stream spectra into the live view until Ctrl-C; the dark frame is read once at the start"
+    device.lamp(lamp, False)
+    time.sleep(device.settle)
+    channels, wavelengths, dark = readSpectrum(device)
+    stages = [Pipeline.DarkSubtraction(dark)]
+    if reference is not None: stages.append(Pipeline.Absorbance(reference))
+    stages.append(liveView(wavelengths))
+    pipeline = Pipeline.Pipeline(*stages)
+    device.lamp(lamp, True)
+    print("live view - press Ctrl-C to stop")
+    try:
+        while True:
+            channels, wavelengths, intensities = readSpectrum(device)
+            pipeline.push(intensities, exposure=device.exposure)
+    except KeyboardInterrupt:
+        pass
+    device.lamp(lamp, False)
 
 def absorptionMenu():
     referenceSpectrum = None
+    exposure = numpy.nan
     while True:
         print("STEP 1: Ensure that sample has been put in the correct position for testing")
         print("STEP 2: LED Lamp on = Y, LED Lamp off = X")
-        print("STEP 3: Set exposure: A = 1ms, B = 5ms, C = 10ms, D = 15ms, E = 20ms")
-        print("STEP 4: Read spectrum: R")
+        print("STEP 3: Set exposure: A = 1ms, B = 10ms, C = 30ms, D = 500ms, E = 700ms, automatic = T, in ms = T<ms>")
+        print("STEP 4: Read spectrum: R, high dynamic range (bracket around the exposure): h")
         print("STEP 5: Save previous spectrum: S")
         print("STEP 6: Save spectrum as reference: r")
         print("STEP ?: Display absorbtion spectrum: a")
+        print("Live view (Ctrl-C to stop): L")
         print("QUIT = Q")
         command = input("Your choice:")
-        if command in "ABCDEXY":
-            arduino.write(command.encode("ascii"))
+        if command and (command in "ABCDEXY" or command.startswith("T")):
+            sendCommand(command, "led")
         elif command == "Q" : return
-        elif command == "R":
-            arduino.write("Y".encode("ascii")) # lamp on
-            channels, wavelengths, intensities = readSpectrum(arduino) 
-            arduino.write("X".encode("ascii")) # lamp off
-            import time
-            time.sleep(2)
-            channels, wavelengths, background = readSpectrum(arduino)
-            intensities -= background
-            intensities = scipy.clip(intensities, 0.001, 1024)
-            wavelengths  = scipy.clip(wavelengths, 300, 900) #visible wavelength range
-            pyplot.plot(wavelengths, intensities)
-            pyplot.show(block=True)
+        elif command in ("R", "h"):
+            if command == "R": frame = device.acquire("led")
+            else: frame = HighDynamicRange.acquire(device, "led", darks=darks)
+            channels, wavelengths = device.calibration.channels, frame["wavelengths"]
+            raw, intensities, exposure = frame["intensities"], frame["corrected"], frame["exposure"]
+            wavelengths  = numpy.clip(wavelengths, 300, 900) #visible wavelength range
+            liveView(wavelengths).update(intensities=raw, corrected=intensities, exposure=exposure,
+                                         saturated=frame["saturated"])
         elif command == "S":
-            saveSpectrum(channels, wavelengths, intensities)
+            saveSpectrum(channels, wavelengths, intensities, "absorbance", exposure)
         elif command == "r":
             referenceSpectrum = intensities
         elif command == "a":
-            absorption = scipy.log10(referenceSpectrum/intensities)
-            pyplot.plot(wavelengths, absorption)
-            pyplot.show(block=True)
+            absorption = numpy.log10(referenceSpectrum/intensities)
+            liveView(wavelengths).update(corrected=intensities, absorbance=absorption)
+        elif command == "L":
+            liveSpectrum("led", referenceSpectrum)
         else: print("unknown command")
 
+def kinetics():
+    "Stream emission spectra with the UV lamp on, then fit the decay of every channel"
+    duration = float(input("Duration of the run (s):"))
+    interval = float(input("Time between spectra (s):"))
+    filename = input("Enter the filename to save to:")
+    if not filename.lower().endswith(".spec"): filename += ".spec"
+    sample = input("Enter the sample name:")
+    view = liveView(device.calibration.wavelengths)
+    Kinetics.record(device, filename, duration, interval, sample=sample,
+                    pipeline=Pipeline.Pipeline(Pipeline.DarkSubtraction(), view))
+    times, intensities, wavelengths = Kinetics.load(filename)
+    fit = Kinetics.fitDecay(times, intensities)
+    peak = numpy.argmax(fit.amplitudes)
+    print("strongest emission at %.1f nm: decay rate %.3g +- %.2g /s, half life %.3g s"
+          % (wavelengths[peak], fit.rates[peak], fit.rateStderr[peak], fit.halfLives[peak]))
+
 def fluorescenceMenu():
+    exposure = numpy.nan
+    referenceSpectrum = None
     while True:
         print("STEP 1: Ensure that sample has been put in the correct position for testing")
         print("STEP 2: UV Lamp on = U, UV Lamp off = V")
-        print("STEP 3: Set exposure: F = 1000ms, G = 2000ms, H = 3000ms")
-        print("STEP 4: Read spectrum: R")
+        print("STEP 3: Set exposure: F = 1000ms, G = 2000ms, H = 3000ms, automatic = T, in ms = T<ms>")
+        print("STEP 4: Read spectrum: R, high dynamic range (bracket around the exposure): h")
         print("STEP 5: Save previous spectrum: S")
+        print("STEP 6: Save spectrum as blank: r")
+        print("STEP ?: Display blank subtracted emission spectrum: a")
+        print("Live view (Ctrl-C to stop): L")
+        print("Kinetics (spectra at a fixed interval, with decay rates): K")
         print("QUIT = Q")
         command = input("Your choice:")
-        if command in "FGHUV":
-            arduino.write(command.encode("ascii"))
+        if command and (command in "FGHUV" or command.startswith("T")):
+            sendCommand(command, "uv")
         elif command == "Q" : return
-        elif command == "R":
-            arduino.write("U".encode("ascii")) # lamp on
-            channels, wavelengths, intensities = readSpectrum(arduino)
-            arduino.write("V".encode("ascii")) # lamp off
-            import time
-            time.sleep(2)                                                                                                                                                                                                                                                       
-            channels, wavelengths, background = readSpectrum(arduino)
-            intensities -= background
-            intensities = scipy.clip(intensities, 0.001, 1024)
-            pyplot.plot(wavelengths, intensities)
-            pyplot.show(block=True)
+        elif command in ("R", "h"):
+            if command == "R": frame = device.acquire("uv")
+            else: frame = HighDynamicRange.acquire(device, "uv", darks=darks)
+            channels, wavelengths = device.calibration.channels, frame["wavelengths"]
+            raw, intensities, exposure = frame["intensities"], frame["corrected"], frame["exposure"]
+            liveView(wavelengths).update(intensities=raw, corrected=intensities, exposure=exposure,
+                                         saturated=frame["saturated"])
         elif command == "S":
-            saveSpectrum(channels, wavelengths, intensities)
+            saveSpectrum(channels, wavelengths, intensities, "fluorescence", exposure)
+        elif command == "L":
+            liveSpectrum("uv")
         elif command == "r":
             referenceSpectrum = intensities
         elif command == "a":
-            fluorescence = scipy.log10(referenceSpectrum/intensities)
-            pyplot.plot(wavelengths, absorption)
-            pyplot.show(block=True)
+            if referenceSpectrum is None:
+                print("save a blank spectrum first (r)")
+                continue
+            fluorescence = intensities - referenceSpectrum
+            liveView(wavelengths).update(intensities=intensities, corrected=fluorescence)
+        elif command == "K":
+            kinetics()
         else: print("unknown command"); return
 
 # Main program starts here
 
-arduino = serial.Serial("/dev/ttyACM0", timeout = 1)
-time.sleep(1)
+device = None
+darks = None
+
+def main(port=Acquisition.DEFAULT_PORT):
+    "Connect to the spectrometer and run the menus; importing this file does neither"
+    global device, darks
+    device = Acquisition.Spectrophotometer(port).connect()
+    darks = HighDynamicRange.DarkCache(device)
+    while True:
+        print("Absorbance = ab, Fluorescence = fl")
+        command = input("Your chosen method:")
+        if command == "ab": absorptionMenu()
+        elif command == "fl": fluorescenceMenu()
+        else: print("Help! I don't know what to do! Enter in the commands in the description!")
 
-while True:
-    print("Absorbance = ab, Fluorescence = fl")
-    command = input("Your chosen method:")
-    if command == "ab": absorptionMenu()
-    elif command == "fl": fluorescenceMenu()
-    else: print("Help! I don't know what to do! Enter in the commands in the description!")
+if __name__ == "__main__":
+    main()
 
 
 
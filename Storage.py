@@ -0,0 +1,235 @@
+"""
+Compact binary storage for spectra.
+
+A spectrum file holds a small header, the wavelength axis (once per file) and a sequence
+of fixed size frame records (timestamp, exposure, mode, sample, device, intensities).
+Frames are appended at the end of the file, and all of them are read back with a single
+memory mapped read:
+
+    store = Storage.SpectrumFile("cyan series.spec", wavelengths)
+    store.append(intensities, mode="absorbance", exposure=5, sample="cyan 50")
+    frames = Storage.SpectrumFile("cyan series.spec").frames()
+    frames["intensities"]         # (N, channels) array, no parsing
+    frames["sample"]
+
+CSV export and import keep compatibility with the "%d,%f,%f" files written by saveSpectrum.
+"""
+
+import json
+import os
+import struct
+import time
+
+import numpy
+
+MAGIC = b"SPECTRA1"
+ALIGNMENT = 64
+TEXT_FIELDS = (("mode", 16), ("sample", 64), ("device", 32))
+
+def recordType(channels, dtype="f8"):
+    "The numpy record type of one stored frame"
+    fields = [("timestamp", "<f8"), ("exposure", "<f8")]
+    fields += [(name, "S%d" % size) for name, size in TEXT_FIELDS]
+    fields.append(("intensities", numpy.dtype(dtype).newbyteorder("<"), (channels,)))
+    return numpy.dtype(fields)
+
+class SpectrumFile:
+    "An append-only file of spectra sharing one wavelength axis"
+    def __init__(self, filename, wavelengths=None, dtype="f8"):
+        self.filename = filename
+        if os.path.exists(filename) and os.path.getsize(filename) > 0:
+            self._readHeader()
+            if wavelengths is not None and (len(wavelengths) != len(self.wavelengths)
+                                            or not numpy.allclose(wavelengths, self.wavelengths)):
+                raise ValueError("%s was written with a different wavelength axis" % filename)
+        else:
+            if wavelengths is None:
+                raise ValueError("a wavelength axis is needed to create %s" % filename)
+            self._writeHeader(numpy.asarray(wavelengths, dtype=float), dtype)
+
+    def __repr__(self):
+        return "SpectrumFile(%r, %d frames of %d channels)" % (self.filename, len(self), self.channels)
+
+    def _writeHeader(self, wavelengths, dtype):
+        self.wavelengths = wavelengths
+        self.channels = len(wavelengths)
+        self.recordType = recordType(self.channels, dtype)
+        header = json.dumps(dict(channels=self.channels, dtype=numpy.dtype(dtype).str,
+                                 fields=dict(TEXT_FIELDS))).encode("ascii")
+        start = len(MAGIC) + 4 + len(header)
+        # the wavelength axis and the records start on aligned offsets
+        axisOffset = -(-start // ALIGNMENT) * ALIGNMENT
+        self.dataOffset = -(-(axisOffset + 8 * self.channels) // ALIGNMENT) * ALIGNMENT
+        with open(self.filename, "wb") as fd:
+            fd.write(MAGIC + struct.pack("<I", len(header)) + header)
+            fd.write(b"\0" * (axisOffset - start))
+            fd.write(wavelengths.astype("<f8").tobytes())
+            fd.write(b"\0" * (self.dataOffset - axisOffset - 8 * self.channels))
+
+    def _readHeader(self):
+        with open(self.filename, "rb") as fd:
+            if fd.read(len(MAGIC)) != MAGIC:
+                raise ValueError("%s is not a spectrum file" % self.filename)
+            length, = struct.unpack("<I", fd.read(4))
+            header = json.loads(fd.read(length).decode("ascii"))
+            start = len(MAGIC) + 4 + length
+            axisOffset = -(-start // ALIGNMENT) * ALIGNMENT
+            fd.seek(axisOffset)
+            self.channels = header["channels"]
+            self.wavelengths = numpy.frombuffer(fd.read(8 * self.channels), dtype="<f8").copy()
+        self.recordType = recordType(self.channels, header["dtype"])
+        self.dataOffset = -(-(axisOffset + 8 * self.channels) // ALIGNMENT) * ALIGNMENT
+
+    def __len__(self):
+        # a partially written last record is ignored
+        return (os.path.getsize(self.filename) - self.dataOffset) // self.recordType.itemsize
+
+    def records(self, intensities, timestamp=None, exposure=numpy.nan, mode="", sample="", device=""):
+        "Frame records for one spectrum or a (N, channels) stack of spectra"
+        intensities = numpy.atleast_2d(intensities)
+        if intensities.shape[1] != self.channels:
+            raise ValueError("expected %d channels, got %d" % (self.channels, intensities.shape[1]))
+        records = numpy.zeros(len(intensities), dtype=self.recordType)
+        records["timestamp"] = time.time() if timestamp is None else timestamp
+        records["exposure"] = exposure
+        for name, size in TEXT_FIELDS:
+            value = {"mode": mode, "sample": sample, "device": device}[name]
+            records[name] = value.encode("utf-8")[:size] if isinstance(value, str) else value
+        records["intensities"] = intensities
+        return records
+
+    def append(self, intensities, **metadata):
+        "Append one spectrum or a stack of spectra with shared metadata"
+        self.appendRecords(self.records(intensities, **metadata))
+
+    def appendRecords(self, records):
+        records = numpy.asarray(records, dtype=self.recordType)
+        with open(self.filename, "r+b") as fd:
+            fd.seek(self.dataOffset + len(self) * self.recordType.itemsize)
+            fd.write(records.tobytes())
+
+    def frames(self, mode="r"):
+        "All frames as a memory mapped record array"
+        n = len(self)
+        if n == 0:
+            return numpy.zeros(0, dtype=self.recordType)
+        return numpy.memmap(self.filename, dtype=self.recordType, mode=mode, offset=self.dataOffset, shape=(n,))
+
+    def intensities(self):
+        "All spectra as a (N, channels) array"
+        return self.frames()["intensities"]
+
+    def metadata(self, index):
+        "Metadata of one frame as a dictionary"
+        frame = self.frames()[index]
+        result = dict(timestamp=float(frame["timestamp"]), exposure=float(frame["exposure"]))
+        for name, size in TEXT_FIELDS:
+            result[name] = frame[name].decode("utf-8", "replace")
+        return result
+
+    def exportCSV(self, filename, index=-1):
+        "Write one frame in the channel,wavelength,intensity format of saveSpectrum"
+        writeCSV(filename, numpy.arange(self.channels), self.wavelengths, self.frames()[index]["intensities"])
+
+class ChunkedWriter:
+    """Collects frames in a fixed block of records and appends the block to the file when
+    it is full, so that long runs neither grow in memory nor write every frame separately"""
+    def __init__(self, store, chunk=64):
+        self.store = store
+        self.block = numpy.zeros(chunk, dtype=store.recordType)
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.flush()
+
+    def __len__(self):
+        "Frames written so far, including those not yet flushed"
+        return len(self.store) + self.count
+
+    def append(self, intensities, **metadata):
+        "Append one spectrum"
+        self.block[self.count] = self.store.records(intensities, **metadata)[0]
+        self.count += 1
+        if self.count == len(self.block):
+            self.flush()
+
+    def flush(self):
+        if self.count:
+            self.store.appendRecords(self.block[:self.count])
+            self.count = 0
+
+def writeCSV(filename, channels, wavelengths, intensities):
+    "Write a spectrum as channel,wavelength,intensity lines"
+    table = numpy.empty(len(channels), dtype=[("c", "i8"), ("w", "f8"), ("i", "f8")])
+    table["c"], table["w"], table["i"] = channels, wavelengths, intensities
+    numpy.savetxt(filename, table, fmt="%d,%f,%f")
+
+def readCSV(filename):
+    "Read a channel,wavelength,intensity file, returning the three columns as arrays"
+    table = numpy.loadtxt(filename, delimiter=",", usecols=(0, 1, 2), ndmin=2)
+    return table[:, 0].astype(int), table[:, 1], table[:, 2]
+
+def _isNumber(text):
+    try:
+        float(text)
+        return True
+    except ValueError:
+        return False
+
+def readPlateCSV(filename):
+    """Read the absorbance spectra of a plate reader export (as in "28 nov abosrbance values"):
+    a wavelength column followed by one column per well. Returns the wavelengths (nm) and a
+    dictionary of the wells' absorbances, named by the well header (A-01, ...) if there is
+    one, else by column number."""
+    import csv
+    with open(filename, newline="", encoding="latin-1") as fd:
+        rows = list(csv.reader(fd))
+    names = {}
+    table = []
+    for number, row in enumerate(rows):
+        cells = [c.strip() for c in row]
+        if len(cells) < 2: continue
+        if not cells[0] and any(cells[1:]) and not any(_isNumber(c) for c in cells[1:]):
+            # the header row names the wells
+            names = dict((i, c) for i, c in enumerate(cells[1:]) if c)
+            continue
+        if not all(_isNumber(c) for c in cells[1:] if c) or not any(cells[1:]): continue
+        if _isNumber(cells[0]):
+            wavelength = float(cells[0])
+        elif not cells[0] and number + 1 < len(rows) and rows[number + 1] and _isNumber(rows[number + 1][0]):
+            # the first wavelength of a table is sometimes left blank
+            wavelength = numpy.nan
+        else:
+            continue
+        table.append([wavelength] + [float(c) if c else numpy.nan for c in cells[1:]])
+    if not table:
+        raise ValueError("no spectra in %s" % filename)
+    width = max(len(r) for r in table)
+    table = numpy.array([r + [numpy.nan] * (width - len(r)) for r in table])
+    wavelengths = table[:, 0]
+    for i in numpy.flatnonzero(numpy.isnan(wavelengths)):
+        if i + 2 < len(wavelengths): wavelengths[i] = 2 * wavelengths[i + 1] - wavelengths[i + 2]
+    if numpy.any(numpy.isnan(wavelengths)) or numpy.any(numpy.diff(wavelengths) <= 0):
+        raise ValueError("no increasing wavelength column in %s" % filename)
+    wells = {}
+    for i in range(1, width):
+        column = table[:, i]
+        # wells measured over the whole wavelength range; partial columns are other tables
+        if numpy.all(numpy.isfinite(column)):
+            wells[names.get(i - 1, "column %d" % i)] = column
+    return wavelengths, wells
+
+def importCSV(filenames, store, **metadata):
+    """Append a list of saveSpectrum CSV files to a spectrum file, returning it; the sample
+    and timestamp default to each file's name and modification time"""
+    columns = [readCSV(f) for f in filenames]
+    if not isinstance(store, SpectrumFile):
+        store = SpectrumFile(store, columns[0][1])
+    for filename, (channels, wavelengths, intensities) in zip(filenames, columns):
+        frame = dict(sample=os.path.splitext(os.path.basename(filename))[0], timestamp=os.path.getmtime(filename))
+        frame.update(metadata)
+        store.append(intensities, **frame)
+    return store
@@ -0,0 +1,149 @@
+"""
+Unmixing of absorbance spectra into concentrations of pure components (cyan, magenta, ...).
+
+The basis holds the absorbance per unit concentration of each component, measured from
+the calibration series in the archive. Concentrations of many spectra are found in one
+batched non-negative least squares solve:
+
+    unmixer = Unmixing.Unmixer.fromDataset(Dataset.Dataset("experimentation overall"))
+    concentrations, residuals = unmixer(absorbances)      # (N, channels) -> (N, components)
+
+The commercial ink spectra of "28 nov abosrbance values" (plate reader exports without
+concentrations) give a basis on any wavelength axis, in units of those reference samples:
+
+    unmixer = Unmixing.Unmixer.fromReferences(Calibration.calibration().wavelengths)
+"""
+
+import itertools
+import os
+
+import numpy
+
+import Analysis
+import Storage
+
+MAX_COMPONENTS = 12
+
+REFERENCE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "28 nov abosrbance values")
+# the export and well of each commercial ink; the other wells are blanks or other dilutions
+REFERENCES = dict(cyan=("cyan ink (commercial).csv", "column 2"),
+                  magenta=("magenta ink v2 (commercial).csv", "A-02"))
+
+def referenceSpectra(directory=REFERENCE_DIRECTORY, references=REFERENCES):
+    "Wavelengths (nm) and absorbances of the reference inks, {name: (wavelengths, absorbances)}"
+    spectra = {}
+    for name, (filename, well) in references.items():
+        wavelengths, wells = Storage.readPlateCSV(os.path.join(directory, filename))
+        if well not in wells:
+            raise ValueError("no well %s in %s, expected one of %s" % (well, filename, ", ".join(sorted(wells))))
+        spectra[name] = (wavelengths, wells[well])
+    return spectra
+
+def seriesBasis(concentrations, absorbances, weights=None, mask=None):
+    "Absorbance per unit concentration of one component, from a concentration series"
+    return Analysis.fitLines(concentrations, absorbances, weights, mask).slopes
+
+def seriesFromDataset(dataset, dye, experiments=None):
+    "Concentrations and absorbances of the final raw series of a dye, each against its 0% reference"
+    concentrations = []
+    absorbances = []
+    rows = dataset.select(dye=dye, kind="raw", final=True)
+    found = sorted(set(dataset.entries[r]["experiment"] for r in rows))
+    for experiment in (experiments or found):
+        series = [r for r in rows if dataset.entries[r]["experiment"] == experiment]
+        references = [r for r in series if dataset.entries[r]["concentration"] == 0]
+        if not references: continue
+        reference = dataset.intensities[references].mean(axis=0)
+        for r in series:
+            if dataset.entries[r]["concentration"] == 0: continue
+            concentrations.append(dataset.entries[r]["concentration"])
+            absorbances.append(Analysis.absorbance(reference, dataset.intensities[r]))
+    if not concentrations:
+        raise ValueError("no referenced %s series in %s" % (dye, dataset))
+    return numpy.array(concentrations), numpy.array(absorbances)
+
+class Unmixer:
+    "Non-negative least squares fit of spectra as sums of basis spectra"
+    def __init__(self, basis, names=None, baseline=False, channels=None):
+        """basis is (channels, components); baseline adds a free constant offset that may be
+        negative; channels selects the channels used in the fit (mask or index array)"""
+        basis = numpy.asarray(basis, dtype=float)
+        if basis.ndim == 1: basis = basis[:, numpy.newaxis]
+        self.names = list(names or ["component %d" % i for i in range(basis.shape[1])])
+        self.baseline = baseline
+        if baseline:
+            basis = numpy.hstack([basis, numpy.ones((len(basis), 1))])
+        if basis.shape[1] > MAX_COMPONENTS:
+            raise ValueError("at most %d components can be unmixed" % MAX_COMPONENTS)
+        self.channels = numpy.arange(len(basis)) if channels is None else numpy.asarray(channels)
+        if self.channels.dtype == bool: self.channels = numpy.flatnonzero(self.channels)
+        self.basis = basis
+        a = basis[self.channels]
+        gram = a.T.dot(a)
+        k = len(self.names)
+        # every active set of the constrained components, each with its normal equations solved
+        # in advance; the NNLS solution is the best of the active set solutions that are feasible
+        free = [k] if baseline else []
+        self.subsets = []
+        for size in range(k + 1):
+            for subset in itertools.combinations(range(k), size):
+                active = list(subset) + free
+                if not active: continue
+                self.subsets.append((numpy.array(active), numpy.linalg.pinv(gram[numpy.ix_(active, active)])))
+
+    def __repr__(self):
+        return "Unmixer(%s%s)" % (", ".join(self.names), ", baseline" if self.baseline else "")
+
+    @classmethod
+    def fromSeries(cls, series, **options):
+        "Basis from {name: (concentrations, absorbances)} calibration series"
+        names = sorted(series)
+        basis = numpy.array([seriesBasis(*series[name]) for name in names]).T
+        return cls(basis, names, **options)
+
+    @classmethod
+    def fromReferences(cls, wavelengths, references=None, **options):
+        """Basis on the given wavelength axis (nm) from reference absorbance spectra, by
+        default those of referenceSpectra(); concentrations are in units of the references.
+        Unless channels are given, only the channels the references cover are fitted."""
+        references = referenceSpectra() if references is None else references
+        names = sorted(references)
+        wavelengths = numpy.asarray(wavelengths, dtype=float)
+        covered = numpy.ones(len(wavelengths), dtype=bool)
+        for name in names:
+            w = references[name][0]
+            covered &= (wavelengths >= w[0]) & (wavelengths <= w[-1])
+        if not covered.any():
+            raise ValueError("the references do not cover %g to %g nm" % (wavelengths.min(), wavelengths.max()))
+        options.setdefault("channels", covered)
+        basis = numpy.array([numpy.interp(wavelengths, *references[name]) for name in names]).T
+        return cls(basis, names, **options)
+
+    @classmethod
+    def fromDataset(cls, dataset, dyes=("cyan", "magenta"), experiments=None, **options):
+        "Basis from the final raw calibration series of the archive"
+        return cls.fromSeries(dict((dye, seriesFromDataset(dataset, dye, experiments)) for dye in dyes), **options)
+
+    def __call__(self, absorbances):
+        """Concentrations (N, components) and residual norms (N,) of a stack of absorbance
+        spectra (N, channels); a single spectrum gives a single row"""
+        y = numpy.atleast_2d(numpy.asarray(absorbances, dtype=float))[:, self.channels]
+        k = len(self.names)
+        projections = y.dot(self.basis[self.channels])
+        yy = numpy.einsum("ij,ij->i", y, y)
+        best = numpy.zeros((len(y), self.basis.shape[1]))
+        bestresidual = yy.copy()
+        for active, inverse in self.subsets:
+            x = projections[:, active].dot(inverse)
+            residual = yy - numpy.einsum("ij,ij->i", x, projections[:, active])
+            feasible = numpy.all(x[:, active < k] >= 0, axis=1)
+            better = feasible & (residual < bestresidual)
+            if numpy.any(better):
+                best[better] = 0
+                best[numpy.ix_(better, active)] = x[better]
+                bestresidual[better] = residual[better]
+        return best[:, :k], numpy.sqrt(numpy.maximum(bestresidual, 0))
+
+    def spectra(self, concentrations):
+        "Model absorbance spectra for given concentrations (N, components)"
+        return numpy.atleast_2d(concentrations).dot(self.basis[:, :len(self.names)].T)
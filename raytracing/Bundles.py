@@ -0,0 +1,423 @@
+"""
+Tracing of whole ray bundles with numpy, reduced into detector histograms as it goes.
+
+A bundle holds the rays as arrays (origins, directions, wavelengths, powers) instead of one
+LightRay per ray; every level of the trace finds the nearest component of all rays at once
+and spawns their reflected, refracted, scattered or diffracted rays as the next bundle,
+with the interactions of Elements.Component. Rays that reach a detector component add
+their power to its histogram over wavelength:
+
+	system = design.system()
+	bundle = Bundles.Bundle.fromrays(design.sourcerays(101, 50))
+	histogram = Bundles.Histogram(edges=numpy.linspace(400e-9, 800e-9, 41), detectors=[0])
+	Bundles.trace(system, bundle, depth=8, histogram=histogram)
+	histogram.power
+
+The shapes of CSG, Mesh and Surfaces are supported, including their CSG combinations.
+
+For very many rays, bundles can be stored in float32 (36 bytes a ray with its source index;
+intersections are still solved in float64) and stream() traces rays made chunk by chunk by
+a source straight into the histogram, so memory stays bounded by the chunk size whatever
+the number of rays:
+
+	Bundles.stream(system, design.source(), 10**8, histogram, chunk=65536)
+"""
+
+import weakref
+
+import numpy
+
+import CSG
+import Elements
+import Mesh
+import Surfaces
+
+EPSILON = 1e-5		# minimum distance of a forward intersection, as in CSG.Shape.firstintersection
+
+def _dot(a, b):
+	return (a*b).sum(axis=-1)
+
+def _normalize(v):
+	with numpy.errstate(invalid="ignore", divide="ignore"):
+		return v/numpy.linalg.norm(v, axis=-1)[..., numpy.newaxis]
+
+def _points(o, d, t):
+	return o[:, numpy.newaxis] + d[:, numpy.newaxis]*t[..., numpy.newaxis]
+
+def _halfspace(shape, o, d):
+	n = numpy.array(shape.normal.components)
+	dn = d.dot(n)
+	with numpy.errstate(invalid="ignore", divide="ignore"):
+		t = (numpy.array(shape.center.components) - o).dot(n)/dn
+	t[dn == 0] = numpy.nan
+	return t[:, numpy.newaxis], numpy.broadcast_to(n, (len(o), 1, 3))
+
+def _sphere(shape, o, d):
+	c = numpy.array(shape.center.components)
+	co = c - o
+	cod = _dot(co, d)
+	with numpy.errstate(invalid="ignore"):
+		root = numpy.sqrt(cod**2 + shape.radius**2 - _dot(co, co))
+	t = numpy.stack([cod + root, cod - root], axis=1)
+	return t, _normalize(_points(o, d, t) - c)
+
+def _cylinder(shape, o, d):
+	a = numpy.array(shape.axis.components)
+	c = numpy.array(shape.center.components)
+	da = d.dot(a)
+	oc = o - c
+	oca = oc.dot(a)
+	A = 1 - da**2
+	B2 = _dot(d, oc) - da*oca
+	C = _dot(oc, oc) - oca**2 - shape.radius**2
+	with numpy.errstate(invalid="ignore", divide="ignore"):
+		root = numpy.sqrt(B2**2 - A*C)
+		t = numpy.stack([(-B2 + root)/A, (-B2 - root)/A], axis=1)
+	t[A == 0] = numpy.nan
+	x = _points(o, d, t) - c
+	return t, _normalize(x - a*x.dot(a)[..., numpy.newaxis])
+
+def _polyhedron(shape, o, d):
+	tin, tout, hin, hout = shape.bundleintersections(o, d)
+	normals = numpy.array([h.normal.components for h in shape.halfspaces] + [(numpy.nan,)*3])
+	t = numpy.stack([numpy.where(hin >= 0, tin, numpy.nan), numpy.where(hout >= 0, tout, numpy.nan)], axis=1)
+	return t, numpy.stack([normals[hin], normals[hout]], axis=1)
+
+def _mesh(shape, o, d):
+	rays, ts, triangles = shape.traverse(o, d, tmin=-numpy.inf, first=False)
+	counts = numpy.bincount(rays, minlength=len(o))
+	t = numpy.full((len(o), max(counts.max() if len(counts) else 0, 1)), numpy.nan)
+	normals = numpy.full(t.shape + (3,), numpy.nan)
+	order = numpy.argsort(rays, kind="stable")
+	rays = rays[order]
+	slot = numpy.arange(len(rays)) - numpy.concatenate([[0], numpy.cumsum(counts)])[rays]
+	t[rays, slot] = ts[order]
+	normals[rays, slot] = shape.normals[triangles[order]]
+	return t, normals
+
+def _surface(shape, o, d):
+	t, normals = shape.solve(o, d)
+	return t[:, numpy.newaxis], normals[:, numpy.newaxis]
+
+def _masked(t, normals, keep):
+	return numpy.where(keep, t, numpy.nan), normals
+
+def _binary(shape, o, d):
+	t1, n1 = candidates(shape.shape1, o, d)
+	t2, n2 = candidates(shape.shape2, o, d)
+	in2 = contains(shape.shape2, _points(o, d, t1))
+	in1 = contains(shape.shape1, _points(o, d, t2))
+	if isinstance(shape, CSG.Intersection): keep1, keep2 = in2, in1
+	elif isinstance(shape, CSG.Union): keep1, keep2 = ~in2, ~in1
+	elif isinstance(shape, CSG.Without):
+		keep1, keep2 = ~in2, in1
+		n2 = -n2
+	elif isinstance(shape, CSG.Difference):
+		# every crossing is kept, facing the other way inside the other shape
+		keep1, keep2 = numpy.ones_like(in2), numpy.ones_like(in1)
+		n1 = numpy.where(in2[..., numpy.newaxis], -n1, n1)
+		n2 = numpy.where(in1[..., numpy.newaxis], -n2, n2)
+	else: raise TypeError("no bundle intersection for %s" % shape.opname())
+	return numpy.concatenate([numpy.where(keep1, t1, numpy.nan), numpy.where(keep2, t2, numpy.nan)], axis=1), \
+		numpy.concatenate([numpy.broadcast_to(n1, t1.shape + (3,)), numpy.broadcast_to(n2, t2.shape + (3,))], axis=1)
+
+def _rotate(shape, r, sign):
+	n = numpy.array(shape.axis.components)
+	return r*shape.cosphi + n*(r.dot(n)[..., numpy.newaxis])*(1 - shape.cosphi) + sign*numpy.cross(r, n)*shape.sinphi
+
+def _translation(shape, o, d):
+	return candidates(shape.shape, o - shape.offset.components, d)
+
+def _rotation(shape, o, d):
+	t, normals = candidates(shape.shape, _rotate(shape, o, -1), _rotate(shape, d, -1))
+	return t, _rotate(shape, normals, 1)
+
+# crossings of the rays' lines with the surface of each kind of shape, as (N, K) parameters
+# (nan where there is none) and (N, K, 3) outward normals
+CANDIDATES = [
+	(CSG.HalfSpace, _halfspace),
+	(CSG.Sphere, _sphere),
+	(CSG.Cylinder, _cylinder),
+	(CSG.ConvexPolyhedron, _polyhedron),
+	(CSG.BinaryShapeOp, _binary),
+	(CSG.Translation, _translation),
+	(CSG.Rotation, _rotation),
+	(Mesh.Mesh, _mesh),
+	(Surfaces.SagSurface, _surface),
+]
+
+def candidates(shape, o, d):
+	for cls, function in CANDIDATES:
+		if isinstance(shape, cls): return function(shape, o, d)
+	raise TypeError("no bundle intersection for %s" % shape)
+
+def contains(shape, points):
+	"Which points (arrays of any shape (..., 3)) are inside a shape"
+	p = numpy.asarray(points)
+	with numpy.errstate(invalid="ignore"):
+		if isinstance(shape, CSG.HalfSpace):
+			return (p - shape.center.components).dot(shape.normal.components) < 0
+		if isinstance(shape, CSG.Sphere):
+			return numpy.linalg.norm(p - shape.center.components, axis=-1) < shape.radius
+		if isinstance(shape, CSG.Cylinder):
+			x = p - shape.center.components
+			a = numpy.array(shape.axis.components)
+			return numpy.linalg.norm(x - a*x.dot(a)[..., numpy.newaxis], axis=-1) < shape.radius
+		if isinstance(shape, CSG.ConvexPolyhedron):
+			inside = numpy.ones(p.shape[:-1], dtype=bool)
+			for h in shape.halfspaces: inside &= (p - h.center.components).dot(h.normal.components) < 0
+			return inside
+		if isinstance(shape, CSG.Intersection): return contains(shape.shape1, p) & contains(shape.shape2, p)
+		if isinstance(shape, CSG.Union): return contains(shape.shape1, p) | contains(shape.shape2, p)
+		if isinstance(shape, CSG.Without): return contains(shape.shape1, p) & ~contains(shape.shape2, p)
+		if isinstance(shape, CSG.Difference): return contains(shape.shape1, p) ^ contains(shape.shape2, p)
+		if isinstance(shape, CSG.Translation): return contains(shape.shape, p - shape.offset.components)
+		if isinstance(shape, CSG.Rotation): return contains(shape.shape, _rotate(shape, p, -1))
+		if isinstance(shape, Surfaces.SagSurface):
+			flat = p.reshape(-1, 3)
+			local, unused = shape.local(flat, numpy.zeros_like(flat))
+			z, dzdx, dzdy = shape.sag(local[:, 0], local[:, 1])
+			return (local[:, 2] > z).reshape(p.shape[:-1])
+		if isinstance(shape, Mesh.Mesh):
+			flat = p.reshape(-1, 3)
+			finite = numpy.flatnonzero(numpy.isfinite(flat).all(axis=1))
+			rays, ts, triangles = shape.traverse(flat[finite], numpy.tile((0.5773, 0.5774, 0.5773), (len(finite), 1)),
+											tmin=0.0, first=False)
+			inside = numpy.zeros(len(flat), dtype=bool)
+			inside[finite] = numpy.bincount(rays, minlength=len(finite)) % 2 == 1
+			return inside.reshape(p.shape[:-1])
+	raise TypeError("no bundle containment test for %s" % shape)
+
+def firstintersection(component, o, d, epsilon=EPSILON):
+	"The nearest intersection of each ray with a component beyond epsilon: parameters (inf on a miss) and normals"
+	if isinstance(component, Elements.Aperture):
+		normal = numpy.array(component.normal.components)
+		with numpy.errstate(invalid="ignore", divide="ignore"):
+			t = (numpy.array(component.center.components) - o).dot(normal)/d.dot(normal)
+		t = numpy.where(component.passes(o, d) | ~(t > epsilon), numpy.inf, t)
+		return t, numpy.broadcast_to(normal, (len(o), 3))
+	if hasattr(component.shape, "bundlefirstintersection"):
+		return component.shape.bundlefirstintersection(o, d, epsilon)
+	t, normals = candidates(component.shape, o, d)
+	with numpy.errstate(invalid="ignore"):
+		t = numpy.where(t > epsilon, t, numpy.inf)
+	nearest = numpy.argmin(t, axis=1)
+	rows = numpy.arange(len(o))
+	return t[rows, nearest], numpy.broadcast_to(normals, t.shape + (3,))[rows, nearest]
+
+def refractiveindices(material, wavelengths):
+	"material.refractiveindex for an array of wavelengths"
+	if isinstance(material, Elements.Sellmeier):
+		l2 = (wavelengths*1e6)**2
+		return numpy.sqrt(1.0 + material.B1*l2/(l2 - material.C1) + material.B2*l2/(l2 - material.C2)
+						+ material.B3*l2/(l2 - material.C3))
+	if isinstance(material, Elements.Sample): return numpy.full(len(wavelengths), float(material.index))
+	if type(material).refractiveindex is Elements.Material.refractiveindex: return numpy.ones(len(wavelengths))
+	values, inverse = numpy.unique(wavelengths, return_inverse=True)
+	return numpy.array([material.refractiveindex(float(w)) for w in values])[inverse]
+
+class Bundle:
+	"Rays as arrays: origins and unit directions (N, 3), wavelengths, powers and the index of the source ray"
+	def __init__(self, origins, directions, wavelengths, powers=None, sources=None, dtype=float):
+		self.dtype = numpy.dtype(dtype)
+		self.origins = numpy.asarray(origins, dtype=self.dtype).reshape(-1, 3)
+		self.directions = numpy.asarray(directions, dtype=self.dtype).reshape(-1, 3)
+		self.wavelengths = numpy.asarray(wavelengths, dtype=self.dtype).reshape(-1)
+		self.powers = numpy.ones(len(self.origins), dtype=self.dtype) if powers is None \
+			else numpy.asarray(powers, dtype=self.dtype).reshape(-1)
+		self.sources = numpy.arange(len(self.origins)) if sources is None else numpy.asarray(sources).reshape(-1)
+	def __repr__(self):
+		return "Bundle(%d rays, %s)" % (len(self), self.dtype)
+	def __len__(self):
+		return len(self.origins)
+	@classmethod
+	def fromrays(cls, rays, dtype=float):
+		"A bundle of LightRays"
+		return cls([r.location.components for r in rays], [r.direction.components for r in rays],
+				[r.wavelength for r in rays], [r.power for r in rays], dtype=dtype)
+	def take(self, rows):
+		return Bundle(self.origins[rows], self.directions[rows], self.wavelengths[rows], self.powers[rows],
+					self.sources[rows], self.dtype)
+
+class FanSource:
+	"""Rays from a point at random angles up to halfangle (degrees) from the axis, in the
+	plane of the axis across up (the xz plane of the prism designs) or in a cone, with
+	wavelengths uniform over (start, stop). Rays are drawn in blocks from generators seeded
+	by the seed and the block, so ray i is the same however the rays are chunked."""
+	block = 4096
+	def __init__(self, location, axis, halfangle, wavelengths, up=(0, 1, 0), cone=False, seed=0, dtype=numpy.float32):
+		self.location = numpy.asarray(location, dtype=float)
+		self.axis = numpy.asarray(axis, dtype=float)/numpy.linalg.norm(axis)
+		self.across = numpy.cross(up, self.axis)
+		self.across /= numpy.linalg.norm(self.across)
+		self.up = numpy.cross(self.axis, self.across)
+		self.halfangle = halfangle
+		self.wavelengths = wavelengths
+		self.cone = cone
+		self.seed = seed
+		self.dtype = numpy.dtype(dtype)
+	def __repr__(self):
+		return "FanSource(%s, halfangle %g, %s)" % ("cone" if self.cone else "fan", self.halfangle, self.dtype)
+	def draw(self, block):
+		"Angles from the axis, azimuths and wavelengths of the rays of a block"
+		rng = numpy.random.default_rng([self.seed, block])
+		radians = self.halfangle*numpy.pi/180
+		if self.cone:
+			# uniform over the solid angle of the cone
+			theta = numpy.arccos(1 - rng.random(self.block)*(1 - numpy.cos(radians)))
+			phi = rng.random(self.block)*2*numpy.pi
+		else:
+			theta = rng.uniform(-radians, radians, self.block)
+			phi = numpy.zeros(self.block)
+		return theta, phi, rng.uniform(self.wavelengths[0], self.wavelengths[1], self.block)
+	def __call__(self, start, stop):
+		"The bundle of rays start to stop"
+		first = start//self.block
+		blocks = [self.draw(b) for b in range(first, -(-stop//self.block))]
+		offset = start - first*self.block
+		theta, phi, wavelengths = [numpy.concatenate(a)[offset:offset + stop - start] for a in zip(*blocks)] \
+			if blocks else (numpy.zeros(0),)*3
+		directions = numpy.cos(theta)[:, numpy.newaxis]*self.axis + numpy.sin(theta)[:, numpy.newaxis] \
+			*(numpy.cos(phi)[:, numpy.newaxis]*self.across + numpy.sin(phi)[:, numpy.newaxis]*self.up)
+		return Bundle(numpy.broadcast_to(self.location, (len(theta), 3)), directions, wavelengths,
+					sources=numpy.arange(start, stop, dtype=numpy.int32 if stop < 2**31 else int), dtype=self.dtype)
+
+class Histogram:
+	"""Power (and number of rays) reaching each detector component, binned by wavelength
+	between edges. The arrays may be given, as views of shared memory, say."""
+	def __init__(self, edges, detectors, power=None, count=None):
+		self.edges = numpy.asarray(edges, dtype=float)
+		self.detectors = list(detectors)
+		shape = (len(self.detectors), len(self.edges) - 1)
+		self.power = numpy.zeros(shape) if power is None else power
+		self.count = numpy.zeros(shape) if count is None else count
+	def __repr__(self):
+		return "Histogram(detectors %s, %d bins)" % (self.detectors, len(self.edges) - 1)
+	def add(self, components, wavelengths, powers):
+		"Add the rays that hit components (one index per ray; others are ignored)"
+		bins = numpy.searchsorted(self.edges, wavelengths, side="right") - 1
+		# the last edge belongs to the last bin, as for numpy.histogram
+		bins[wavelengths == self.edges[-1]] = len(self.edges) - 2
+		inside = (bins >= 0) & (bins < len(self.edges) - 1)
+		for row, detector in enumerate(self.detectors):
+			hit = inside & (components == detector)
+			numpy.add.at(self.power[row], bins[hit], powers[hit])
+			numpy.add.at(self.count[row], bins[hit], 1)
+	def merge(self, other):
+		self.power += other.power
+		self.count += other.count
+		return self
+
+# the numpy generator of each scattering material, dropped with the material
+_generators = weakref.WeakKeyDictionary()
+
+def interact(component, bundle, t, normals):
+	"The rays spawned where the rays of a bundle meet a component, as in Elements.Component.interact"
+	material = component.material
+	dtype = bundle.dtype
+	x = (bundle.origins + bundle.directions*t[:, numpy.newaxis]).astype(dtype)
+	n = normals.astype(dtype)
+	k = bundle.directions
+	nk = _dot(n, k)
+	k_perp = n*nk[:, numpy.newaxis]
+	k_par = k - k_perp
+	index = refractiveindices(material, bundle.wavelengths).astype(dtype)
+	l = numpy.where(nk < 0, index, 1.0/index)
+	lp2 = l**2 - _dot(k_par, k_par)
+	power = bundle.powers
+	leaving = nk > 0
+	if isinstance(material, Elements.Sample) and leaving.any():
+		# absorbed along the path inside
+		power = power.copy()
+		power[leaving] *= material.transmittance(bundle.wavelengths[leaving], t[leaving]).astype(dtype)
+	children = []
+	def spawn(rows, directions, powers):
+		if len(rows): children.append((rows, directions, powers))
+	everything = numpy.arange(len(bundle))
+	if material.reflective:
+		spawn(everything, k_par - k_perp, power)
+	if material.transmissive:
+		rows = numpy.flatnonzero(lp2 > 0)
+		root = numpy.sqrt(lp2[rows])[:, numpy.newaxis]
+		l_perp = numpy.where((nk[rows] < 0)[:, numpy.newaxis], -n[rows]*root, n[rows]*root)
+		spawn(rows, _normalize(k_par[rows] + l_perp), power[rows])
+	if material.scattering:
+		if material not in _generators: _generators[material] = numpy.random.default_rng(material.seed)
+		rng = _generators[material]
+		rows = numpy.flatnonzero(rng.random(len(bundle)) < material.reflectance)
+		outward = numpy.where((nk[rows] < 0)[:, numpy.newaxis], n[rows], -n[rows])
+		v = _normalize(rng.normal(size=(len(rows), 3)))
+		spawn(rows, _normalize(v + outward).astype(dtype), power[rows])
+	if material.diffracting:
+		for i, (order, efficiency) in enumerate(material.orders):
+			# rays leaving the substrate pass once, undeviated
+			rows = everything if i == 0 else numpy.flatnonzero(~leaving)
+			directions = material.bundlediffract(n[rows], k[rows], bundle.wavelengths[rows], order)
+			scale = numpy.where(leaving[rows], 1.0, efficiency)
+			propagating = numpy.isfinite(directions).all(axis=1)
+			spawn(rows[propagating], directions[propagating].astype(dtype), (power[rows]*scale)[propagating])
+	if not children:
+		return Bundle(numpy.zeros((0, 3)), numpy.zeros((0, 3)), [], [], numpy.zeros(0, dtype=int), dtype)
+	rows = numpy.concatenate([c[0] for c in children])
+	return Bundle(x[rows], numpy.concatenate([c[1] for c in children]), bundle.wavelengths[rows],
+				numpy.concatenate([c[2] for c in children]), bundle.sources[rows], dtype)
+
+def epsilon(dtype):
+	"""Minimum distance of a forward intersection for rays stored in dtype: float32 hit points
+	are off the surface by up to about 1e-7 of their coordinates, so rays would meet the
+	surface they start on again without the larger margin"""
+	return EPSILON if numpy.dtype(dtype).itemsize >= 8 else 1e-3
+
+def propagate(components, bundle):
+	"The index of the component each ray meets first (-1 for none), the parameters and the normals there"
+	nearest = numpy.full(len(bundle), numpy.inf)
+	hit = numpy.full(len(bundle), -1)
+	normals = numpy.full((len(bundle), 3), numpy.nan)
+	o = bundle.origins.astype(float)
+	d = bundle.directions.astype(float)
+	for i, component in enumerate(components):
+		t, n = firstintersection(component, o, d, epsilon(bundle.dtype))
+		closer = t < nearest
+		nearest[closer] = t[closer]
+		hit[closer] = i
+		normals[closer] = n[closer]
+	return hit, nearest, normals
+
+def step(components, bundle, histogram=None):
+	"One level of the trace: the rays spawned where the rays of the bundle meet the components"
+	hit, t, normals = propagate(components, bundle)
+	if histogram is not None:
+		histogram.add(hit, bundle.wavelengths, bundle.powers)
+	spawned = []
+	for i in numpy.unique(hit[hit >= 0]):
+		rows = numpy.flatnonzero(hit == i)
+		spawned.append(interact(components[i], bundle.take(rows), t[rows], normals[rows]))
+	if not spawned: return bundle.take(numpy.zeros(0, dtype=int))
+	return Bundle(numpy.concatenate([b.origins for b in spawned]), numpy.concatenate([b.directions for b in spawned]),
+				numpy.concatenate([b.wavelengths for b in spawned]), numpy.concatenate([b.powers for b in spawned]),
+				numpy.concatenate([b.sources for b in spawned]), bundle.dtype)
+
+def trace(components, bundle, depth=8, histogram=None):
+	"""Trace a bundle through the components for depth interactions, as LightRay.trace does,
+	adding the rays that reach detectors to the histogram; returns the rays still in flight"""
+	for level in range(depth):
+		if not len(bundle): break
+		bundle = step(components, bundle, histogram)
+	return bundle
+
+def stream(components, source, count, histogram, depth=8, chunk=65536, log=None):
+	"""Trace count rays made chunk by chunk by source(start, stop) (a FanSource, say) into
+	the histogram, without ever holding more than about chunk rays per level: bundles
+	that grow beyond chunk (by reflections, scattering or grating orders) are split, and
+	the pieces are traced depth first."""
+	for start in range(0, count, chunk):
+		pending = [(source(start, min(start + chunk, count)), depth)]
+		while pending:
+			bundle, remaining = pending.pop()
+			if remaining <= 0 or not len(bundle): continue
+			if len(bundle) > chunk:
+				pending += [(bundle.take(slice(i, i + chunk)), remaining) for i in range(0, len(bundle), chunk)]
+				continue
+			pending.append((step(components, bundle, histogram), remaining - 1))
+		if log: log("%d/%d rays" % (min(start + chunk, count), count))
+	return histogram
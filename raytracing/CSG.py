@@ -5,7 +5,6 @@ Initial development focuses on constructive solid geometry for description of re
 """
 
 import math
-import scipy
 
 class Vector:
 	"An Euclidean vector (i.e., a vector with a dot product and a norm)"
@@ -21,6 +20,7 @@ class Vector:
 		if isinstance(b, Vector): return self.dot(b)
 		else: return self.smul(b)
 	def __div__(self, s): return Vector(x / s for x in self)
+	__truediv__ = __div__
 	def __add__(self, b):
 		if len(self) != len(b): raise Exception("dimension mismatch in vector addition")
 		return Vector(self[i] + b[i] for i in range(len(self)))
@@ -177,8 +177,8 @@ class Difference(BinaryShapeOp):
 	def __contains__(self, x):
 		return (x in self.shape1) ^ (x in self.shape2)
 	def intersections(self, ray):
-		intersects = [-x if (x in self.shape2) else x for x.location in self.shape1.intersections(ray)]
-		intersects += [-x if (x in self.shape1) else x for x.location in self.shape2.intersections(ray)]
+		intersects = [-x if (x.location in self.shape2) else x for x in self.shape1.intersections(ray)]
+		intersects += [-x if (x.location in self.shape1) else x for x in self.shape2.intersections(ray)]
 		return intersects
 
 class HalfSpace(Shape):
@@ -265,12 +265,79 @@ class Cylinder(Shape):
 		intersects = [NormalizedAnchoredVector(x, x-c - a*((x-c)*a)) for x in xs]
 		return intersects
 
+class ConvexPolyhedron(Shape):
+	"The intersection of half-spaces, with one entry/exit (slab) computation per ray instead of nested Intersections"
+	def __init__(self, halfspaces):
+		self.halfspaces = list(halfspaces)
+	def __repr__(self):
+		return "ConvexPolyhedron (%s)" % ", ".join(str(h) for h in self.halfspaces)
+	def __contains__(self, x):
+		return all(x in h for h in self.halfspaces)
+	def slab(self, ray):
+		"Parameters along the ray where it enters and leaves, with the half-spaces there (None on a miss)"
+		o = ray.location
+		d = ray.direction
+		tin, tout, hin, hout = -float("inf"), float("inf"), None, None
+		for h in self.halfspaces:
+			dn = d*h.normal
+			distance = (h.center-o)*h.normal
+			if dn == 0:
+				if distance < 0: return None
+				continue
+			t = distance/dn
+			if dn < 0:
+				if t > tin: tin, hin = t, h
+			elif t < tout: tout, hout = t, h
+		if not tin < tout: return None
+		return tin, tout, hin, hout
+	def intersections(self, ray):
+		hit = self.slab(ray)
+		if hit is None: return list()
+		tin, tout, hin, hout = hit
+		return [NormalizedAnchoredVector(ray(t), h.normal) for t, h in ((tin, hin), (tout, hout)) if h is not None]
+	def bundleintersections(self, origins, directions):
+		"""The slab computation for a bundle of rays at once, as (N, 3) arrays of origins and
+		unit directions: the entry and exit parameters (nan on a miss) and the indices of
+		the half-spaces there (-1 where there is none)"""
+		import numpy
+		origins = numpy.asarray(origins, dtype=float)
+		directions = numpy.asarray(directions, dtype=float)
+		centers = numpy.array([h.center.components for h in self.halfspaces])
+		normals = numpy.array([h.normal.components for h in self.halfspaces])
+		dn = directions.dot(normals.T)
+		distance = (centers*normals).sum(axis=1) - origins.dot(normals.T)
+		with numpy.errstate(divide="ignore", invalid="ignore"):
+			t = distance/dn
+		entering = numpy.where(dn < 0, t, -numpy.inf)
+		leaving = numpy.where(dn > 0, t, numpy.inf)
+		hin = numpy.argmax(entering, axis=1)
+		hout = numpy.argmin(leaving, axis=1)
+		rows = numpy.arange(len(origins))
+		tin = entering[rows, hin]
+		tout = leaving[rows, hout]
+		hin[tin == -numpy.inf] = -1
+		hout[tout == numpy.inf] = -1
+		miss = ((dn == 0) & (distance < 0)).any(axis=1) | ~(tin < tout)
+		tin[miss] = tout[miss] = numpy.nan
+		hin[miss] = hout[miss] = -1
+		return tin, tout, hin, hout
+	def bundlefirstintersection(self, origins, directions, epsilon=1e-5):
+		"""The nearest forward intersection of each ray of a bundle, as for firstintersection():
+		its parameter (inf on a miss, or closer than epsilon) and the outward normals there (N, 3)"""
+		import numpy
+		tin, tout, hin, hout = self.bundleintersections(origins, directions)
+		normals = numpy.array([h.normal.components for h in self.halfspaces] + [(numpy.nan,)*3])
+		entry = (hin >= 0) & (tin > epsilon)
+		exit = ~entry & (hout >= 0) & (tout > epsilon)
+		t = numpy.where(entry, tin, numpy.where(exit, tout, numpy.inf))
+		return t, normals[numpy.where(entry, hin, numpy.where(exit, hout, -1))]
+
 def SphericalLens(center, axis, radius1, radius2, thickness, diameter):
-	if radius1 == 0: radius1 = scipy.inf
-	if radius2 == 0: radius2 = scipy.inf
+	if radius1 == 0: radius1 = float("inf")
+	if radius2 == 0: radius2 = float("inf")
 	axis = axis.normalize()
 	lens = Cylinder(center, axis, 0.5*diameter)
-	if abs(radius1) == scipy.inf:
+	if abs(radius1) == float("inf"):
 		lens = Intersection(lens, HalfSpace(center - axis*thickness/2, -axis))
 	else:
 		if radius1 > 0:
@@ -279,7 +346,7 @@ def SphericalLens(center, axis, radius1, radius2, thickness, diameter):
 			ctr1 = center + axis*(radius1-0.5*thickness)
 			lens = Intersection(lens, HalfSpace(ctr1, -axis))
 			lens = Without(lens, Sphere(ctr1, -radius1))
-	if abs(radius2) == scipy.inf:
+	if abs(radius2) == float("inf"):
 		lens = Intersection(lens, HalfSpace(center + axis*thickness/2, axis))
 	else:
 		if radius2 > 0:
@@ -290,5 +357,16 @@ def SphericalLens(center, axis, radius1, radius2, thickness, diameter):
 			lens = Without(lens, Sphere(ctr2, -radius2))
 	return lens
 
-
-
+def Prism(center, baselength, apex=60.0, angle=0.0):
+	"""A triangular prism along the y axis (a convex polyhedron): an isosceles triangle
+	in the xz plane with the given base length and apex angle (degrees; 60 is equilateral,
+	90 a right-angle prism) around its centroid. The base faces -x and the apex +x
+	before a rotation by angle (degrees) about the y axis."""
+	half = 0.5*apex*math.pi/180
+	height = 0.5*baselength/math.tan(half)
+	faces = [((-height/3, 0), (-1.0, 0.0)),
+		((2*height/3, 0), (math.sin(half), math.cos(half))),
+		((2*height/3, 0), (math.sin(half), -math.cos(half)))]
+	c, s = math.cos(angle*math.pi/180), math.sin(angle*math.pi/180)
+	def rotate(x, z): return Vector((x*c + z*s, 0, -x*s + z*c))
+	return ConvexPolyhedron([HalfSpace(center + rotate(*point), rotate(*normal)) for point, normal in faces])
@@ -0,0 +1,167 @@
+"""
+Parametrized versions of the prism spectrometer layouts explored in the prism scripts
+(prism.py, prism2.py, prism_3.py, ...), so that the same optical systems can be built
+without running a script's plotting code.
+"""
+
+import math
+import CSG
+import Elements
+
+N_SF10 = Elements.Sellmeier(1.62153902, 0.256287842, 1.64447552, 0.0122241457, 0.0595736775, 147.468793)
+N_SF11 = Elements.Sellmeier(1.73759695, 0.313747346, 1.89878101, 0.013188707, 0.0623068142, 155.23629)
+SF18 = Elements.Sellmeier(1.56441436, 0.291413580, 0.960307888, 0.0121863935, 0.0535567966, 111.451201)
+BK7 = Elements.Sellmeier(1.03961212, 0.231792344, 1.01096945, 0.00600069867, 0.0200179144, 103.560653)
+Absorber = Elements.Absorber()
+degrees = math.pi/180
+
+def vec(x,y,z):
+	return CSG.Vector((x,y,z))
+def Sin(deg):
+	return math.sin(deg*degrees)
+def Cos(deg):
+	return math.cos(deg*degrees)
+
+def linspace(start, stop, num):
+	"Evenly spaced values like scipy.linspace, without importing scipy"
+	if num == 1: return [float(start)]
+	return [start + (stop-start)*i/float(num-1) for i in range(num)]
+
+def equilateralprism(baselen, offset):
+	"An equilateral prism in the xz plane, a convex polyhedron of three half-spaces"
+	halfspaces = []
+	for angle in 0, 120, 240:
+		normal = vec(-Cos(angle), 0, Sin(angle))
+		halfspaces.append(CSG.HalfSpace(normal*baselen/3+offset, normal))
+	return CSG.ConvexPolyhedron(halfspaces)
+
+class PrismDesign:
+	"Collimator lens, equilateral prism and (optional) objective lens inside an absorbing boundary"
+	defaults = dict(
+		baselen = 15.0,
+		prismoffset = (-5.0, 0, 0),
+		glass = "SF18",
+		incidentaxisangle = 30,
+		outgoingaxisangle = -30,
+		sourcedistance = -70,
+		sourcehalfangle = 4.8,
+		collimatordistance = -40.0,
+		collimator = (float("inf"), 26.0, 4.9, 24.0),
+		objectiveposition = 30.0,
+		objective = (25.84, float("inf"), 3.23, 20.0),
+		boundaryradius = 150,
+		wavelengths = (400e-9, 800e-9, 10),
+	)
+	glasses = dict(N_SF10=N_SF10, N_SF11=N_SF11, SF18=SF18, BK7=BK7)
+	def __init__(self, **parameters):
+		unknown = set(parameters) - set(self.defaults)
+		if unknown: raise ValueError("unknown design parameters %s" % ", ".join(sorted(unknown)))
+		self.parameters = dict(self.defaults)
+		self.parameters.update(parameters)
+		for name, value in self.parameters.items(): setattr(self, name, value)
+		if self.glass not in self.glasses:
+			raise ValueError("unknown glass %r, expected one of %s" % (self.glass, ", ".join(sorted(self.glasses))))
+	def __repr__(self):
+		return "PrismDesign(%s)" % ", ".join("%s=%r" % kv for kv in sorted(self.parameters.items()))
+	def replace(self, **parameters):
+		"Return a copy of the design with some parameters changed"
+		changed = dict(self.parameters)
+		changed.update(parameters)
+		return PrismDesign(**changed)
+	def incidentaxis(self):
+		return CSG.Ray(vec(0,0,0), vec(Sin(self.incidentaxisangle), 0, Cos(self.incidentaxisangle)))
+	def outgoingaxis(self):
+		return CSG.Ray(vec(0,0,0), vec(Sin(self.outgoingaxisangle), 0, Cos(self.outgoingaxisangle)))
+	def objectivelocation(self):
+		"The objective lens is placed either along the outgoing axis or at an explicit point"
+		if isinstance(self.objectiveposition, (tuple, list)): return vec(*self.objectiveposition)
+		return self.outgoingaxis()(self.objectiveposition)
+	def components(self):
+		"Return the named components of the system, in tracing order"
+		incidentaxis = self.incidentaxis()
+		result = [("boundary", Elements.Component(CSG.Sphere(vec(0, 0, 0), self.boundaryradius), Absorber))]
+		r1, r2, thickness, diameter = self.collimator
+		clshape = CSG.SphericalLens(incidentaxis(self.collimatordistance), incidentaxis.direction,
+								r1, r2, thickness, diameter)
+		result.append(("collimator", Elements.Component(clshape, BK7)))
+		prismshape = equilateralprism(self.baselen, vec(*self.prismoffset))
+		result.append(("prism", Elements.Component(prismshape, self.glasses[self.glass])))
+		if self.objective:
+			r1, r2, thickness, diameter = self.objective
+			olshape = CSG.SphericalLens(self.objectivelocation(), self.outgoingaxis().direction,
+									r1, r2, thickness, diameter)
+			result.append(("objective", Elements.Component(olshape, BK7)))
+		return result
+	def system(self):
+		return [component for name, component in self.components()]
+	def sourcerays(self, nangles=11, nwavelengths=None):
+		"The fan of rays from the entrance aperture, for each wavelength"
+		start, stop, num = self.wavelengths
+		if nwavelengths is not None: num = nwavelengths
+		apos = self.incidentaxis()(self.sourcedistance)
+		angles = linspace(-self.sourcehalfangle, self.sourcehalfangle, nangles)
+		rays = []
+		for wl in linspace(start, stop, num):
+			rays += [Elements.LightRay(apos, vec(Sin(da+self.incidentaxisangle), 0, Cos(da+self.incidentaxisangle)), wl)
+					for da in angles]
+		return rays
+	def source(self, seed=0, dtype="float32"):
+		"""The source as a Bundles.FanSource of random rays over the same fan and wavelength
+		range as sourcerays(), for streaming very many rays (float32 by default)"""
+		import Bundles
+		axis = self.incidentaxis()
+		return Bundles.FanSource(axis(self.sourcedistance).components, axis.direction.components, self.sourcehalfangle,
+								self.wavelengths[:2], seed=seed, dtype=dtype)
+	def scene(self, nangles=11, nwavelengths=None):
+		"The components and source rays as a Scene.Scene, for saving or cached tracing"
+		import Scene
+		return Scene.Scene(self.components(), self.sourcerays(nangles, nwavelengths))
+	def paths(self, nangles=11, nwavelengths=None, depth=8, cache=None):
+		"""The transmitted path of every source ray, as (wavelength, [(x, y, z), ...]);
+		with a Scene.TraceCache, an unchanged design is read back instead of retraced"""
+		if cache is not None:
+			return cache.trace(self.scene(nangles, nwavelengths), depth).paths()
+		system = self.system()
+		result = []
+		for ray in self.sourcerays(nangles, nwavelengths):
+			node, children = ray.trace(system, depth=depth)
+			points = [tuple(node)]
+			while children:
+				# the transmitted ray comes after the reflected one
+				node, children = children[-1]
+				points.append(tuple(node))
+			result.append((ray.wavelength, points))
+		return result
+
+def dispersion(paths):
+	"""Angular separation (degrees, in the xz plane) of the outgoing directions of the
+	shortest and longest wavelengths, and the mean spread of the directions within a
+	wavelength"""
+	directions = {}
+	for wl, points in paths:
+		if len(points) < 2: continue
+		(x1, y1, z1), (x2, y2, z2) = points[-2], points[-1]
+		directions.setdefault(wl, []).append(math.atan2(x2-x1, z2-z1)/degrees)
+	if len(directions) < 2: return float("nan"), float("nan")
+	means = dict((wl, sum(a)/len(a)) for wl, a in directions.items())
+	spreads = [max(a) - min(a) for a in directions.values()]
+	return abs(means[max(means)] - means[min(means)]), sum(spreads)/len(spreads)
+
+# the layouts of the individual prism scripts
+_prism2 = dict(baselen=25.0, prismoffset=(-9, 0, 0), glass="N_SF11", sourcedistance=-70-40,
+		collimatordistance=-22-40, collimator=(float("inf"), 25.84, 4.9, 24.0),
+		objective=(25.84, float("inf"), 4.9, 24.0), boundaryradius=200, wavelengths=(400e-9, 800e-9, 7))
+designs = {
+	"prism": PrismDesign(),
+	"prism2": PrismDesign(**_prism2),
+	"prism_3": PrismDesign(**_prism2),
+	"prism2-without-objectivelens": PrismDesign(**dict(_prism2, objective=None)),
+	"prism2-withnew-objectivelens": PrismDesign(**dict(_prism2, outgoingaxisangle=-42,
+		objectiveposition=(-14.4408, 0, 26.2957))),
+	"13 October version 1": PrismDesign(**dict(_prism2, outgoingaxisangle=-42,
+		objectiveposition=(-20.0739, 0, 22.2943))),
+	"CHANGE PRISM": PrismDesign(**dict(_prism2, prismoffset=(0, 0, 0), outgoingaxisangle=-42,
+		objectiveposition=(-14.4408, 0, 26.2957))),
+	"Spectrophotometer raytracing": PrismDesign(**dict(_prism2, prismoffset=(-11.8, 0, 0),
+		sourcedistance=-70, collimatordistance=-22)),
+}
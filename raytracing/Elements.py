@@ -1,13 +1,18 @@
 import CSG
-import scipy
 import math
+import random
 
 class Material:
 	"Properties of an optical material"
 	def __init__(self):
 		self.reflective = False
 		self.transmissive = True
+		self.scattering = False
+		self.diffracting = False
 	def refractiveindex(self, wavelength): return 1.0
+	def attenuation(self, wavelength, length):
+		"Fraction of the power left after a path of the given length through the material"
+		return 1.0
 
 class Absorber(Material):
 	def __init__(self):
@@ -21,6 +26,125 @@ class Mirror(Material):
 		self.reflective = True
 		self.transmissive = False
 
+class Black(Material):
+	"An absorbing surface: rays that hit it end there"
+	def __init__(self):
+		Material.__init__(self)
+		self.reflective = False
+		self.transmissive = False
+
+class Diffuse(Material):
+	"A matt (Lambertian) surface: a ray is reflected with probability reflectance, in a random direction"
+	def __init__(self, reflectance=1.0, seed=None):
+		Material.__init__(self)
+		self.reflective = False
+		self.transmissive = False
+		self.scattering = True
+		self.reflectance = reflectance
+		self.seed = seed
+		self.random = random.Random(seed)
+	def __repr__(self):
+		return "Diffuse reflector, reflectance=%g" % self.reflectance
+	def scatter(self, normal):
+		"A cosine distributed random direction on the side of the unit normal"
+		while True:
+			v = CSG.Vector([self.random.uniform(-1, 1) for i in range(3)])
+			if 0 < v.normsquared() <= 1: break
+		# a uniform point on the sphere plus the normal is cosine distributed about it
+		direction = v.normalize() + normal
+		return direction if direction.normsquared() > 1e-12 else normal
+
+class Sample(Material):
+	"""A solution in a cuvette: Beer-Lambert absorption with a decadic absorption coefficient
+	(absorbance per unit length) tabulated against wavelength, in any order, and interpolated
+	linearly"""
+	def __init__(self, wavelengths, coefficients, index=1.333):
+		Material.__init__(self)
+		wavelengths = [float(x) for x in wavelengths]
+		coefficients = [float(x) for x in coefficients]
+		if len(wavelengths) != len(coefficients):
+			raise ValueError("need one coefficient per wavelength")
+		# exports often list wavelengths in decreasing order; interpolation needs them increasing
+		table = sorted(zip(wavelengths, coefficients))
+		self.wavelengths = [w for w, c in table]
+		self.coefficients = [c for w, c in table]
+		self.index = index
+	def __repr__(self):
+		return "Sample, %d wavelengths from %g to %g, n=%g" % (len(self.wavelengths), self.wavelengths[0],
+				self.wavelengths[-1], self.index)
+	@classmethod
+	def fromabsorbance(cls, wavelengths, absorbance, pathlength=10.0, **options):
+		"A sample whose absorbance over the given path length (mm, a standard cuvette) was measured"
+		return cls(wavelengths, [a/float(pathlength) for a in absorbance], **options)
+	@classmethod
+	def fromcalibration(cls, filename, concentration, pathlength=10.0, **options):
+		"""A sample of a dye at the given concentration, from the per channel calibration lines
+		written by 'spectro.py analyse' (wavelength in nm, slope in absorbance per concentration)"""
+		import csv
+		with open(filename) as fd:
+			rows = sorted((float(row["wavelength"]), float(row["slope"])) for row in csv.DictReader(fd))
+		return cls.fromabsorbance([w*1e-9 for w, slope in rows], [slope*concentration for w, slope in rows],
+								pathlength, **options)
+	def refractiveindex(self, wavelength): return self.index
+	def transmittance(self, wavelength, length):
+		"10^(-coefficient length), for single values or arrays of rays alike"
+		import numpy
+		coefficient = numpy.interp(wavelength, self.wavelengths, self.coefficients)
+		return 10.0**(-numpy.maximum(coefficient, 0.0)*numpy.asarray(length))
+	def attenuation(self, wavelength, length):
+		return float(self.transmittance(wavelength, length))
+
+class Grating(Material):
+	"""A ruled grating on the surface a ray enters: density lines per mm (lengths in mm,
+	wavelengths in m), the lines along grooves, and (order, efficiency) pairs of the
+	diffracted orders kept. Reflective by default; a transmission grating passes the rays
+	on into the substrate, which they leave undeviated."""
+	def __init__(self, density, orders=((1, 1.0),), transmission=False, grooves=CSG.Vector((0, 1, 0))):
+		Material.__init__(self)
+		self.reflective = False
+		self.transmissive = False
+		self.diffracting = True
+		self.density = density
+		self.orders = [(int(m), float(efficiency)) for m, efficiency in orders]
+		self.transmission = transmission
+		self.grooves = grooves.normalize()
+	def __repr__(self):
+		return "%s grating, %g lines/mm, orders %s" % ("Transmission" if self.transmission else "Reflection",
+				self.density, ", ".join("%d (%g)" % o for o in self.orders))
+	def diffract(self, normal, direction, wavelength):
+		"""The (direction, efficiency) of each propagating order at a surface with the given
+		outward normal, from the grating equation for the tangential wave vector"""
+		nk = normal*direction
+		if nk > 0: return [(direction, 1.0)]
+		across = normal ^ self.grooves
+		# grooves along the normal do not rule the surface, so nothing is diffracted
+		if across.normsquared() < 1e-24: return []
+		across = across.normalize()
+		tangential = direction - normal*nk
+		result = []
+		for order, efficiency in self.orders:
+			t = tangential + across*(order*wavelength*1e3*self.density)
+			t2 = t*t
+			if t2 >= 1: continue	# evanescent
+			if self.transmission: result.append((t - normal*math.sqrt(1 - t2), efficiency))
+			else: result.append((t + normal*math.sqrt(1 - t2), efficiency))
+		return result
+	def bundlediffract(self, normals, directions, wavelengths, order):
+		"""diffract() for one order and a bundle of rays as (N, 3) arrays; nan rows where the
+		order is evanescent or the grooves lie along the normal"""
+		import numpy
+		normals = numpy.asarray(normals, dtype=float)
+		directions = numpy.asarray(directions, dtype=float)
+		nk = (normals*directions).sum(axis=1)[:, numpy.newaxis]
+		across = numpy.cross(normals, self.grooves.components)
+		length = numpy.linalg.norm(across, axis=1)[:, numpy.newaxis]
+		across = across/numpy.where(length > 1e-12, length, numpy.nan)
+		t = directions - normals*nk + across*(order*numpy.asarray(wavelengths)[:, numpy.newaxis]*1e3*self.density)
+		with numpy.errstate(invalid="ignore"):
+			normal = numpy.sqrt(1 - (t*t).sum(axis=1))[:, numpy.newaxis]
+		result = t - normals*normal if self.transmission else t + normals*normal
+		return numpy.where(nk > 0, directions, result)
+
 class Sellmeier(Material):
 	"Sellmeier model for optical glass"
 	def __init__(self, B1, B2, B3, C1, C2, C3):
@@ -41,14 +165,15 @@ class Sellmeier(Material):
 
 class LightRay(CSG.Ray):
 	"An optical ray"
-	def __init__(self, origin, direction, wavelength):
+	def __init__(self, origin, direction, wavelength, power=1.0):
 		CSG.Ray.__init__(self,origin, direction)
 		self.wavelength = wavelength
+		self.power = power
 	def propagate(self, components):
 		# find the nearest intersecting component
 		intersects = [(co, co.firstintersection(self)) for co in components]
 		intersects = [x for x in intersects if x[1] is not None]
-		if len(intersects) is 0: return []
+		if len(intersects) == 0: return []
 		intersectingcomponent = min(intersects, key=lambda i: (self.location - i[1].location).norm())[0]
 		# interact at the surface
 		return intersectingcomponent.interact(self)
@@ -82,13 +207,24 @@ class Component:
 			if nk < 0: l = self.material.refractiveindex(lightray.wavelength)
 			else: l = 1.0/self.material.refractiveindex(lightray.wavelength)
 			lp2 = l**2 - l_par*l_par
+			power = lightray.power
+			if nk > 0:
+				# the ray leaves the component: absorbed along its path inside
+				power *= self.material.attenuation(lightray.wavelength, (intersection.location - lightray.location).norm())
 			if self.material.reflective:
-				result.append(LightRay(intersection.location, k_par - k_perp, lightray.wavelength))
+				result.append(LightRay(intersection.location, k_par - k_perp, lightray.wavelength, power))
 			if self.material.transmissive and lp2 > 0:
 				if nk < 0: l_perp = -n * math.sqrt(lp2)
 				else: l_perp = n * math.sqrt(lp2)
 				l = (l_par + l_perp).normalize()
-				result.append(LightRay(intersection.location, l, lightray.wavelength))
+				result.append(LightRay(intersection.location, l, lightray.wavelength, power))
+			if self.material.scattering and self.material.random.random() < self.material.reflectance:
+				# scattered back to the side the ray came from
+				outward = n if nk < 0 else -n
+				result.append(LightRay(intersection.location, self.material.scatter(outward), lightray.wavelength, power))
+			if self.material.diffracting:
+				for direction, efficiency in self.material.diffract(n, k, lightray.wavelength):
+					result.append(LightRay(intersection.location, direction, lightray.wavelength, power*efficiency))
 		return result
 
 class Lens(Component):
@@ -100,3 +236,54 @@ class Lens(Component):
 		shape = CSG.Intersection(cylinder, CSG.Intersection(surface1, surface2))
 		Component.__init__(self, shape, material)
 
+class Aperture(Component):
+	"""A stop in the plane through center with the given normal: rays that meet the plane
+	outside the opening end there, the others pass without an interaction. The opening is
+	a slit width wide across up and height (None: unlimited) along it, or a circle of
+	diameter width if round."""
+	def __init__(self, center, normal, width, height=None, up=CSG.Vector((0, 1, 0)), round=False):
+		Component.__init__(self, CSG.HalfSpace(center, normal), Black())
+		self.center = center
+		self.normal = normal.normalize()
+		self.width = width
+		self.height = height
+		self.up = (up - self.normal*(up*self.normal)).normalize()
+		self.across = self.up ^ self.normal
+		self.round = round
+	def __repr__(self):
+		if self.round: return "Aperture(center %s, normal %s, diameter %g)" % (self.center, self.normal, self.width)
+		return "Aperture(center %s, normal %s, slit %g x %s)" % (self.center, self.normal, self.width, self.height)
+	def open(self, x, y):
+		"Whether the point at x across and y along the slit from the center is in the opening"
+		if self.round: return x*x + y*y <= 0.25*self.width**2
+		return abs(x) <= 0.5*self.width and (self.height is None or abs(y) <= 0.5*self.height)
+	def firstintersection(self, lightray):
+		dn = lightray.direction*self.normal
+		if dn == 0: return None
+		t = (self.center - lightray.location)*self.normal/dn
+		if t <= 1e-5: return None
+		x = lightray(t)
+		offset = x - self.center
+		if self.open(offset*self.across, offset*self.up): return None
+		return CSG.NormalizedAnchoredVector(x, self.normal)
+	def passes(self, origins, directions):
+		"Which rays of a bundle ((N, 3) arrays) get past the stop: through the opening, or not meeting the plane ahead"
+		import numpy
+		origins = numpy.asarray(origins, dtype=float)
+		directions = numpy.asarray(directions, dtype=float)
+		normal = numpy.array(self.normal.components)
+		dn = directions.dot(normal)
+		with numpy.errstate(divide="ignore", invalid="ignore"):
+			t = (numpy.array(self.center.components) - origins).dot(normal)/dn
+		offset = origins + directions*t[:, numpy.newaxis] - self.center.components
+		x = offset.dot(self.across.components)
+		y = offset.dot(self.up.components)
+		if self.round: inside = x*x + y*y <= 0.25*self.width**2
+		else:
+			inside = numpy.abs(x) <= 0.5*self.width
+			if self.height is not None: inside &= numpy.abs(y) <= 0.5*self.height
+		return inside | ~(t > 1e-5)
+	def cull(self, rays):
+		"The LightRays that get past the stop, so that the others need not be traced at all"
+		keep = self.passes([r.location.components for r in rays], [r.direction.components for r in rays])
+		return [ray for ray, k in zip(rays, keep) if k]
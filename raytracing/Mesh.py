@@ -0,0 +1,251 @@
+"""
+Triangle mesh shapes, loaded from STL or OBJ files, for enclosures and lens mounts that the
+CSG primitives cannot describe:
+
+	housing = Mesh.load("housing.stl", scale=1.0)
+	system.append(Elements.Component(housing, Elements.Black()))
+	system.append(Elements.Component(Mesh.load("mount.obj"), Elements.Diffuse(0.05)))
+
+Intersections go through a bounding volume hierarchy (axis aligned boxes split at the
+median triangle), traversed for a whole bundle of rays at once with numpy, so a mesh of
+10^5 triangles costs a few dozen box tests per ray rather than 10^5 triangle tests.
+Triangle normals follow the winding (counterclockwise seen from outside), as in STL/OBJ.
+"""
+
+import struct
+
+import numpy
+
+import CSG
+
+EPSILON = 1e-5		# minimum distance of a forward intersection, as in CSG.Shape.firstintersection
+
+def readstl(filename):
+	"Vertices (V, 3) and triangles (F, 3) of a binary or ASCII STL file, with shared vertices merged"
+	with open(filename, "rb") as fd:
+		data = fd.read()
+	if len(data) >= 84:
+		count = struct.unpack("<I", data[80:84])[0]
+	if len(data) >= 84 and len(data) == 84 + 50*count:
+		records = numpy.frombuffer(data, dtype=numpy.dtype([("normal", "<f4", 3), ("vertices", "<f4", (3, 3)),
+								("attribute", "<u2")]), count=count, offset=84)
+		corners = records["vertices"].reshape(-1, 3).astype(float)
+	else:
+		corners = [[float(x) for x in line.split()[1:4]] for line in data.decode("ascii", "replace").splitlines()
+				if line.strip().startswith("vertex")]
+		corners = numpy.array(corners, dtype=float).reshape(-1, 3)
+	if len(corners) % 3:
+		raise ValueError("%s: not a whole number of triangles" % filename)
+	vertices, faces = numpy.unique(corners, axis=0, return_inverse=True)
+	return vertices, faces.reshape(-1, 3)
+
+def readobj(filename):
+	"Vertices (V, 3) and triangles (F, 3) of a Wavefront OBJ file; polygons are split into fans"
+	vertices = []
+	faces = []
+	with open(filename) as fd:
+		for line in fd:
+			fields = line.split()
+			if not fields: continue
+			if fields[0] == "v":
+				vertices.append([float(x) for x in fields[1:4]])
+			elif fields[0] == "f":
+				# v, v/vt, v//vn or v/vt/vn; negative indices count back from the last vertex
+				indices = [int(f.split("/")[0]) for f in fields[1:]]
+				indices = [i - 1 if i > 0 else len(vertices) + i for i in indices]
+				faces += [(indices[0], indices[k], indices[k+1]) for k in range(1, len(indices) - 1)]
+	return numpy.array(vertices, dtype=float).reshape(-1, 3), numpy.array(faces, dtype=int).reshape(-1, 3)
+
+def load(filename, scale=1.0, offset=(0, 0, 0)):
+	"A Mesh from an .stl or .obj file, its coordinates scaled and then offset"
+	if filename.lower().endswith(".obj"): vertices, faces = readobj(filename)
+	else: vertices, faces = readstl(filename)
+	return Mesh(vertices*scale + numpy.asarray(offset, dtype=float), faces)
+
+class Mesh(CSG.Shape):
+	"A triangle mesh; closed and consistently wound for __contains__ and outward normals"
+	def __init__(self, vertices, faces, leafsize=8):
+		self.vertices = numpy.asarray([tuple(v) for v in vertices], dtype=float).reshape(-1, 3)
+		self.faces = numpy.asarray([tuple(f) for f in faces], dtype=int).reshape(-1, 3)
+		self.leafsize = leafsize
+		self.build()
+	def __repr__(self):
+		return "Mesh (%d vertices, %d triangles)" % (len(self.vertices), len(self.faces))
+	def build(self):
+		"""The hierarchy as flat arrays: the box of every node (lo, hi), its children (left,
+		right; -1 for a leaf) and for leaves the range of triangles (start, count) in self.order"""
+		corners = self.vertices[self.faces]
+		centroids = corners.mean(axis=1)
+		lower = corners.min(axis=1)
+		upper = corners.max(axis=1)
+		order = numpy.arange(len(self.faces))
+		lo, hi, left, right, start, count = [], [], [], [], [], []
+		def node(first, last):
+			lo.append(lower[order[first:last]].min(axis=0))
+			hi.append(upper[order[first:last]].max(axis=0))
+			left.append(-1)
+			right.append(-1)
+			start.append(first)
+			count.append(last - first)
+			return len(lo) - 1
+		stack = [(node(0, len(order)), 0, len(order))] if len(order) else []
+		while stack:
+			index, first, last = stack.pop()
+			if last - first <= self.leafsize: continue
+			span = centroids[order[first:last]]
+			axis = numpy.argmax(span.max(axis=0) - span.min(axis=0))
+			middle = (last - first)//2
+			order[first:last] = order[first:last][numpy.argpartition(span[:, axis], middle)]
+			left[index] = node(first, first + middle)
+			right[index] = node(first + middle, last)
+			count[index] = 0
+			stack += [(left[index], first, first + middle), (right[index], first + middle, last)]
+		self.lo = numpy.array(lo).reshape(-1, 3)
+		self.hi = numpy.array(hi).reshape(-1, 3)
+		self.left = numpy.array(left, dtype=int)
+		self.right = numpy.array(right, dtype=int)
+		self.start = numpy.array(start, dtype=int)
+		self.count = numpy.array(count, dtype=int)
+		self.order = order
+		# triangles in hierarchy order: a corner and two edges each, for the Moller-Trumbore test
+		v0, v1, v2 = [corners[order, k] for k in range(3)]
+		self.v0 = v0
+		self.e1 = v1 - v0
+		self.e2 = v2 - v0
+		normals = numpy.cross(self.e1, self.e2)
+		with numpy.errstate(invalid="ignore", divide="ignore"):
+			self.normals = normals/numpy.linalg.norm(normals, axis=1)[:, numpy.newaxis]
+	def traverse(self, origins, directions, tmin=EPSILON, tmax=numpy.inf, first=True):
+		"""Ray/triangle hits of a bundle of rays (N, 3 arrays) between tmin and tmax.
+		first: the nearest hit per ray, as (t, triangle) arrays with t inf and triangle -1
+		on a miss; otherwise every hit, as (ray, t, triangle) arrays. Triangles are indices
+		into the hierarchy order (self.normals, self.order).
+
+		The hierarchy is walked a level at a time for all (ray, node) pairs together: the
+		pairs whose ray misses the node's box (or only meets it beyond the ray's nearest hit
+		so far) are dropped, leaves are tested against their triangles and the other nodes
+		are replaced by their two children."""
+		origins = numpy.asarray(origins, dtype=float).reshape(-1, 3)
+		directions = numpy.asarray(directions, dtype=float).reshape(-1, 3)
+		with numpy.errstate(divide="ignore"):
+			inverse = 1.0/directions
+		best = numpy.full(len(origins), tmax, dtype=float)
+		triangle = numpy.full(len(origins), -1, dtype=int)
+		hits = []
+		rays = numpy.arange(len(origins)) if len(self.lo) else numpy.zeros(0, dtype=int)
+		nodes = numpy.zeros(len(rays), dtype=int)
+		slots = numpy.arange(self.count.max() if len(self.count) else 0)
+		while len(rays):
+			# slab test of every pair
+			with numpy.errstate(invalid="ignore"):
+				t1 = (self.lo[nodes] - origins[rays])*inverse[rays]
+				t2 = (self.hi[nodes] - origins[rays])*inverse[rays]
+				near = numpy.nanmax(numpy.minimum(t1, t2), axis=1)
+				far = numpy.nanmin(numpy.maximum(t1, t2), axis=1)
+			keep = (near <= far) & (far >= tmin) & (near <= best[rays])
+			rays = rays[keep]
+			nodes = nodes[keep]
+			leaf = self.left[nodes] < 0
+			if leaf.any():
+				# every triangle of every leaf pair
+				candidates = self.start[nodes[leaf], numpy.newaxis] + slots
+				used = slots < self.count[nodes[leaf], numpy.newaxis]
+				r = numpy.broadcast_to(rays[leaf, numpy.newaxis], used.shape)[used]
+				k = candidates[used]
+				t, valid = self.mollertrumbore(origins[r], directions[r], k, tmin, tmax)
+				r, t, k = r[valid], t[valid], k[valid]
+				if first:
+					numpy.minimum.at(best, r, t)
+					nearest = t == best[r]
+					triangle[r[nearest]] = k[nearest]
+				else:
+					hits.append((r, t, k))
+			inner = ~leaf
+			rays = numpy.concatenate([rays[inner], rays[inner]])
+			nodes = numpy.concatenate([self.left[nodes[inner]], self.right[nodes[inner]]])
+		if first:
+			best[triangle < 0] = numpy.inf
+			return best, triangle
+		if not hits: return numpy.zeros(0, dtype=int), numpy.zeros(0), numpy.zeros(0, dtype=int)
+		return tuple(numpy.concatenate(column) for column in zip(*hits))
+	def mollertrumbore(self, o, d, k, tmin, tmax):
+		"Parameters of the ray/triangle intersections for rays (o, d) and triangles k (arrays), and which are hits"
+		e1 = self.e1[k]
+		e2 = self.e2[k]
+		p = numpy.cross(d, e2)
+		determinant = (e1*p).sum(axis=1)
+		with numpy.errstate(divide="ignore", invalid="ignore"):
+			inverse = 1.0/determinant
+			s = o - self.v0[k]
+			u = (s*p).sum(axis=1)*inverse
+			q = numpy.cross(s, e1)
+			v = (d*q).sum(axis=1)*inverse
+			t = (e2*q).sum(axis=1)*inverse
+			valid = (determinant != 0) & (u >= 0) & (v >= 0) & (u + v <= 1) & (t > tmin) & (t < tmax)
+		return t, valid
+	def bundlefirstintersection(self, origins, directions, epsilon=EPSILON):
+		"""The nearest forward intersection of each ray of a bundle: its parameter (inf on a
+		miss) and the triangle normal there (N, 3; nan on a miss)"""
+		t, triangle = self.traverse(origins, directions, tmin=epsilon)
+		normals = numpy.vstack([self.normals, [(numpy.nan,)*3]])
+		return t, normals[triangle]
+	def nearest(self, o, d, tmin=EPSILON):
+		"""The nearest hit (t, triangle) of a single ray (origin and direction as tuples), or None:
+		the hierarchy is walked depth first with plain floats, nearer child first, skipping
+		boxes beyond the nearest hit so far. Quicker than traverse() for one ray at a time."""
+		if not hasattr(self, "lists"):
+			self.lists = [a.tolist() for a in (self.lo, self.hi, self.left, self.right, self.start, self.count,
+											self.v0, self.e1, self.e2)]
+		lo, hi, left, right, start, count, v0, e1, e2 = self.lists
+		inverse = [1.0/x if x != 0 else float("inf") for x in d]
+		def box(index, best):
+			near, far = tmin, best
+			for axis in range(3):
+				if d[axis] == 0:
+					if not lo[index][axis] <= o[axis] <= hi[index][axis]: return None
+					continue
+				t1 = (lo[index][axis] - o[axis])*inverse[axis]
+				t2 = (hi[index][axis] - o[axis])*inverse[axis]
+				if t1 > t2: t1, t2 = t2, t1
+				if t1 > near: near = t1
+				if t2 < far: far = t2
+				if near > far: return None
+			return near
+		best, found = float("inf"), None
+		stack = [(0.0, 0)] if lo else []
+		while stack:
+			near, index = stack.pop()
+			if near > best: continue
+			if left[index] < 0:
+				for k in range(start[index], start[index] + count[index]):
+					(ax, ay, az), (bx, by, bz), (cx, cy, cz) = v0[k], e1[k], e2[k]
+					px, py, pz = d[1]*cz - d[2]*cy, d[2]*cx - d[0]*cz, d[0]*cy - d[1]*cx
+					determinant = bx*px + by*py + bz*pz
+					if determinant == 0: continue
+					sx, sy, sz = o[0] - ax, o[1] - ay, o[2] - az
+					u = (sx*px + sy*py + sz*pz)/determinant
+					if u < 0 or u > 1: continue
+					qx, qy, qz = sy*bz - sz*by, sz*bx - sx*bz, sx*by - sy*bx
+					v = (d[0]*qx + d[1]*qy + d[2]*qz)/determinant
+					if v < 0 or u + v > 1: continue
+					t = (cx*qx + cy*qy + cz*qz)/determinant
+					if tmin < t < best: best, found = t, k
+				continue
+			children = [(box(child, best), child) for child in (left[index], right[index])]
+			# the nearer child is popped first
+			children = sorted([c for c in children if c[0] is not None], reverse=True)
+			stack += children
+		return None if found is None else (best, found)
+	def firstintersection(self, ray):
+		hit = self.nearest(ray.location.components, ray.direction.components)
+		if hit is None: return None
+		return CSG.NormalizedAnchoredVector(ray(hit[0]), CSG.Vector(self.normals[hit[1]].tolist()))
+	def intersections(self, ray):
+		"Every crossing of the ray's line with the mesh, behind the origin too"
+		rays, ts, triangles = self.traverse([ray.location.components], [ray.direction.components],
+									tmin=-numpy.inf, first=False)
+		return [CSG.NormalizedAnchoredVector(ray(float(t)), CSG.Vector(self.normals[k].tolist())) for t, k in zip(ts, triangles)]
+	def __contains__(self, x):
+		# an odd number of crossings along a direction unlikely to graze an edge
+		rays, ts, triangles = self.traverse([x.components], [(0.5773, 0.5774, 0.5773)], tmin=0.0, first=False)
+		return len(ts) % 2 == 1
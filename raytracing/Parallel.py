@@ -0,0 +1,135 @@
+"""
+Tracing of large ray bundles on all cores: the bundle is split into chunks that a pool of
+processes traces with Bundles.trace, each worker adding its detector hits into its own
+histogram in shared memory; the histograms are summed at the end.
+
+	executor = Parallel.Executor(design.scene(), edges=numpy.linspace(400e-9, 800e-9, 41), detectors=[0])
+	histogram = executor.run(Bundles.Bundle.fromrays(rays))
+
+The scene goes to each worker once, as its Scene description, when the pool starts; the
+rays are copied once into shared memory, and a task is just the range of rays of a chunk,
+so neither rays nor results are pickled per chunk. For ray counts too large to hold at
+all, stream() has each worker make its chunks itself from a source such as
+Bundles.FanSource and trace them with Bundles.stream, so memory is bounded by the chunk:
+
+	source = Bundles.FanSource(location, axis, 10.0, (400e-9, 800e-9))
+	histogram = executor.stream(source, 10**9)
+"""
+
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+import numpy
+
+import Bundles
+import Scene
+
+class SharedArrays:
+	"numpy arrays in one block of shared memory, opened by name in other processes"
+	def __init__(self, layout, name=None):
+		self.layout = [(key, tuple(shape), numpy.dtype(dtype).str) for key, shape, dtype in layout]
+		size = sum(int(numpy.prod(shape))*numpy.dtype(dtype).itemsize for key, shape, dtype in self.layout)
+		if name is None: self.memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+		else: self.memory = shared_memory.SharedMemory(name=name)
+		self.arrays = {}
+		offset = 0
+		for key, shape, dtype in self.layout:
+			self.arrays[key] = numpy.ndarray(shape, dtype=dtype, buffer=self.memory.buf, offset=offset)
+			offset += int(numpy.prod(shape))*numpy.dtype(dtype).itemsize
+	def __getitem__(self, key):
+		return self.arrays[key]
+	def description(self):
+		return self.layout, self.memory.name
+	def close(self, unlink=False):
+		self.arrays = {}
+		self.memory.close()
+		if unlink: self.memory.unlink()
+
+# the state of a worker process, set up once by _start
+_worker = {}
+
+def _start(scene, depth, edges, detectors, inputs, outputs, counter, source=None, chunk=None):
+	with counter.get_lock():
+		slot = counter.value
+		counter.value += 1
+	_worker["system"] = Scene.Scene.fromdict(scene).system()
+	_worker["depth"] = depth
+	_worker["inputs"] = SharedArrays(*inputs)
+	_worker["source"] = source
+	_worker["chunk"] = chunk
+	_worker["outputs"] = SharedArrays(*outputs)
+	_worker["histogram"] = Bundles.Histogram(edges, detectors, _worker["outputs"]["power"][slot],
+											_worker["outputs"]["count"][slot])
+
+def _chunk(bounds):
+	start, stop = bounds
+	inputs = _worker["inputs"]
+	bundle = Bundles.Bundle(inputs["origins"][start:stop], inputs["directions"][start:stop],
+						inputs["wavelengths"][start:stop], inputs["powers"][start:stop],
+						numpy.arange(start, stop), inputs["origins"].dtype)
+	Bundles.trace(_worker["system"], bundle, _worker["depth"], _worker["histogram"])
+	return stop - start
+
+def _stream(bounds):
+	start, stop = bounds
+	source = _worker["source"]
+	Bundles.stream(_worker["system"], lambda i, j: source(start + i, start + j), stop - start, _worker["histogram"],
+				_worker["depth"], _worker["chunk"])
+	return stop - start
+
+class Executor:
+	"Traces bundles of a scene's components in a pool of processes, into detector histograms"
+	def __init__(self, scene, edges, detectors, depth=8, processes=None, chunk=65536):
+		self.scene = scene
+		self.edges = numpy.asarray(edges, dtype=float)
+		self.detectors = list(detectors)
+		self.depth = depth
+		self.processes = processes or os.cpu_count() or 1
+		self.chunk = chunk
+	def __repr__(self):
+		return "Executor(%r, %d processes, chunks of %d rays)" % (self.scene, self.processes, self.chunk)
+	def run(self, bundle, log=None):
+		"The Bundles.Histogram of all rays of the bundle"
+		n = len(bundle)
+		inputs = SharedArrays([("origins", (n, 3), bundle.dtype), ("directions", (n, 3), bundle.dtype),
+							("wavelengths", (n,), bundle.dtype), ("powers", (n,), bundle.dtype)])
+		try:
+			for key, values in (("origins", bundle.origins), ("directions", bundle.directions),
+								("wavelengths", bundle.wavelengths), ("powers", bundle.powers)):
+				inputs[key][...] = values
+			return self.reduce(_chunk, [(start, min(start + self.chunk, n)) for start in range(0, n, self.chunk)],
+							n, inputs, None, log)
+		finally:
+			inputs.close(unlink=True)
+	def stream(self, source, count, tasks=None, log=None):
+		"""The Bundles.Histogram of count rays made by source(start, stop) in the workers,
+		which trace them chunk by chunk; the work is split into tasks ranges of rays
+		(four per process by default)"""
+		tasks = tasks or 4*self.processes
+		size = max(-(-count//tasks), 1)
+		inputs = SharedArrays([])
+		try:
+			return self.reduce(_stream, [(start, min(start + size, count)) for start in range(0, count, size)],
+							count, inputs, source, log)
+		finally:
+			inputs.close(unlink=True)
+	def reduce(self, function, ranges, n, inputs, source, log):
+		"Run function over the ranges of rays in the pool and sum the workers' histograms"
+		bins = len(self.edges) - 1
+		outputs = SharedArrays([("power", (self.processes, len(self.detectors), bins), float),
+							("count", (self.processes, len(self.detectors), bins), float)])
+		try:
+			outputs["power"][...] = 0
+			outputs["count"][...] = 0
+			counter = multiprocessing.Value("i", 0)
+			with multiprocessing.Pool(self.processes, _start, (self.scene.todict(), self.depth, self.edges,
+					self.detectors, inputs.description(), outputs.description(), counter, source, self.chunk)) as pool:
+				done = 0
+				for count in pool.imap_unordered(function, ranges):
+					done += count
+					if log: log("%d/%d rays" % (done, n))
+			return Bundles.Histogram(self.edges, self.detectors, outputs["power"].sum(axis=0),
+									outputs["count"].sum(axis=0))
+		finally:
+			outputs.close(unlink=True)
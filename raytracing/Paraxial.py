@@ -0,0 +1,196 @@
+"""
+First order (paraxial) optics: ray transfer (ABCD) matrices of spherical lenses and a
+prism deviation model, for screening designs long before an exact trace.
+
+A paraxial ray is (height, angle) relative to the optical axis; matrices are 2x2 tuples
+((A, B), (C, D)) and a system is the product of its elements' matrices in reverse order.
+Lens radii follow CSG.SphericalLens: radius1 > 0 is a first surface convex towards the
+incoming light, radius2 > 0 a second surface convex towards the outgoing light.
+
+	model = Paraxial.FirstOrder(Designs.designs["prism2"])
+	model.summary()       # focal lengths, image distances, deviation angles and dispersion
+
+The dispersion of the summary is measured after the objective, like Designs.dispersion of
+an exact trace, so that screened and traced sweeps can be compared.
+"""
+
+import math
+
+degrees = math.pi/180
+
+def multiply(m1, m2):
+	"The matrix product m1 m2 (m2 acts first)"
+	(a1, b1), (c1, d1) = m1
+	(a2, b2), (c2, d2) = m2
+	return ((a1*a2 + b1*c2, a1*b2 + b1*d2), (c1*a2 + d1*c2, c1*b2 + d1*d2))
+
+def chain(*matrices):
+	"The matrix of elements passed in order"
+	result = ((1.0, 0.0), (0.0, 1.0))
+	for m in matrices:
+		result = multiply(m, result)
+	return result
+
+def translation(distance):
+	return ((1.0, float(distance)), (0.0, 1.0))
+
+def refraction(radius, n1, n2):
+	"A spherical surface of the given radius (positive: centre after the surface) from index n1 to n2"
+	if radius == 0 or abs(radius) == float("inf"): power = 0.0
+	else: power = (n2 - n1)/float(radius)
+	return ((1.0, 0.0), (-power/n2, n1/float(n2)))
+
+def thicklens(radius1, radius2, thickness, n, n0=1.0):
+	"Vertex to vertex matrix of a lens with radii in the sign convention of CSG.SphericalLens"
+	return chain(refraction(radius1, n0, n), translation(thickness), refraction(-radius2, n, n0))
+
+def focallength(m):
+	"Effective focal length of a system matrix (inf for an afocal system)"
+	c = m[1][0]
+	return float("inf") if c == 0 else -1.0/c
+
+def imagedistance(m):
+	"Distance after the system at which the object (at the system's entrance plane) is imaged"
+	(a, b), (c, d) = m
+	return float("inf") if d == 0 else -b/float(d)
+
+def minimumdeviation(n, apex):
+	"Deviation (degrees) of a prism with the given apex angle (degrees) at minimum deviation"
+	return 2*math.asin(n*math.sin(apex*degrees/2))/degrees - apex
+
+def refract(d, normal, eta):
+	"""Refract the 2D unit direction d at a surface with unit normal (pointing against d)
+	for the index ratio eta = n1/n2; None on total internal reflection"""
+	cosi = -(d[0]*normal[0] + d[1]*normal[1])
+	k = 1 - eta**2*(1 - cosi**2)
+	if k < 0: return None
+	f = eta*cosi - math.sqrt(k)
+	return (eta*d[0] + f*normal[0], eta*d[1] + f*normal[1])
+
+def slab(origin, d, planes, exclude=None):
+	"""Entry and exit parameters of the line origin + t d through a convex polygon of
+	planes (point, outward normal), with the entry and exit plane indices; the plane
+	exclude (the one a ray starts on) is skipped"""
+	tin, tout, iin, iout = -float("inf"), float("inf"), None, None
+	for i, ((px, pz), (nx, nz)) in enumerate(planes):
+		if i == exclude: continue
+		dn = d[0]*nx + d[1]*nz
+		distance = (px - origin[0])*nx + (pz - origin[1])*nz
+		if dn == 0:
+			if distance < 0: return None
+			continue
+		t = distance/dn
+		if dn < 0 and t > tin: tin, iin = t, i
+		if dn > 0 and t < tout: tout, iout = t, i
+	if tin >= tout: return None
+	return tin, tout, iin, iout
+
+class FirstOrder:
+	"First order model of a Designs.PrismDesign: collimator, prism and objective along the unfolded axis"
+	def __init__(self, design, minimum=False):
+		self.design = design
+		self.minimum = minimum
+		glass = design.glasses[design.glass]
+		self.glass = glass
+		self.lensglass = design.glasses["BK7"]
+		# the prism faces in the xz plane, as built by Designs.equilateralprism
+		ox, oy, oz = design.prismoffset
+		self.faces = []
+		for angle in 0, 120, 240:
+			nx, nz = -math.cos(angle*degrees), math.sin(angle*degrees)
+			self.faces.append(((nx*design.baselen/3 + ox, nz*design.baselen/3 + oz), (nx, nz)))
+	def __repr__(self):
+		return "FirstOrder(%r%s)" % (self.design, ", minimum deviation" if self.minimum else "")
+	def axis(self, angle):
+		return (math.sin(angle*degrees), math.cos(angle*degrees))
+	def objectivedistance(self):
+		"Distance of the objective from the prism along the outgoing axis"
+		location = self.design.objectiveposition
+		if isinstance(location, (tuple, list)):
+			dx, dz = self.axis(self.design.outgoingaxisangle)
+			return location[0]*dx + location[2]*dz
+		return location
+	def lens(self, name, wavelength):
+		"Vertex to vertex matrix of the 'collimator' or 'objective' lens"
+		r1, r2, thickness, diameter = getattr(self.design, name)
+		return thicklens(r1, r2, thickness, self.lensglass.refractiveindex(wavelength))
+	def system(self, wavelength):
+		"Matrix from the source to the last lens vertex"
+		d = self.design
+		r1, r2, t1, diameter = d.collimator
+		elements = [translation(d.collimatordistance - t1/2.0 - d.sourcedistance), self.lens("collimator", wavelength)]
+		if d.objective:
+			r1, r2, t2, diameter = d.objective
+			# the path through the prism is taken as a thin element at the origin
+			elements += [translation(-d.collimatordistance - t1/2.0 + self.objectivedistance() - t2/2.0),
+						self.lens("objective", wavelength)]
+		return chain(*elements)
+	def prism(self, wavelength):
+		"""The point (x, z) where the axial ray leaves the prism and its angle (degrees, as
+		atan2(x, z)) there, or None if it misses the prism or is totally reflected inside it.
+		With minimum, the prism deviates the ray as at minimum deviation, at the origin."""
+		d = self.design
+		n = self.glass.refractiveindex(wavelength)
+		if self.minimum:
+			return (0.0, 0.0), d.incidentaxisangle - minimumdeviation(n, 60.0)
+		direction = self.axis(d.incidentaxisangle)
+		origin = (-1e3*direction[0], -1e3*direction[1])
+		hit = slab(origin, direction, self.faces)
+		if hit is None: return None
+		tin, tout, iin, iout = hit
+		entry = (origin[0] + tin*direction[0], origin[1] + tin*direction[1])
+		inside = refract(direction, self.faces[iin][1], 1.0/n)
+		if inside is None: return None
+		hit = slab(entry, inside, self.faces, exclude=iin)
+		if hit is None: return None
+		tin, tout, iin, iout = hit
+		nx, nz = self.faces[iout][1]
+		outside = refract(inside, (-nx, -nz), n)
+		if outside is None: return None
+		return (entry[0] + tout*inside[0], entry[1] + tout*inside[1]), math.atan2(outside[0], outside[1])/degrees
+	def direction(self, wavelength):
+		"Angle (degrees, as atan2(x, z)) of the axial ray after the prism, or nan (see prism())"
+		exit = self.prism(wavelength)
+		return float("nan") if exit is None else exit[1]
+	def outgoing(self, wavelength):
+		"""Angle (degrees) of the axial ray after the objective, as a paraxial ray through it
+		from where it leaves the prism; the angle after the prism without an objective"""
+		d = self.design
+		exit = self.prism(wavelength)
+		if exit is None: return float("nan")
+		(x, z), angle = exit
+		if not d.objective: return angle
+		r1, r2, thickness, diameter = d.objective
+		axis = d.outgoingaxisangle
+		ax, az = self.axis(axis)
+		location = d.objectivelocation().components
+		# the ray's height and angle relative to the objective's axis, in the plane of its centre
+		distance = (location[0] - x)*ax + (location[2] - z)*az
+		u = (angle - axis)*degrees
+		height = (x - location[0])*az - (z - location[2])*ax + distance*math.tan(u)
+		m = chain(translation(-thickness/2.0), self.lens("objective", wavelength), translation(-thickness/2.0))
+		return axis + (m[1][0]*height + m[1][1]*u)/degrees
+	def summary(self, wavelengths=None):
+		"""Focal lengths, image distances and angles after the prism and after the objective per
+		wavelength, and the angular dispersion of the latter as in Designs.dispersion"""
+		if wavelengths is None:
+			start, stop, num = self.design.wavelengths
+			wavelengths = [start + (stop-start)*i/float(max(num-1, 1)) for i in range(num)]
+		result = dict(wavelengths=list(wavelengths), collimatorfocus=[], objectivefocus=[],
+					imagedistance=[], angles=[], outgoing=[])
+		for wl in wavelengths:
+			result["collimatorfocus"].append(focallength(self.lens("collimator", wl)))
+			if self.design.objective:
+				result["objectivefocus"].append(focallength(self.lens("objective", wl)))
+			result["imagedistance"].append(imagedistance(self.system(wl)))
+			result["angles"].append(self.direction(wl))
+			result["outgoing"].append(self.outgoing(wl))
+		angles = result["angles"]
+		result["prismdispersion"] = abs(angles[-1] - angles[0])
+		result["dispersion"] = abs(result["outgoing"][-1] - result["outgoing"][0])
+		if self.design.objective:
+			# separation of the extreme wavelengths in the focal plane of the objective
+			f = result["objectivefocus"][len(wavelengths)//2]
+			axis = self.design.outgoingaxisangle
+			result["lineardispersion"] = abs(f*(math.tan((angles[-1]-axis)*degrees) - math.tan((angles[0]-axis)*degrees)))
+		return result
@@ -0,0 +1,49 @@
+"""
+Plots of ray traces in the xz plane, one colour per wavelength. matplotlib is imported
+when a plot is made, not when this module is imported.
+"""
+
+def wlcolor(wl):
+	"Approximate display colour of a wavelength (m)"
+	wl = wl*1e9
+	colortable = [(300, 0, 0, 0), (400, 255, 0, 255), (436, 0, 0, 255),
+		(480, 0, 255, 255), (550, 0, 255, 0), (590, 255, 255, 0), 
+		(635, 255, 0, 0), (900, 0, 0, 0), (1000, 0, 0, 0)]
+	last = (0, 0, 0, 0)
+	for current in colortable:
+		if current[0] >= wl: break
+		last = current
+	wl1, r1, g1, b1 = last
+	wl2, r2, g2, b2 = current
+	t = float(wl-wl1)/float(wl2-wl1)
+	r = (1-t)*r1 + t*r2
+	g = (1-t)*g1 + t*g2
+	b = (1-t)*b1 + t*b2
+	return "#%02x%02x%02x"%(int(r), int(g), int(b))
+
+def dumptrace(trace, color="red", axes=None):
+	"Draw every segment of a trace tree"
+	if axes is None:
+		from matplotlib import pyplot
+		axes = pyplot.gca()
+	node, children = trace
+	for child in children:
+		childnode = child[0]
+		axes.plot([node[2], childnode[2]], [node[0], childnode[0]], color)
+		dumptrace(child, color, axes)
+
+def plotdesign(design, depth=8, nangles=11, nwavelengths=None, log=print):
+	"Trace the source rays of a Designs.PrismDesign through its system and show them"
+	from matplotlib import pyplot
+	system = design.system()
+	rays = design.sourcerays(nangles, nwavelengths)
+	axes = pyplot.subplot(111, facecolor="black")
+	axes.axis("equal")
+	for i in range(len(rays)):
+		if log: log("processing %d / %d" % (i+1, len(rays)))
+		ray = rays[i]
+		trace = ray.trace(system, depth=depth)
+		dumptrace(trace, wlcolor(ray.wavelength), axes)
+		pyplot.show(block=False)
+		pyplot.draw()
+	pyplot.show()
@@ -0,0 +1,373 @@
+"""
+Serializable optical scenes, their content hash, and an on-disk cache of trace results.
+
+A scene is a list of named components and the source rays; it converts to and from
+plain dictionaries (and JSON files), with vectors as lists and every shape, material
+and component as {"type": ..., fields}. The hash of its canonical JSON identifies the
+scene, so the segment table of a trace can be cached on disk and returned at once when
+the same scene is traced again:
+
+	scene = Scene.Scene(design.components(), design.sourcerays())
+	cache = Scene.TraceCache("~/.cache/raytracing")
+	table = cache.trace(scene, depth=8)      # traced once, then read back
+	table.paths()
+
+When one component moves, only the rays it affects are propagated again:
+
+	moved = scene.replace("objective", Elements.Component(shape, Designs.BK7))
+	table = moved.retrace(table, "objective")
+
+Scenes with scattering materials (Elements.Diffuse) trace differently every time, as
+their random generators advance, so the cache traces them afresh instead of storing
+them, and a retrace of such a scene is a full trace.
+"""
+
+import hashlib
+import json
+import os
+
+import CSG
+import Elements
+import Mesh
+import Surfaces
+
+# serializable classes and the constructor arguments stored for each
+TYPES = dict(
+	HalfSpace = (CSG.HalfSpace, ("center", "normal")),
+	Sphere = (CSG.Sphere, ("center", "radius")),
+	Cylinder = (CSG.Cylinder, ("center", "axis", "radius")),
+	ConvexPolyhedron = (CSG.ConvexPolyhedron, ("halfspaces",)),
+	Mesh = (Mesh.Mesh, ("vertices", "faces")),
+	EvenAsphere = (Surfaces.EvenAsphere, ("vertex", "axis", "radius", "conic", "coefficients")),
+	Toroid = (Surfaces.Toroid, ("vertex", "axis", "up", "radiusx", "radiusy")),
+	Intersection = (CSG.Intersection, ("shape1", "shape2")),
+	Union = (CSG.Union, ("shape1", "shape2")),
+	Without = (CSG.Without, ("shape1", "shape2")),
+	Difference = (CSG.Difference, ("shape1", "shape2")),
+	Translation = (CSG.Translation, ("shape", "offset")),
+	Rotation = (CSG.Rotation, ("shape", "axis", "angle")),
+	Material = (Elements.Material, ()),
+	Absorber = (Elements.Absorber, ()),
+	Mirror = (Elements.Mirror, ()),
+	Black = (Elements.Black, ()),
+	Diffuse = (Elements.Diffuse, ("reflectance", "seed")),
+	Sellmeier = (Elements.Sellmeier, ("B1", "B2", "B3", "C1", "C2", "C3")),
+	Sample = (Elements.Sample, ("wavelengths", "coefficients", "index")),
+	Grating = (Elements.Grating, ("density", "orders", "transmission", "grooves")),
+	Component = (Elements.Component, ("shape", "material")),
+	Aperture = (Elements.Aperture, ("center", "normal", "width", "height", "up", "round")),
+)
+
+def todict(obj):
+	"Plain (JSON compatible) description of a vector, shape, material or component"
+	if isinstance(obj, CSG.Vector): return list(obj.components)
+	if obj is None or isinstance(obj, (bool, int, float)): return obj
+	if hasattr(obj, "tolist"): return obj.tolist()
+	if isinstance(obj, (list, tuple)): return [todict(x) for x in obj]
+	for cls in type(obj).__mro__:
+		# subclasses such as CSG.Sheet are stored as the class they are built from
+		if cls.__name__ in TYPES and TYPES[cls.__name__][0] is cls:
+			result = dict(type=cls.__name__)
+			for name in TYPES[cls.__name__][1]:
+				result[name] = todict(getattr(obj, name))
+			return result
+	raise Exception("cannot serialize %r" % (obj,))
+
+def fromdict(description):
+	"The object described by a todict() result"
+	if isinstance(description, list):
+		if all(isinstance(x, (int, float)) for x in description): return CSG.Vector(description)
+		return [fromdict(x) for x in description]
+	if not isinstance(description, dict): return description
+	cls, fields = TYPES[description["type"]]
+	return cls(*[fromdict(description[name]) for name in fields])
+
+def canonical(data):
+	"JSON text that is the same for equal descriptions (floats are written exactly)"
+	return json.dumps(data, sort_keys=True, separators=(",", ":"))
+
+class Scene:
+	"Named components and source rays"
+	def __init__(self, components, rays=()):
+		self.components = [c if isinstance(c, tuple) else ("component %d" % i, c) for i, c in enumerate(components)]
+		self.rays = list(rays)
+	def __repr__(self):
+		return "Scene(%s; %d rays)" % (", ".join(name for name, c in self.components), len(self.rays))
+	def system(self):
+		return [component for name, component in self.components]
+	def todict(self):
+		return dict(components=[dict(name=name, component=todict(c)) for name, c in self.components],
+					rays=[todict(r.location) + todict(r.direction) + [r.wavelength, r.power] for r in self.rays])
+	@classmethod
+	def fromdict(cls, description):
+		components = [(c["name"], fromdict(c["component"])) for c in description["components"]]
+		rays = [Elements.LightRay(CSG.Vector(r[0:3]), CSG.Vector(r[3:6]), *r[6:8]) for r in description["rays"]]
+		return cls(components, rays)
+	def save(self, filename):
+		with open(filename, "w") as fd:
+			json.dump(self.todict(), fd, indent=1)
+	@classmethod
+	def load(cls, filename):
+		with open(filename) as fd:
+			return cls.fromdict(json.load(fd))
+	def hash(self):
+		"SHA-256 of the canonical description"
+		return hashlib.sha256(canonical(self.todict()).encode("utf-8")).hexdigest()
+	def trace(self, depth=8):
+		return SegmentTable.trace(self.system(), self.rays, depth)
+	def stochastic(self):
+		"Whether the scene has scattering materials, whose traces depend on their random state"
+		return stochastic(self.system())
+	def index(self, name):
+		return [n for n, c in self.components].index(name)
+	def replace(self, name, component):
+		"A copy of the scene with the named component replaced (moved, say)"
+		i = self.index(name)
+		return Scene(self.components[:i] + [(name, component)] + self.components[i+1:], self.rays)
+	def retrace(self, table, name):
+		"""The trace of this scene from the table of a scene that differed in the named
+		component only, propagating again just the rays that change (SegmentTable.retrace)"""
+		return table.retrace(self.system(), self.index(name))
+
+def stochastic(components):
+	return any(component.material.scattering for component in components)
+
+def bounds(shape):
+	"A bounding sphere (center, radius) of a shape, or None if it is unbounded"
+	if isinstance(shape, CSG.Sphere): return shape.center, shape.radius
+	if isinstance(shape, CSG.Intersection):
+		# either bound holds; the smaller one is kept
+		candidates = [b for b in (bounds(shape.shape1), bounds(shape.shape2)) if b is not None]
+		return min(candidates, key=lambda b: b[1]) if candidates else None
+	if isinstance(shape, (CSG.Union, CSG.Difference)):
+		b1, b2 = bounds(shape.shape1), bounds(shape.shape2)
+		if b1 is None or b2 is None: return None
+		distance = (b2[0] - b1[0]).norm()
+		if distance + b2[1] <= b1[1]: return b1
+		if distance + b1[1] <= b2[1]: return b2
+		radius = (distance + b1[1] + b2[1])/2
+		return b1[0] + (b2[0] - b1[0])*((radius - b1[1])/distance), radius
+	if isinstance(shape, CSG.Without): return bounds(shape.shape1)
+	if isinstance(shape, CSG.Translation):
+		b = bounds(shape.shape)
+		return None if b is None else (b[0] + shape.offset, b[1])
+	if isinstance(shape, Mesh.Mesh) and len(shape.lo):
+		lo, hi = shape.lo[0], shape.hi[0]
+		return CSG.Vector([float(x) for x in (lo + hi)/2]), float(sum((h - l)**2 for h, l in zip(hi, lo))**0.5)/2
+	if isinstance(shape, CSG.Rotation):
+		b = bounds(shape.shape)
+		return None if b is None else (shape.rotate_fw(b[0]), b[1])
+	return None
+
+class SegmentTable:
+	"""The rays of a trace, one row per ray (the sources and every ray they spawn): its
+	source ray, the row of its parent, the component it hits next, its depth, origin,
+	direction, the point it hits (nan where it hits nothing), wavelength and power. Rows are in the order of
+	LightRay.trace's depth first recursion, children after their parent. The component
+	is -1 where a ray hits nothing and -2 where the depth ran out before it was traced."""
+	NONE = -1
+	UNTRACED = -2
+	columns = ("source", "parent", "component", "depth", "origin", "direction", "end", "wavelength", "power")
+	def __init__(self, source, parent, component, depth, origin, direction, end, wavelength, power):
+		self.source = source
+		self.parent = parent
+		self.component = component
+		self.depth = depth
+		self.origin = origin
+		self.direction = direction
+		self.end = end
+		self.wavelength = wavelength
+		self.power = power
+	def __repr__(self):
+		return "SegmentTable(%d rays)" % len(self)
+	def __len__(self):
+		return len(self.source)
+	@classmethod
+	def _visit(cls, rows, components, ray, source, parent, depth):
+		"Append the rows of a ray and the rays it spawns, as LightRay.trace follows them"
+		row = [source, parent, cls.UNTRACED, depth, ray.location.components, ray.direction.components,
+			(float("nan"),)*3, ray.wavelength, ray.power]
+		index = len(rows)
+		rows.append(row)
+		if depth <= 0: return
+		# the nearest intersecting component, as LightRay.propagate finds it
+		intersects = [(i, co.firstintersection(ray)) for i, co in enumerate(components)]
+		intersects = [x for x in intersects if x[1] is not None]
+		if not intersects:
+			row[2] = cls.NONE
+			return
+		i, intersection = min(intersects, key=lambda x: (ray.location - x[1].location).norm())
+		row[2] = i
+		row[6] = intersection.location.components
+		for newray in components[i].interact(ray):
+			cls._visit(rows, components, newray, source, index, depth-1)
+	@classmethod
+	def _fromrows(cls, rows):
+		import numpy
+		columns = list(zip(*rows)) if rows else [()]*9
+		return cls(numpy.array(columns[0], dtype=int), numpy.array(columns[1], dtype=int),
+				numpy.array(columns[2], dtype=int), numpy.array(columns[3], dtype=int),
+				numpy.array(columns[4], dtype=float).reshape(-1, 3), numpy.array(columns[5], dtype=float).reshape(-1, 3),
+				numpy.array(columns[6], dtype=float).reshape(-1, 3), numpy.array(columns[7], dtype=float),
+				numpy.array(columns[8], dtype=float))
+	@classmethod
+	def trace(cls, components, rays, depth=8):
+		rows = []
+		for source, ray in enumerate(rays):
+			cls._visit(rows, components, ray, source, -1, depth)
+		return cls._fromrows(rows)
+	def ray(self, row):
+		"The LightRay of a row, exactly as it was traced"
+		# built without the constructor, which would normalize the direction once more
+		ray = Elements.LightRay.__new__(Elements.LightRay)
+		ray.location = CSG.Vector(float(x) for x in self.origin[row])
+		ray.direction = CSG.Vector(float(x) for x in self.direction[row])
+		ray.wavelength = float(self.wavelength[row])
+		ray.power = float(self.power[row])
+		return ray
+	def retrace(self, components, changed):
+		"""The trace of a system that differs from the traced one in the component at index
+		changed only. A ray keeps its old outcome (and its children theirs) unless it hit the
+		changed component or the new component lies across its path before the point it hit;
+		only those rays are propagated again, through the whole system. The new shape's
+		bounding sphere (see bounds()) spares the exact test for rays that pass well away.
+		With scattering materials (see stochastic()) every ray is traced again."""
+		if stochastic(components):
+			rays = [self.ray(row) for row in range(len(self)) if self.parent[row] < 0]
+			table = self.trace(components, rays, max([int(d) for d in self.depth] or [0]))
+			table.retraced = len(table)
+			return table
+		component = components[changed]
+		bound = bounds(component.shape)
+		children = self.children()
+		self.retraced = 0
+		rows = []
+		def keep(i):
+			if self.component[i] == self.UNTRACED: return True
+			if self.component[i] == changed: return False
+			origin = self.origin[i]
+			direction = self.direction[i]
+			length = float("inf")
+			if self.component[i] != self.NONE:
+				length = sum((e - o)*d for e, o, d in zip(self.end[i], origin, direction))
+			if bound is not None:
+				center, radius = bound
+				along = min(max(sum((c - o)*d for c, o, d in zip(center, origin, direction)), 0.0), length)
+				if sum((o + d*along - c)**2 for c, o, d in zip(center, origin, direction)) > radius**2: return True
+			intersection = component.firstintersection(self.ray(i))
+			if intersection is None: return True
+			if self.component[i] == self.NONE: return False
+			return (intersection.location - CSG.Vector(origin)).norm() > (CSG.Vector(self.end[i]) - CSG.Vector(origin)).norm()
+		def copy(i, parent):
+			if not keep(i):
+				start = len(rows)
+				self._visit(rows, components, self.ray(i), int(self.source[i]), parent, int(self.depth[i]))
+				self.retraced += len(rows) - start
+				return
+			index = len(rows)
+			rows.append([int(self.source[i]), parent, int(self.component[i]), int(self.depth[i]),
+						tuple(self.origin[i]), tuple(self.direction[i]), tuple(self.end[i]), float(self.wavelength[i]),
+						float(self.power[i])])
+			for child in children[i]:
+				copy(child, index)
+		for row in range(len(self)):
+			if self.parent[row] < 0: copy(row, -1)
+		table = self._fromrows(rows)
+		table.retraced = self.retraced
+		return table
+	def save(self, filename):
+		import numpy
+		with open(filename, "wb") as fd:
+			numpy.savez(fd, **dict((name, getattr(self, name)) for name in self.columns))
+	@classmethod
+	def load(cls, filename):
+		import numpy
+		with numpy.load(filename) as data:
+			return cls(*[data[name] for name in cls.columns])
+	def children(self):
+		"The rows of each row's children, in order"
+		result = [[] for i in range(len(self))]
+		for index, parent in enumerate(self.parent):
+			if parent >= 0: result[parent].append(index)
+		return result
+	def tree(self, row):
+		"The (location, [children]) tree of LightRay.trace for the ray of a row"
+		children = self.children()
+		def build(i):
+			return (CSG.Vector(self.origin[i]), [build(c) for c in children[i]])
+		return build(row)
+	def paths(self):
+		"The transmitted path of every source ray, as (wavelength, [(x, y, z), ...])"
+		children = self.children()
+		result = []
+		for row in [i for i in range(len(self)) if self.parent[i] < 0]:
+			points = [tuple(self.origin[row])]
+			while children[row]:
+				# the transmitted ray comes after the reflected one
+				row = children[row][-1]
+				points.append(tuple(self.origin[row]))
+			result.append((float(self.wavelength[row]), points))
+		return result
+	def hits(self, component):
+		"Rows of the rays that hit a component, and the points where they hit it"
+		import numpy
+		rows = numpy.flatnonzero(self.component == component)
+		return rows, self.end[rows]
+	def spectrum(self, component, edges):
+		"""Power reaching a component (a detector) in each wavelength bin between edges; the
+		absorbance of a sample is log10(blank/sample) for the spectra of the two traces"""
+		import numpy
+		rows = self.component == component
+		return numpy.histogram(self.wavelength[rows], bins=edges, weights=self.power[rows])[0]
+
+class TraceCache:
+	"Segment tables of traced scenes in a directory, the least recently used ones removed beyond maxbytes"
+	def __init__(self, directory, maxbytes=256*2**20):
+		self.directory = os.path.expanduser(directory)
+		self.maxbytes = maxbytes
+		if not os.path.isdir(self.directory): os.makedirs(self.directory)
+	def __repr__(self):
+		return "TraceCache(%r)" % self.directory
+	def key(self, scene, depth):
+		return hashlib.sha256(("%s depth=%d" % (scene.hash(), depth)).encode("ascii")).hexdigest()
+	def filename(self, key):
+		return os.path.join(self.directory, key + ".npz")
+	def get(self, key):
+		filename = self.filename(key)
+		try:
+			table = SegmentTable.load(filename)
+		except (IOError, OSError, ValueError, KeyError):
+			return None
+		# the modification time orders the entries for eviction
+		os.utime(filename, None)
+		return table
+	def put(self, key, table):
+		filename = self.filename(key)
+		temporary = "%s.%d.tmp" % (filename, os.getpid())
+		table.save(temporary)
+		os.rename(temporary, filename)
+		self.evict()
+	def evict(self):
+		entries = []
+		for name in os.listdir(self.directory):
+			if not name.endswith(".npz"): continue
+			path = os.path.join(self.directory, name)
+			try: entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+			except OSError: pass
+		total = sum(size for mtime, size, path in entries)
+		# the most recent entry stays, even alone beyond the limit
+		for mtime, size, path in sorted(entries)[:-1]:
+			if total <= self.maxbytes: break
+			try: os.remove(path)
+			except OSError: pass
+			total -= size
+	def trace(self, scene, depth=8):
+		"""The segment table of a scene, from the cache if it was traced before; scenes with
+		scattering materials are always traced, and not stored"""
+		if scene.stochastic(): return scene.trace(depth)
+		key = self.key(scene, depth)
+		table = self.get(key)
+		if table is None:
+			table = scene.trace(depth)
+			self.put(key, table)
+		return table
@@ -0,0 +1,173 @@
+"""
+Aspheric, toroidal and cylindrical lens surfaces, and lenses built from them:
+
+	collimator = Surfaces.AsphericLens(center, axis, 20.0, float("inf"), 6.0, 25.0, conic1=-0.6,
+									coefficients1=(2.1e-6, -3.4e-9))
+	slitlens = Surfaces.CylindricalLens(center, axis, 15.0, float("inf"), 3.0, 10.0, 20.0)
+
+A surface is a solid like the CSG primitives: the side of z = sag(x, y) towards +z in the
+frame of its vertex (z along the axis), so that lenses are intersections of surfaces as
+in CSG.SphericalLens. Rays meet a surface where z(t) - sag(x(t), y(t)) = 0, found by
+Newton's iteration from the intersection with the base sphere, for a whole bundle of
+rays at once; the normals follow from the analytic derivatives of the sag.
+"""
+
+import abc
+
+import numpy
+
+import CSG
+
+class SagSurface(CSG.Shape, abc.ABC):
+	"""The solid on the +axis side of a surface z = sag(x, y) in the frame of its vertex;
+	subclasses define the sag"""
+	tolerance = 1e-12	# relative step at which the iteration has converged
+	iterations = 30
+	def __init__(self, vertex, axis, up=None):
+		self.vertex = vertex
+		self.axis = axis.normalize()
+		if up is None:
+			# any direction across the axis, for rotationally symmetric surfaces
+			up = CSG.Vector((0, 1, 0)) if abs(self.axis[1]) < 0.9 else CSG.Vector((1, 0, 0))
+		self.up = (up - self.axis*(up*self.axis)).normalize()
+		self.across = self.up ^ self.axis
+		self.frame = numpy.array([self.across.components, self.up.components, self.axis.components])
+	@abc.abstractmethod
+	def sag(self, x, y):
+		"The sag and its derivatives d/dx and d/dy at points of the vertex plane (arrays; nan off the surface)"
+	def baseradius(self):
+		"Radius of the sphere whose intersection seeds the iteration (inf: the vertex plane)"
+		return float("inf")
+	def local(self, points, directions):
+		return (numpy.asarray(points, dtype=float) - self.vertex.components).dot(self.frame.T), \
+			numpy.asarray(directions, dtype=float).dot(self.frame.T)
+	def seed(self, o, d):
+		"Parameters where the rays meet the base sphere near the vertex, or else the vertex plane"
+		with numpy.errstate(divide="ignore", invalid="ignore"):
+			plane = -o[:, 2]/d[:, 2]
+			radius = self.baseradius()
+			if not numpy.isfinite(radius): return plane
+			oc = o - (0, 0, radius)
+			b = (d*oc).sum(axis=1)
+			discriminant = b**2 - (oc*oc).sum(axis=1) + radius**2
+			root = numpy.sqrt(discriminant)
+			t1, t2 = -b - root, -b + root
+			# the root on the vertex side of the sphere's centre
+			z1, z2 = o[:, 2] + t1*d[:, 2], o[:, 2] + t2*d[:, 2]
+			t = numpy.where(numpy.abs(z1) <= numpy.abs(z2), t1, t2)
+		return numpy.where(discriminant >= 0, t, plane)
+	def solve(self, origins, directions):
+		"""Parameters of the intersections of a bundle of rays ((N, 3) arrays) with the
+		surface (nan where the iteration fails) and the outward unit normals there"""
+		o, d = self.local(origins, directions)
+		t = self.seed(o, d)
+		active = numpy.isfinite(t)
+		converged = numpy.zeros(len(t), dtype=bool)
+		with numpy.errstate(divide="ignore", invalid="ignore"):
+			for iteration in range(self.iterations):
+				if not active.any(): break
+				i = numpy.flatnonzero(active)
+				ti = t[i]
+				z, dzdx, dzdy = self.sag(o[i, 0] + ti*d[i, 0], o[i, 1] + ti*d[i, 1])
+				f = o[i, 2] + ti*d[i, 2] - z
+				slope = d[i, 2] - dzdx*d[i, 0] - dzdy*d[i, 1]
+				step = f/slope
+				t[i] = ti - step
+				done = numpy.abs(step) <= self.tolerance*numpy.maximum(1.0, numpy.abs(ti))
+				failed = ~numpy.isfinite(step)
+				converged[i[done]] = True
+				active[i[done | failed]] = False
+			t[~converged] = numpy.nan
+			z, dzdx, dzdy = self.sag(o[:, 0] + t*d[:, 0], o[:, 1] + t*d[:, 1])
+			normals = numpy.stack([dzdx, dzdy, -numpy.ones(len(t))], axis=1)
+			normals /= numpy.linalg.norm(normals, axis=1)[:, numpy.newaxis]
+		t[~numpy.isfinite(z)] = numpy.nan
+		return t, normals.dot(self.frame)
+	def bundlefirstintersection(self, origins, directions, epsilon=1e-5):
+		"The forward intersection of each ray of a bundle: its parameter (inf on a miss) and the normal there"
+		t, normals = self.solve(origins, directions)
+		t[~(t > epsilon)] = numpy.inf
+		return t, normals
+	def intersections(self, ray):
+		t, normals = self.solve([ray.location.components], [ray.direction.components])
+		if not numpy.isfinite(t[0]): return list()
+		return [CSG.NormalizedAnchoredVector(ray(float(t[0])), CSG.Vector(normals[0].tolist()))]
+	def __contains__(self, x):
+		p, unused = self.local([x.components], [(0, 0, 1)])
+		z, dzdx, dzdy = self.sag(p[:, 0], p[:, 1])
+		return bool(p[0, 2] > z[0])
+
+class EvenAsphere(SagSurface):
+	"""A rotationally symmetric asphere: a conic of the given vertex radius and conic constant
+	plus polynomial terms coefficients[0] r^4 + coefficients[1] r^6 + ..."""
+	def __init__(self, vertex, axis, radius, conic=0.0, coefficients=()):
+		SagSurface.__init__(self, vertex, axis)
+		self.radius = radius
+		self.conic = conic
+		self.coefficients = [float(a) for a in coefficients]
+		self.curvature = 0.0 if radius == 0 or abs(radius) == float("inf") else 1.0/radius
+	def __repr__(self):
+		return "EvenAsphere (vertex %s, axis %s, radius %s, conic %s, coefficients %s)" % (self.vertex, self.axis,
+				self.radius, self.conic, self.coefficients)
+	def baseradius(self):
+		return self.radius if self.curvature else float("inf")
+	def sag(self, x, y):
+		c = self.curvature
+		s = x*x + y*y
+		with numpy.errstate(invalid="ignore"):
+			q = numpy.sqrt(1 - (1 + self.conic)*c*c*s)
+		z = c*s/(1 + q)
+		dzds = 0.5*c/q
+		power = s
+		for i, a in enumerate(self.coefficients):
+			# the term a s^(i+2) and its derivative
+			dzds = dzds + (i + 2)*a*power
+			power = power*s
+			z = z + a*power
+		return z, 2*x*dzds, 2*y*dzds
+
+class Toroid(SagSurface):
+	"""A toroidal surface: radiusy the radius of its profile in the plane of axis and up,
+	swept around an axis along up at distance radiusx from the vertex. Either radius may be
+	infinite; with radiusx infinite it is a cylindrical surface curved along up only."""
+	def __init__(self, vertex, axis, up, radiusx, radiusy):
+		SagSurface.__init__(self, vertex, axis, up)
+		self.radiusx = radiusx
+		self.radiusy = radiusy
+	def __repr__(self):
+		return "Toroid (vertex %s, axis %s, up %s, radii %s, %s)" % (self.vertex, self.axis, self.up,
+				self.radiusx, self.radiusy)
+	def baseradius(self):
+		finite = [r for r in (self.radiusy, self.radiusx) if r != 0 and abs(r) != float("inf")]
+		return finite[0] if finite else float("inf")
+	def sag(self, x, y):
+		cy = 0.0 if self.radiusy == 0 or abs(self.radiusy) == float("inf") else 1.0/self.radiusy
+		with numpy.errstate(invalid="ignore"):
+			q = numpy.sqrt(1 - cy*cy*y*y)
+		u = cy*y*y/(1 + q)
+		dudy = cy*y/q
+		if self.radiusx == 0 or abs(self.radiusx) == float("inf"):
+			return u, 0*x, dudy
+		w = self.radiusx - u
+		with numpy.errstate(invalid="ignore"):
+			r = numpy.sqrt(w*w - x*x)
+		sign = numpy.sign(w)
+		return self.radiusx - sign*r, sign*x/r, numpy.abs(w)*dudy/r
+
+def AsphericLens(center, axis, radius1, radius2, thickness, diameter, conic1=0.0, coefficients1=(),
+				conic2=0.0, coefficients2=()):
+	"A round lens with even asphere surfaces, radii in the sign convention of CSG.SphericalLens"
+	axis = axis.normalize()
+	front = EvenAsphere(center - axis*(0.5*thickness), axis, radius1, conic1, coefficients1)
+	back = EvenAsphere(center + axis*(0.5*thickness), -axis, radius2, conic2, coefficients2)
+	return CSG.Intersection(CSG.Intersection(CSG.Cylinder(center, axis, 0.5*diameter), front), back)
+
+def CylindricalLens(center, axis, radius1, radius2, thickness, width, height, up=CSG.Vector((0, 1, 0))):
+	"""A rectangular cylindrical lens focusing across up (its cylinder axis is along up),
+	width across and height along up, radii as in CSG.SphericalLens"""
+	axis = axis.normalize()
+	front = Toroid(center - axis*(0.5*thickness), axis, up, radius1, float("inf"))
+	back = Toroid(center + axis*(0.5*thickness), -axis, up, radius2, float("inf"))
+	sides = CSG.ConvexPolyhedron([CSG.HalfSpace(center + direction*(0.5*size), direction)
+			for direction, size in ((front.across, width), (-front.across, width), (front.up, height), (-front.up, height))])
+	return CSG.Intersection(CSG.Intersection(sides, front), back)
@@ -0,0 +1,184 @@
+"""
+Performance benchmarks for the CSG and Elements raytracing modules.
+
+Reports rays/second and peak allocated memory per ray for primitive intersections,
+the nested CSG lenses built by SphericalLens, material index evaluation and full traces
+of the prism designs. Inputs are generated from a fixed seed so that results can be saved
+with --save and compared against a later run with --compare.
+
+	python benchmark.py --max-rays 10000 --save baseline.json
+	python benchmark.py --max-rays 10000 --compare baseline.json
+"""
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import CSG
+import Designs
+import Surfaces
+
+vec = Designs.vec
+
+def randomrays(n, location, axis, seed=0, spread=5.0):
+	"Rays roughly parallel to axis, starting 20 units in front of location"
+	rng = random.Random(seed)
+	side = axis ^ vec(0, 1, 0)
+	rays = []
+	for i in range(n):
+		o = location - axis*20 + side*rng.uniform(-spread, spread) + vec(0, rng.uniform(-spread, spread), 0)
+		d = axis + vec(rng.uniform(-0.05, 0.05), rng.uniform(-0.05, 0.05), rng.uniform(-0.05, 0.05))
+		rays.append(CSG.Ray(o, d))
+	return rays
+
+def timeit(function, repeat):
+	"Best wall clock time of several runs"
+	best = float("inf")
+	for i in range(repeat):
+		start = time.perf_counter()
+		function()
+		best = min(best, time.perf_counter() - start)
+	return best
+
+def memory(function):
+	"Peak memory allocated by Python objects while running function, including its result"
+	tracemalloc.start()
+	try:
+		function()
+		current, peak = tracemalloc.get_traced_memory()
+	finally:
+		tracemalloc.stop()
+	return peak
+
+class Case:
+	"A benchmark case processing nrays rays per call of run()"
+	def __init__(self, name, nrays, run):
+		self.name = name
+		self.nrays = nrays
+		self.run = run
+	def measure(self, repeat):
+		seconds = timeit(self.run, repeat)
+		peak = memory(self.run)
+		return dict(name=self.name, rays=self.nrays, seconds=seconds,
+			raysPerSecond=self.nrays/seconds, bytesPerRay=float(peak)/self.nrays)
+
+def shapecase(name, shape, rays):
+	def run():
+		return [shape.intersections(ray) for ray in rays]
+	return Case(name, len(rays), run)
+
+def firstintersectioncase(name, shape, rays):
+	def run():
+		return [shape.firstintersection(ray) for ray in rays]
+	return Case(name, len(rays), run)
+
+def materialcase(name, material, n):
+	wavelengths = Designs.linspace(400e-9, 800e-9, n)
+	def run():
+		return [material.refractiveindex(wl) for wl in wavelengths]
+	return Case(name, n, run)
+
+def tracecase(name, design, nrays, depth=8):
+	"Trace about nrays rays (a fan of 10 wavelengths) through a full design"
+	nwavelengths = min(10, nrays)
+	rays = design.sourcerays(nangles=max(1, nrays // nwavelengths), nwavelengths=nwavelengths)
+	system = design.system()
+	def run():
+		return [ray.trace(system, depth=depth) for ray in rays]
+	return Case(name, len(rays), run)
+
+def cases(nrays, maxrays, designnames):
+	"""The benchmark cases as a dict of name: factory, in running order, so that only the
+	cases that are run get their (for large traces, costly) rays built"""
+	shared = []
+	def sharedrays():
+		if not shared: shared.append(randomrays(nrays, vec(0, 0, 0), vec(0, 0, 1)))
+		return shared[0]
+	result = {}
+	shapes = [
+		("Sphere", lambda: CSG.Sphere(vec(0, 0, 0), 10.0)),
+		("Cylinder", lambda: CSG.Cylinder(vec(0, 0, 0), vec(0, 1, 0), 10.0)),
+		("HalfSpace", lambda: CSG.HalfSpace(vec(0, 0, 0), vec(0, 0, 1))),
+		("ConvexPolyhedron", lambda: CSG.Prism(vec(0, 0, 5), 15.0)),
+		("EvenAsphere", lambda: Surfaces.EvenAsphere(vec(0, 0, 5), vec(0, 0, 1), 20.0, -0.5, (1e-5,))),
+	]
+	for name, shape in shapes:
+		result[name] = lambda name=name, shape=shape: shapecase(name, shape(), sharedrays())
+	def lenscase(name, designname, component):
+		design = Designs.designs[designname]
+		incidentaxis = design.incidentaxis()
+		if component == "collimator":
+			location, axis = incidentaxis(design.collimatordistance), incidentaxis.direction
+		else:
+			location, axis = design.objectivelocation(), design.outgoingaxis().direction
+		shape = dict(design.components())[component].shape
+		return firstintersectioncase(name, shape, randomrays(nrays, location, axis))
+	for designname in "prism", "prism2":
+		for component in "collimator", "objective":
+			name = "SphericalLens %s %s" % (designname, component)
+			result[name] = lambda name=name, designname=designname, component=component: \
+				lenscase(name, designname, component)
+	for glass in sorted(Designs.PrismDesign.glasses):
+		name = "Sellmeier %s" % glass
+		result[name] = lambda name=name, glass=glass: materialcase(name, Designs.PrismDesign.glasses[glass], nrays)
+	for designname in designnames:
+		n = 100
+		while n <= maxrays:
+			name = "trace %s %d" % (designname, n)
+			result[name] = lambda name=name, designname=designname, n=n: tracecase(name, Designs.designs[designname], n)
+			n *= 10
+	return result
+
+def compare(results, baseline, tolerance):
+	"Return the names of the cases that got slower than the baseline by more than tolerance"
+	previous = dict((r["name"], r) for r in baseline["results"])
+	regressions = []
+	for r in results:
+		if r["name"] not in previous: continue
+		ratio = previous[r["name"]]["raysPerSecond"] / r["raysPerSecond"]
+		r["slowdown"] = ratio
+		if ratio > 1 + tolerance: regressions.append(r["name"])
+	return regressions
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+	parser.add_argument("--rays", type=int, default=1000, help="rays for primitive, lens and material cases")
+	parser.add_argument("--max-rays", type=int, default=1000, help="largest full trace, from 10^2 up to 10^6")
+	parser.add_argument("--design", action="append", help="prism designs to trace (default: prism, prism2)")
+	parser.add_argument("--repeat", type=int, default=3)
+	parser.add_argument("--filter", default="", help="only run cases containing this text")
+	parser.add_argument("--save", help="write results to a JSON file")
+	parser.add_argument("--compare", help="JSON file from an earlier --save to compare against")
+	parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown")
+	args = parser.parse_args(argv)
+	designnames = args.design or ["prism", "prism2"]
+	results = []
+	print("%-40s %10s %14s %12s" % ("case", "rays", "rays/s", "bytes/ray"))
+	for name, case in cases(args.rays, args.max_rays, designnames).items():
+		if args.filter not in name: continue
+		r = case().measure(args.repeat)
+		results.append(r)
+		print("%-40s %10d %14.1f %12.1f" % (r["name"], r["rays"], r["raysPerSecond"], r["bytesPerRay"]))
+		sys.stdout.flush()
+	report = dict(python=platform.python_version(), machine=platform.machine(),
+		platform=platform.platform(), rays=args.rays, repeat=args.repeat, results=results)
+	status = 0
+	if args.compare:
+		with open(args.compare) as fd:
+			regressions = compare(results, json.load(fd), args.tolerance)
+		for r in results:
+			if "slowdown" in r: print("%-40s %6.2fx the baseline time" % (r["name"], r["slowdown"]))
+		if regressions:
+			print("regressions: %s" % ", ".join(regressions))
+			status = 1
+	if args.save:
+		with open(args.save, "w") as fd:
+			json.dump(report, fd, indent=1)
+	return status
+
+if __name__ == "__main__":
+	sys.exit(main())
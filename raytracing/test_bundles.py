@@ -0,0 +1,106 @@
+"""
+Checks of the bundle tracer (Bundles) and the multi-process executor (Parallel) against
+the scalar tracer and against each other. Run with python -m pytest raytracing.
+"""
+
+import itertools
+
+import numpy
+import pytest
+
+import CSG
+import Bundles
+import Designs
+import Elements
+import Parallel
+
+EDGES = numpy.linspace(400e-9, 800e-9, 5)
+
+def prismvertices(design):
+	"The edges of the design's prism, as (x, z) points where two of its faces meet"
+	shape = dict(design.components())["prism"].shape
+	vertices = []
+	for h1, h2 in itertools.combinations(shape.halfspaces, 2):
+		(n1x, n1y, n1z), (n2x, n2y, n2z) = h1.normal.components, h2.normal.components
+		c1, c2 = h1.center*h1.normal, h2.center*h2.normal
+		vertices.append(numpy.linalg.solve([[n1x, n1z], [n2x, n2z]], [c1, c2]))
+	return numpy.array(vertices)
+
+def bundlehits(system, bundle, depth, detector):
+	"The number of times each source ray of a bundle reaches the detector"
+	hits = numpy.zeros(len(bundle), dtype=int)
+	for level in range(depth):
+		if not len(bundle): break
+		hit, t, normals = Bundles.propagate(system, bundle)
+		numpy.add.at(hits, bundle.sources[hit == detector], 1)
+		bundle = Bundles.step(system, bundle)
+	return hits
+
+@pytest.mark.parametrize("name", sorted(Designs.designs))
+def test_bundle_matches_scalar(name):
+	design = Designs.designs[name]
+	scene = design.scene(11, 7)
+	system = scene.system()
+	table = scene.trace(8)
+	vertices = prismvertices(design)
+	prism = [n for n, c in design.components()].index("prism")
+	# rays that meet the prism exactly at an edge, where the two tracers may take either face
+	ends = table.end[table.component == prism][:, [0, 2]]
+	near = numpy.linalg.norm(ends[:, numpy.newaxis] - vertices, axis=2).min(axis=1) < 1e-9
+	vertexrays = set(table.source[table.component == prism][near].tolist())
+	for detector in range(len(system)):
+		scalar = numpy.bincount(table.source[table.component == detector], minlength=len(scene.rays))
+		bundle = bundlehits(system, Bundles.Bundle.fromrays(scene.rays), 8, detector)
+		assert set(numpy.flatnonzero(scalar != bundle).tolist()) <= vertexrays
+	histogram = Bundles.Histogram(EDGES, range(len(system)))
+	Bundles.trace(system, Bundles.Bundle.fromrays(scene.rays), 8, histogram)
+	if not vertexrays:
+		expected = [table.spectrum(c, EDGES) for c in range(len(system))]
+		assert numpy.array_equal(histogram.power, expected)
+	# the axial ray of CHANGE PRISM runs into the apex of its centred prism
+	assert bool(vertexrays) == (name == "CHANGE PRISM")
+
+def test_difference_matches_scalar():
+	shape = CSG.Difference(CSG.Sphere(CSG.Vector((0, 0, 0)), 5.0), CSG.Sphere(CSG.Vector((3, 0, 0)), 4.0))
+	component = Elements.Component(shape, Elements.Absorber())
+	rng = numpy.random.default_rng(1)
+	o = rng.uniform(-10, 10, (200, 3))
+	d = rng.normal(size=(200, 3))
+	d /= numpy.linalg.norm(d, axis=1)[:, numpy.newaxis]
+	t, normals = Bundles.firstintersection(component, o, d)
+	for i in range(len(o)):
+		ray = CSG.Ray(CSG.Vector(o[i].tolist()), CSG.Vector(d[i].tolist()))
+		x = shape.firstintersection(ray)
+		if x is None:
+			assert t[i] == numpy.inf
+		else:
+			assert (x.location - ray.location)*ray.direction == pytest.approx(t[i], abs=1e-9)
+			assert numpy.allclose(x.direction.components, normals[i])
+
+def test_stream_matches_trace():
+	design = Designs.designs["prism2"]
+	system = design.system()
+	source = design.source(dtype=float)
+	traced = Bundles.Histogram(EDGES, [0, 3])
+	Bundles.trace(system, source(0, 5000), 8, traced)
+	streamed = Bundles.stream(system, source, 5000, Bundles.Histogram(EDGES, [0, 3]), chunk=1000)
+	assert numpy.array_equal(traced.power, streamed.power)
+
+def test_float32_matches_float64():
+	design = Designs.designs["prism2"]
+	system = design.system()
+	single = Bundles.stream(system, design.source(), 5000, Bundles.Histogram(EDGES, [0, 3]), chunk=1000)
+	double = Bundles.stream(system, design.source(dtype=float), 5000, Bundles.Histogram(EDGES, [0, 3]), chunk=1000)
+	assert numpy.abs(single.count - double.count).sum() <= 1e-3*double.count.sum()
+	assert numpy.allclose(single.power, double.power, rtol=1e-3, atol=1.0)
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_processes_match_serial(processes):
+	design = Designs.designs["prism2"]
+	bundle = design.source(dtype=float)(0, 3000)
+	serial = Bundles.Histogram(EDGES, [0, 3])
+	Bundles.trace(design.system(), bundle, 8, serial)
+	executor = Parallel.Executor(design.scene(), EDGES, [0, 3], processes=processes, chunk=1000)
+	assert numpy.allclose(executor.run(bundle).power, serial.power)
+	streamed = executor.stream(design.source(dtype=float), 3000)
+	assert numpy.allclose(streamed.power, serial.power)
@@ -0,0 +1,281 @@
+"""
+Command line entry point for headless acquisition, ray tracing, design sweeps, analysis
+and benchmarks:
+
+    python spectro.py acquire --config "cyan series.json" --port /dev/ttyACM0
+    python spectro.py trace --design prism2 --output prism2.json --cache ~/.cache/raytracing
+    python spectro.py sweep --design prism2 --vary baselen=20,25,30 --vary prismoffset=-11:-7:5 --output sweep.csv
+    python spectro.py sweep --paraxial --vary baselen=15:30:16 --vary incidentaxisangle=20:40:21
+    python spectro.py analyse "experimentation overall" --dye cyan --output cyan.csv
+    python spectro.py bench --max-rays 10000 --compare baseline.json
+
+Every subcommand also takes --config, a JSON file whose keys are option names (with
+underscores, e.g. "max_rays"); options on the command line override them. The time
+taken by each step is reported on stderr, and the exit status is non-zero on failure.
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+class Timer:
+    "Reports the duration of each step on stderr"
+    def __init__(self, quiet=False):
+        self.quiet = quiet
+        self.start = self.last = time.perf_counter()
+
+    def __call__(self, step):
+        now = time.perf_counter()
+        if not self.quiet:
+            sys.stderr.write("%-30s %8.3f s\n" % (step, now - self.last))
+        self.last = now
+
+    def total(self):
+        if not self.quiet:
+            sys.stderr.write("%-30s %8.3f s\n" % ("total", time.perf_counter() - self.start))
+
+def raytracing():
+    "The raytracing modules import each other by their plain names"
+    path = os.path.join(HERE, "raytracing")
+    if path not in sys.path: sys.path.insert(0, path)
+    import Designs
+    return Designs
+
+def design(name, parameters=None):
+    Designs = raytracing()
+    if name not in Designs.designs:
+        raise ValueError("unknown design %r, expected one of %s" % (name, ", ".join(sorted(Designs.designs))))
+    return Designs.designs[name].replace(**(parameters or {}))
+
+def values(text):
+    "Sweep values: a,b,c or start:stop:num"
+    if ":" in text:
+        start, stop, num = text.split(":")
+        num = int(num)
+        return [float(start) + (float(stop) - float(start)) * i / max(num - 1, 1) for i in range(num)]
+    return [json.loads(v) for v in text.split(",")]
+
+def acquire(args, timer):
+    import Acquisition
+    if not args.config and not args.samples:
+        raise ValueError("acquire needs a protocol (--config) or --samples")
+    description = dict(args.protocol or {})
+    if args.samples: description["samples"] = args.samples
+    if args.output: description["output"] = args.output
+    for name in "mode", "exposure", "repeats", "delay", "interval":
+        if getattr(args, name) is not None: description[name] = getattr(args, name)
+    if "output" not in description:
+        raise ValueError("no output file given")
+    protocol = Acquisition.Protocol(**description)
+    connection = Acquisition.SimulatedConnection() if args.simulate else None
+    with Acquisition.Spectrophotometer(args.port, connection=connection) as device:
+        if args.simulate: device.settle = device.readDelay = 0
+        timer("connect")
+        frames = Acquisition.runProtocol(protocol, device, log=(lambda message: None) if args.quiet else print)
+    timer("%d frames" % frames)
+
+def writeJSON(filename, data):
+    if filename in (None, "-"):
+        json.dump(data, sys.stdout, indent=1)
+        sys.stdout.write("\n")
+    else:
+        with open(filename, "w") as fd:
+            json.dump(data, fd, indent=1)
+
+def cache(args):
+    "The trace cache of --cache, if given"
+    if not args.cache: return None
+    raytracing()
+    import Scene
+    return Scene.TraceCache(args.cache)
+
+def trace(args, timer):
+    Designs = raytracing()
+    d = design(args.design, args.set)
+    traces = cache(args)
+    timer("build")
+    paths = d.paths(args.angles, args.wavelengths, args.depth, cache=traces)
+    timer("trace %d rays" % len(paths))
+    spread, blur = Designs.dispersion(paths)
+    writeJSON(args.output, dict(design=args.design, parameters=d.parameters, dispersion=spread, blur=blur,
+                                rays=[dict(wavelength=wl, points=points) for wl, points in paths]))
+    timer("write")
+
+def sweep(args, timer):
+    Designs = raytracing()
+    grid = dict(args.grid or {})
+    for item in args.vary or []:
+        name, text = item.split("=", 1)
+        grid[name] = values(text)
+    if not grid:
+        raise ValueError("nothing to sweep: give --vary name=values")
+    names = sorted(grid)
+    unknown = set(names) - set(Designs.PrismDesign.defaults)
+    if unknown:
+        raise ValueError("unknown design parameters %s" % ", ".join(sorted(unknown)))
+    traces = cache(args)
+    if args.paraxial:
+        import Paraxial
+    out = open(args.output, "w", newline="") if args.output not in (None, "-") else sys.stdout
+    try:
+        writer = csv.writer(out)
+        if args.paraxial:
+            writer.writerow(names + ["dispersion", "lineardispersion", "imagedistance", "seconds"])
+        else:
+            writer.writerow(names + ["dispersion", "blur", "seconds"])
+        for combination in itertools.product(*(grid[n] for n in names)):
+            start = time.perf_counter()
+            parameters = dict(args.set or {})
+            for name, value in zip(names, combination):
+                # offsets are swept along x
+                if name == "prismoffset" and not isinstance(value, (list, tuple)): value = (value, 0, 0)
+                parameters[name] = value
+            d = design(args.design, parameters)
+            if args.paraxial:
+                summary = Paraxial.FirstOrder(d).summary()
+                middle = summary["imagedistance"][len(summary["imagedistance"]) // 2]
+                metrics = [summary["dispersion"], summary.get("lineardispersion", float("nan")), middle]
+            else:
+                metrics = Designs.dispersion(d.paths(args.angles, args.wavelengths, args.depth, cache=traces))
+            writer.writerow(list(combination) + ["%.6g" % m for m in metrics] + ["%.6f" % (time.perf_counter() - start)])
+            out.flush()
+    finally:
+        if out is not sys.stdout: out.close()
+    timer("%d designs" % len(list(itertools.product(*grid.values()))))
+
+def analyse(args, timer):
+    import Analysis
+    import Dataset
+    import Unmixing
+    dataset = Dataset.Dataset(args.dataset)
+    timer("index %d spectra" % len(dataset.entries))
+    concentrations, absorbances = Unmixing.seriesFromDataset(dataset, args.dye, args.experiment)
+    fit = Analysis.fitLines(concentrations, absorbances)
+    timer("fit %d spectra" % len(concentrations))
+    rows = dataset.select(dye=args.dye, kind="raw", final=True)
+    wavelengths = dataset.wavelengths[rows[0]]
+    out = open(args.output, "w", newline="") if args.output not in (None, "-") else sys.stdout
+    try:
+        writer = csv.writer(out)
+        writer.writerow(["channel", "wavelength", "slope", "intercept", "rsquared", "stderr"])
+        for i in range(len(fit.slopes)):
+            writer.writerow([i, "%.3f" % wavelengths[i], "%.6g" % fit.slopes[i], "%.6g" % fit.intercepts[i],
+                             "%.6g" % fit.rsquared[i], "%.6g" % fit.stderr[i]])
+    finally:
+        if out is not sys.stdout: out.close()
+    timer("write")
+
+def bench(args, timer):
+    raytracing()
+    import benchmark
+    status = benchmark.main(args.arguments)
+    timer("benchmark")
+    return status
+
+def exposure(text):
+    "A preset letter or auto as given, a time in ms as a number"
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+def parameters(text):
+    "name=value, the value in JSON"
+    name, value = text.split("=", 1)
+    return name, json.loads(value)
+
+def parser():
+    main = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    commands = main.add_subparsers(dest="command")
+    commands.required = True
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--config", help="JSON file of option defaults")
+    common.add_argument("--quiet", action="store_true", help="no progress or timing output")
+
+    p = commands.add_parser("acquire", parents=[common], help="run a measurement protocol without the menus")
+    p.add_argument("--port", default="/dev/ttyACM0")
+    p.add_argument("--simulate", action="store_true", help="use a simulated device instead of the serial port")
+    p.add_argument("--output", help="spectrum file to append to")
+    p.add_argument("--samples", nargs="+", help="sample names, instead of those of the protocol")
+    p.add_argument("--mode", choices=["absorbance", "fluorescence"])
+    p.add_argument("--exposure", type=exposure, help="preset letter, time in ms, or auto")
+    p.add_argument("--repeats", type=int)
+    p.add_argument("--delay", type=float)
+    p.add_argument("--interval", type=float)
+    p.set_defaults(run=acquire, protocol=None)
+
+    for name, run, help in (("trace", trace, "trace a prism design and write the ray paths"),
+                            ("sweep", sweep, "trace a design over a grid of parameters")):
+        p = commands.add_parser(name, parents=[common], help=help)
+        p.add_argument("--design", default="prism2")
+        p.add_argument("--set", type=parameters, action="append", help="design parameter name=value (JSON)")
+        p.add_argument("--angles", type=int, default=11)
+        p.add_argument("--wavelengths", type=int, help="number of wavelengths (default: the design's)")
+        p.add_argument("--depth", type=int, default=8)
+        p.add_argument("--output", help="output file (default: standard output)")
+        p.add_argument("--cache", help="directory of cached traces, reused while a design is unchanged")
+        if name == "sweep":
+            p.add_argument("--vary", action="append", help="name=a,b,c or name=start:stop:num")
+            p.add_argument("--paraxial", action="store_true",
+                           help="first order model instead of exact traces, for screening large grids")
+            p.set_defaults(grid=None)
+        p.set_defaults(run=run)
+
+    p = commands.add_parser("analyse", parents=[common], help="per channel calibration lines of a dye series")
+    p.add_argument("dataset", nargs="?", default=os.path.join(HERE, "experimentation overall"))
+    p.add_argument("--dye", default="cyan")
+    p.add_argument("--experiment", type=int, action="append")
+    p.add_argument("--output", help="CSV file (default: standard output)")
+    p.set_defaults(run=analyse)
+
+    # the remaining options are passed on to benchmark.py
+    p = commands.add_parser("bench", parents=[common], help="raytracing benchmarks (options as benchmark.py)")
+    p.set_defaults(run=bench, arguments=[])
+    return main, commands
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    top, commands = parser()
+    args, extra = top.parse_known_args(argv)
+    if extra and args.command != "bench":
+        top.error("unrecognized arguments: %s" % " ".join(extra))
+    if args.config:
+        # the config file supplies defaults; a second parse lets the command line override them
+        with open(args.config) as fd:
+            config = json.load(fd)
+        subparser = commands.choices[args.command]
+        if args.command == "acquire":
+            # a protocol file, possibly with the device options too
+            options = dict((k, config.pop(k)) for k in ("port", "simulate", "quiet") if k in config)
+            subparser.set_defaults(protocol=config, **options)
+        elif args.command == "bench":
+            arguments = []
+            for name, value in config.items():
+                option = "--" + name.replace("_", "-")
+                if value is True: arguments.append(option)
+                elif isinstance(value, list): arguments += sum([[option, str(v)] for v in value], [])
+                elif value is not False and value is not None: arguments += [option, str(value)]
+            subparser.set_defaults(arguments=arguments)
+        else:
+            if isinstance(config.get("set"), dict): config["set"] = list(config["set"].items())
+            subparser.set_defaults(**config)
+        args, extra = top.parse_known_args(argv)
+    if args.command == "bench": args.arguments = args.arguments + extra
+    if isinstance(getattr(args, "set", None), list): args.set = dict(args.set)
+    timer = Timer(args.quiet)
+    try:
+        status = args.run(args, timer)
+    except (ValueError, IOError) as e:
+        sys.stderr.write("%s: %s\n" % (args.command, e))
+        return 2
+    timer.total()
+    return status or 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+"""
+Checks of the acquisition code against a simulated spectrometer whose spectra arrive only
+after their exposure, on a fake clock so that long exposures take no time.
+"""
+
+import time
+
+import pytest
+
+import Acquisition
+
+class Clock:
+    "time.time and time.sleep of a clock that only moves when slept on"
+    def __init__(self):
+        self.now = 1e9
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(seconds, 0)
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, "time", clock.time)
+    monkeypatch.setattr(time, "sleep", clock.sleep)
+    return clock
+
+def device(**options):
+    return Acquisition.Spectrophotometer(connection=Acquisition.SimulatedConnection(realtime=True), **options)
+
+@pytest.mark.parametrize("exposure", [1, 1500, 2500, 12000, Acquisition.MAX_EXPOSURE])
+def test_long_exposures_are_read(clock, exposure):
+    spectrometer = device()
+    spectrometer.setExposure(exposure)
+    start = clock.now
+    data = spectrometer.readSpectrum()
+    assert len(data) == len(spectrometer.calibration.channels)
+    assert spectrometer.exposure == exposure
+    assert clock.now - start >= exposure / 1000.0
+
+def test_presets_match_the_firmware(clock):
+    spectrometer = device()
+    for letter, exposure in sorted(Acquisition.PRESETS.items()):
+        spectrometer.setExposure(letter)
+        spectrometer.readSpectrum()
+        # the firmware reports the exposure it used in the header
+        assert spectrometer.exposure == exposure
+
+def test_high_dynamic_range_reads_long_brackets(clock):
+    import HighDynamicRange
+    spectrometer = device()
+    spectrometer.setExposure(3000)
+    exposures = HighDynamicRange.bracket(spectrometer.exposure)
+    assert list(exposures) == [750, 3000, 12000]
+    frame = HighDynamicRange.acquire(spectrometer, "uv")
+    assert list(frame["exposures"]) == [750, 3000, 12000]
+    assert frame["raw"].shape == (3, len(spectrometer.calibration.channels))
+    # the UV peak saturates even the shortest frame; the tails are read in all three
+    assert frame["saturated"] > 0 and frame["used"].max() == 3
+    assert spectrometer.exposure == 3000
+
+def test_kinetics_with_long_exposures(clock, tmp_path):
+    import Kinetics
+    spectrometer = device(settle=0)
+    spectrometer.setExposure(3000)
+    messages = []
+    Kinetics.record(spectrometer, str(tmp_path / "kinetics.spec"), duration=20, interval=2, chunk=4,
+                    log=messages.append)
+    times, intensities, wavelengths = Kinetics.load(str(tmp_path / "kinetics.spec"))
+    assert len(times) == 11
+    # each read takes 4 s, so the 2 s interval cannot be kept
+    assert "longer than the 2 s interval" in messages[0]
+    assert times[1] == pytest.approx(4.0)